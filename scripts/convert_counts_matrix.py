@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+"""
+Script that converts one or more ST datasets (matrix of counts in TSV format)
+where the columns are genes and the rows are spot coordinates
+        gene    gene
+XxY
+XxY
+...
+
+to the binary matrix format of the ST Analysis package (a folder with
+the counts, spots and genes as .npy files).
+
+The binary matrices can be given to the rest of the scripts instead of the
+TSV files and they will be loaded much faster (memory mapped) as they do
+not need to be parsed.
+
+The converted matrices will be written to the output folder with the
+same name as the input files and the extension .counts
+
+convert_counts_matrix.py --counts-table-files datasetA.tsv datasetB.tsv --outdir binary
+
+@Author Jose Fernandez Navarro <jose.fernandez.navarro@scilifelab.se>
+"""
+
+import argparse
+import sys
+import os
+from stanalysis.preprocessing import read_counts, write_binary_counts
+
+def main(counts_table_files, outdir, use_sparse):
+
+    if len(counts_table_files) == 0 or \
+    any([not os.path.isfile(f) for f in counts_table_files]):
+        sys.stderr.write("Error, input file/s not present or invalid format\n")
+        sys.exit(1)
+
+    if outdir is None or not os.path.isdir(outdir):
+        outdir = os.getcwd()
+    outdir = os.path.abspath(outdir)
+
+    for counts_file in counts_table_files:
+        # Read the data frame (genes as columns)
+        counts = read_counts(counts_file, use_sparse=use_sparse)
+        outfile = os.path.join(outdir, "{}.counts".format(
+            os.path.splitext(os.path.basename(counts_file))[0]))
+        print("Converting {} with {} spots and {} genes to {}".format(counts_file,
+                                                                      len(counts.index),
+                                                                      len(counts.columns),
+                                                                      outfile))
+        write_binary_counts(counts, outfile)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts-table-files", required=True, nargs='+', type=str,
+                        help="One or more matrices with gene counts per feature/spot (genes as columns)")
+    parser.add_argument("--outdir", default=None, help="Path to output dir")
+    parser.add_argument("--use-sparse", action="store_true", default=False,
+                        help="Store the counts in a sparse format (recommended for datasets\n"
+                        "with a high number of zeroes)")
+    args = parser.parse_args()
+    main(args.counts_table_files, args.outdir, args.use_sparse)
@@ -2,6 +2,10 @@
 """ 
 This script performs Differential Expression Analysis 
 using DESeq2 or Scran + DESeq2 on ST datasets.
+The DEA can also be performed natively (without R) fitting
+the negative binomial GLMs of DESeq2 (--method NBGLM) or with
+fast Wilcoxon rank-sum or Welch t-tests for exploratory comparisons 
+(--method Wilcoxon or TTest) of many pairs of conditions.
 
 The script can take one or several datasets with the following format:
 
@@ -30,17 +34,19 @@ import sys
 import os
 import numpy as np
 import pandas as pd
-from stanalysis.normalization import RimportLibrary
+from stanalysis.normalization import RimportLibrary, computeSumFactors
 from stanalysis.preprocessing import compute_size_factors, aggregate_datatasets, remove_noise
 from stanalysis.visualization import volcano
-from stanalysis.analysis import deaDESeq2, deaScranDESeq2
+from stanalysis.analysis import deaDESeq2, deaScranDESeq2, deaNegativeBinomial, \
+     deaWilcoxon, deaTTest
+from stanalysis.rsession import set_r_workers
 import matplotlib.pyplot as plt
     
 def main(counts_table_files, conditions, comparisons, outdir, fdr, 
-         normalization, num_exp_spots, num_exp_genes, min_gene_expression):
+         normalization, num_exp_spots, num_exp_genes, min_gene_expression, num_workers, method):
 
     if len(counts_table_files) == 0 or \
-    any([not os.path.isfile(f) for f in counts_table_files]):
+    any([not os.path.exists(f) for f in counts_table_files]):
         sys.stderr.write("Error, input file/s not present or invalid format\n")
         sys.exit(1)
      
@@ -50,7 +56,7 @@ def main(counts_table_files, conditions, comparisons, outdir, fdr,
     print("Output folder {}".format(outdir))
       
     # Merge input datasets (Spots are rows and genes are columns)
-    counts = aggregate_datatasets(counts_table_files)
+    counts, spots = aggregate_datatasets(counts_table_files, return_spots=True)
     
     # Remove noisy spots and genes (Spots are rows and genes are columns)
     counts = remove_noise(counts, num_exp_genes / 100.0, num_exp_spots / 100.0, 
@@ -64,14 +70,10 @@ def main(counts_table_files, conditions, comparisons, outdir, fdr,
     for cond in conditions:
         d, c = cond.split(":")
         conds_repl[d] = c
-    conds = list()
-    for spot in counts.index:
-        index = spot.split("_")[0]
-        try:
-            conds.append(conds_repl[index])
-        except KeyError:
-            counts.drop(spot, axis=0, inplace=True)
-            continue
+    # Keep only the spots of the datasets with a condition
+    spot_conds = spots.loc[counts.index, "dataset"].astype(str).map(conds_repl)
+    counts = counts.loc[spot_conds.notnull().values]
+    conds = spot_conds.dropna().tolist()
 
     # Write the conditions to a file
     with open("conditions.txt", "w") as filehandler:
@@ -94,9 +96,21 @@ def main(counts_table_files, conditions, comparisons, outdir, fdr,
     # Spots as columns 
     counts = counts.transpose()
     
+    # The genes are split in chunks that are fitted in parallel by the R workers
+    if num_workers is not None:
+        set_r_workers(num_workers)
+
     # DEA call
     try:
-        if normalization in "DESeq2":
+        if method != "DESeq2":
+            size_factors = None if normalization == "DESeq2" \
+            else computeSumFactors(counts, scran_clusters=False)
+            dea_function = {"NBGLM" : deaNegativeBinomial,
+                            "Wilcoxon" : deaWilcoxon,
+                            "TTest" : deaTTest}[method]
+            dea_results = dea_function(counts, conds, comparisons, 
+                                       alpha=fdr, size_factors=size_factors)
+        elif normalization in "DESeq2":
             dea_results = deaDESeq2(counts, conds, comparisons, alpha=fdr, size_factors=None)
         else:
             dea_results = deaScranDESeq2(counts, conds, comparisons, alpha=fdr, scran_clusters=False)
@@ -113,7 +127,7 @@ def main(counts_table_files, conditions, comparisons, outdir, fdr,
         dea_result.to_csv(os.path.join(outdir,
                                        "dea_results_{}_vs_{}.tsv"
                                        .format(comp[0], comp[1])), sep="\t")
-        dea_result.ix[dea_result["padj"] <= fdr].to_csv(os.path.join(outdir,
+        dea_result.loc[dea_result["padj"] <= fdr].to_csv(os.path.join(outdir,
                                                                      "filtered_dea_results_{}_vs_{}.tsv"
                                                                      .format(comp[0], comp[1])), sep="\t")
         # Volcano plot
@@ -133,6 +147,15 @@ if __name__ == '__main__':
                         "DESeq2 = DESeq2::estimateSizeFactors(counts)\n" \
                         "Scran = Deconvolution Sum Factors (Marioni et al)\n" \
                         "(default: %(default)s)")
+    parser.add_argument("--method", default="DESeq2", metavar="[STR]", 
+                        type=str, 
+                        choices=["DESeq2", "NBGLM", "Wilcoxon", "TTest"],
+                        help="The method to perform the DEA:\n" \
+                        "DESeq2 = DESeq2 (R)\n" \
+                        "NBGLM = negative binomial GLMs and Wald tests computed natively (DESeq2 model)\n" \
+                        "Wilcoxon = Wilcoxon rank-sum tests of the log normalized counts\n" \
+                        "TTest = Welch t-tests of the log normalized counts\n" \
+                        "(default: %(default)s)")
     parser.add_argument("--conditions", required=True, nargs='+', type=str,
                         help="One of more tuples that represent what conditions to give to each dataset.\n" \
                         "The notation is simple: DATASET:CONDITION DATASET:CONDITION ...\n" \
@@ -152,8 +175,12 @@ if __name__ == '__main__':
                         "considered expressed (default: %(default)s)")
     parser.add_argument("--fdr", type=float, default=0.01,
                         help="The FDR minimum confidence threshold (default: %(default)s)")
+    parser.add_argument("--num-workers", default=None, metavar="[INT]", type=int,
+                        help="The number of R processes used to fit the DEA models in parallel.\n" \
+                        "The genes are split in as many chunks as processes\n" \
+                        "(default: the STANALYSIS_R_WORKERS environment variable or 1)")
     parser.add_argument("--outdir", help="Path to output dir")
     args = parser.parse_args()
     main(args.counts_table_files, args.conditions, args.comparisons, args.outdir,
          args.fdr, args.normalization, args.num_exp_spots, args.num_exp_genes, 
-         args.min_gene_expression)
\ No newline at end of file
+         args.min_gene_expression, args.num_workers, args.method)
\ No newline at end of file
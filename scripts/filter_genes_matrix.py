@@ -18,10 +18,11 @@ import sys
 import os
 import pandas as pd
 import re
+from stanalysis.preprocessing import read_counts
 
 def main(counts_matrix, reg_exps, outfile):
 
-    if not os.path.isfile(counts_matrix):
+    if not os.path.exists(counts_matrix):
         sys.stderr.write("Error, input file not present or invalid format\n")
         sys.exit(1)
      
@@ -29,7 +30,7 @@ def main(counts_matrix, reg_exps, outfile):
         outfile = "filtered_{}".format(os.path.basename(counts_matrix).split(".")[0])
     
     # Read the data frame (genes as columns)
-    counts_table = pd.read_table(counts_matrix, sep="\t", header=0, index_col=0)
+    counts_table = read_counts(counts_matrix)
     genes = counts_table.columns
     # Filter out genes that match any of the reg-exps
     genes = [gene for gene in genes if any([re.match(regex,gene) for regex in reg_exps])]
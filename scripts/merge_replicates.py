@@ -1,18 +1,21 @@
 #! /usr/bin/env python
 """
-This scripts merges two ST datasets (technical replicates
+This scripts merges two or more ST datasets (technical replicates
 from the same individual).
 
-It keeps only the genes that are in both datasets
-(summing their counts or averaging them).
+It keeps only the genes that are in all the datasets
+(summing their counts, averaging them or computing their median).
 
-Assumes that both matrices have the same order of genes and spots
-and that the spots of both datasets are located in the same part of the tissue (aligned).
+Assumes that the spots of all the datasets are located in the same part 
+of the tissue (aligned). The spots are matched by their coordinates 
+(the closest spot within a distance of 0.6) so the matrices do not
+need to have the same order of spots or genes. Spots that are not
+present in all the datasets will be discarded.
 
 The spots coordinates of the merged dataset will be the ones present in the first
 dataset.
 
-merge_replicates.py --input-files datasetA.tsv datasetB.tsv --output merged.tsv
+merge_replicates.py --input-files datasetA.tsv datasetB.tsv datasetC.tsv --output merged.tsv
 
 @Author Jose Fernandez Navarro <jose.fernandez.navarro@scilifelab.se>
 """
@@ -21,11 +24,11 @@ import argparse
 import sys
 import os
 import pandas as pd
-from stanalysis.preprocessing import merge_datasets
+from stanalysis.preprocessing import merge_datasets, read_counts
 
 def main(input_files, outfile, merging_action):
 
-    if len(input_files) != 2 or any([not os.path.isfile(f) for f in input_files]):
+    if len(input_files) < 2 or any([not os.path.exists(f) for f in input_files]):
         sys.stderr.write("Error, input file not present or invalid format\n")
         sys.exit(1)
      
@@ -33,21 +36,18 @@ def main(input_files, outfile, merging_action):
         outfile = "merged.tsv"
     
     # Read the data frames (genes as columns)
-    counts_tableA = pd.read_table(input_files[0], sep="\t", header=0, index_col=0)
-    counts_tableB = pd.read_table(input_files[1], sep="\t", header=0, index_col=0)
+    counts_tables = list()
+    for input_file in input_files:
+        counts = read_counts(input_file)
+        print("Merging dataset {} with {} spots and {} genes".format(input_file,
+                                                                     len(counts.index),
+                                                                     len(counts.columns)))
+        counts_tables.append(counts)
 
-    num_spotsA = len(counts_tableA.index)
-    num_spotsB = len(counts_tableB.index)
-    if num_spotsA != num_spotsB:
-        sys.stderr.write("Error, datasets have different number of spots "
-                         "{} and {}\n".format(num_spotsA, num_spotsB))
-        sys.exit(1)
-         
-    print("Merging dataset {} with {} spots and {} genes with "
-          "dataset {} with {} spots and {} genes".format(input_files[0], input_files[1], 
-                                                         num_spotsA, num_spotsB))
-    # Merge the two datasets
-    merged_table = merge_datasets(counts_tableA, counts_tableB, merging_action)
+    # Merge the datasets
+    merged_table = merge_datasets(counts_tables, merging_action)
+    print("Merged dataset has {} spots and {} genes".format(len(merged_table.index),
+                                                            len(merged_table.columns)))
     
     # Write merged table
     merged_table.to_csv(outfile, sep='\t')
@@ -56,13 +56,12 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument("--input-files", required=True, nargs='+', type=str,
-                        help="Two ST datasets (matrix of counts in TSV format)")
+                        help="Two or more ST datasets (matrix of counts in TSV format)")
     parser.add_argument("--outfile", help="Name of the output file")
     parser.add_argument("--merging-action", default="Sum", metavar="[STR]", 
-                        type=str, choices=["Sum", "Median"],
-                        help="How to merge the counts of common genes in both datasets.\n"
-                        "Sum will sum the counts of both and Median will sum the counts and "
-                        "divided by 2 (default: %(default)s).")
+                        type=str, choices=["Sum", "Avg", "Median"],
+                        help="How to merge the counts of common genes in the datasets.\n"
+                        "Sum will sum the counts, Avg will average the counts and "
+                        "Median will compute the median of the counts (default: %(default)s).")
     args = parser.parse_args()
     main(args.input_files, args.outfile, args.merging_action)
-
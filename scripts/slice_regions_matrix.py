@@ -29,10 +29,11 @@ import sys
 import os
 import pandas as pd
 from collections import defaultdict
+from stanalysis.preprocessing import read_counts
 
 def main(counts_matrix, class_file, regions):
 
-    if not os.path.isfile(counts_matrix) \
+    if not os.path.exists(counts_matrix) \
     or not os.path.isfile(class_file) or len(regions) == 0:
         sys.stderr.write("Error, input file not present or invalid format\n")
         sys.exit(1)
@@ -40,7 +41,7 @@ def main(counts_matrix, class_file, regions):
     # Get the file name
     base_name = os.path.basename(counts_matrix).split(".")[0]
     # Read the data frame (genes as columns)
-    counts_table = pd.read_table(counts_matrix, sep="\t", header=0, index_col=0)
+    counts_table = read_counts(counts_matrix)
     # Load the spot classes
     spot_classes = defaultdict(list)
     with open(class_file) as filehandler:
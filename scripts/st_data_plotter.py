@@ -20,7 +20,6 @@ what spots to plot
 """
 
 import argparse
-import re
 from matplotlib import pyplot as plt
 from stanalysis.visualization import scatter_plot
 from stanalysis.preprocessing import *
@@ -39,10 +38,11 @@ def main(counts_table_files,
          normalization,
          filter_genes,
          outdir,
-         use_log_scale):
+         use_log_scale,
+         no_cache):
 
     if len(counts_table_files) == 0 or \
-    any([not os.path.isfile(f) for f in counts_table_files]):
+    any([not os.path.exists(f) for f in counts_table_files]):
         sys.stderr.write("Error, input file/s not present or invalid format\n")
         sys.exit(1)
     
@@ -65,67 +65,70 @@ def main(counts_table_files,
     print("Output directory {}".format(outdir))
     print("Input datasets {}".format(" ".join(counts_table_files))) 
          
+    # With binary matrices and no normalization only the genes
+    # to be shown are read from disk (the spots are filtered with
+    # the number of expressed genes computed over all the genes)
+    genes = None
+    spot_nnz = None
+    if filter_genes and normalization == "RAW" \
+    and all([os.path.isdir(f) for f in counts_table_files]):
+        genes = set()
+        for counts_file in counts_table_files:
+            gene_names = read_genes(counts_file).astype(str)
+            for regex in filter_genes:
+                genes.update(gene_names[gene_names.str.match(regex)])
+        if len(genes) == 0:
+            sys.stderr.write("Error, no genes found with the reg-exp given\n")
+            sys.exit(1)
+        genes = sorted(genes)
+        print("Reading only the {} genes to be shown".format(len(genes)))
+        spot_nnz = count_spot_genes(counts_table_files)
+         
     # Merge input datasets (Spots are rows and genes are columns)
-    counts = aggregate_datatasets(counts_table_files)
+    counts, spots = aggregate_datatasets(counts_table_files, return_spots=True, genes=genes)
     print("Total number of spots {}".format(len(counts.index)))
     print("Total number of genes {}".format(len(counts.columns)))
 
     # Remove noisy spots and genes (Spots are rows and genes are columns)
-    counts = remove_noise(counts, 1 / 100.0, 1 / 100.0, min_expression=1)
+    counts = remove_noise(counts, 1 / 100.0, 1 / 100.0, min_expression=1, spot_nnz=spot_nnz)
     
     # Normalization
     print("Computing per spot normalization...")
-    counts = normalize_data(counts, normalization)
+    counts = normalize_data(counts, normalization, use_cache=not no_cache)
                          
     # Extract the list of the genes that must be shown
-    genes_to_keep = list()
     if filter_genes:
-        for gene in counts.columns:
-            for regex in filter_genes:
-                if re.match(regex, gene):
-                    genes_to_keep.append(gene)
-                    break                         
+        gene_names = counts.columns.astype(str)
+        genes_to_keep = np.zeros(len(gene_names), dtype=bool)
+        for regex in filter_genes:
+            genes_to_keep |= np.asarray(gene_names.str.match(regex), dtype=bool)
     else: 
-        genes_to_keep = counts.columns
+        genes_to_keep = np.ones(len(counts.columns), dtype=bool)
     
-    if len(genes_to_keep) == 0:
+    if not np.any(genes_to_keep):
         sys.stderr.write("Error, no genes found with the reg-exp given\n")
         sys.exit(1)        
     
+    # Compute the expressions for each spot
+    # as the sum of all the genes that pass the thresholds (Gene and counts)
+    values = to_dense(counts.iloc[:,genes_to_keep]).values
+    expression = np.where(values > cutoff, values, 0.0).sum(axis=1)
+    spots = spots.loc[counts.index].assign(expression=expression)
+    spots = spots[spots["expression"] > 0.0]
+    if use_log_scale:
+        spots["expression"] = np.log2(spots["expression"])
+    vmin = spots["expression"].min() if len(spots.index) > 0 else 10e6
+    vmax = spots["expression"].max() if len(spots.index) > 0 else -1
+    datasets = dict(list(spots.groupby("dataset")))
+    
     # Create a scatter plot for each dataset
     print("Plotting data...")
-    total_spots = counts.index
-    vmin = 10e6
-    vmax = -1
-    x_points = list()
-    y_points = list()
-    colors = list()
-    for i, name in enumerate(counts_table_files):
-        spots = filter(lambda x:'{}_'.format(i) in x, total_spots)
-        # Compute the expressions for each spot
-        # as the sum of all spots that pass the thresholds (Gene and counts)
-        x_points.append(list())
-        y_points.append(list())
-        colors.append(list())
-        for spot in spots:
-            tokens = spot.split("x")
-            assert(len(tokens) == 2)
-            y = float(tokens[1])
-            x = float(tokens[0].split("_")[1])
-            exp = sum(count for count in counts.loc[spot,genes_to_keep] if count > cutoff)
-            if exp > 0.0:
-                x_points[i].append(x)
-                y_points[i].append(y)
-                if use_log_scale: exp = np.log2(exp)
-                vmin = min(vmin, exp)
-                vmax = max(vmax, exp)
-                colors[i].append(exp)
-                
     for i, name in enumerate(counts_table_files):
         
-        if len(colors[i]) == 0:
-            sys.stdount.write("Warning, the gene/s given are not expressed in {}\n".format(name))
+        if i not in datasets:
+            sys.stdout.write("Warning, the gene/s given are not expressed in {}\n".format(name))
             continue 
+        dataset = datasets[i]
  
         # Retrieve alignment matrix and image if any
         image = image_files[i] if image_files is not None \
@@ -138,9 +141,9 @@ def main(counts_table_files,
     
         # Create a scatter plot for the gene data
         # If image is given plot it as a background
-        scatter_plot(x_points=x_points[i],
-                     y_points=y_points[i],
-                     colors=colors[i],
+        scatter_plot(x_points=dataset["x"].values,
+                     y_points=dataset["y"].values,
+                     colors=dataset["expression"].values,
                      output=os.path.join(outdir, "{}.pdf".format(os.path.splitext(os.path.basename(name))[0])),
                      alignment=alignment_matrix,
                      cmap=plt.get_cmap("YlOrBr"),
@@ -194,12 +197,20 @@ if __name__ == '__main__':
                         "(default: %(default)s)")
     parser.add_argument("--show-genes", help="Regular expression for gene symbols to be shown\n" \
                         "If given only the genes matching the reg-exp will be shown.\n" \
-                        "Can be given several times.",
+                        "Can be given several times.\n" \
+                        "If the datasets are binary matrices (see convert_counts_matrix.py) and\n" \
+                        "the counts are not normalized (RAW) only these genes are read from disk\n" \
+                        "(the spots noise filter is still computed over all the genes).",
                         default=None,
                         type=str,
                         action='append')
     parser.add_argument("--outdir", default=None, help="Path to output dir")
     parser.add_argument("--use-log-scale", action="store_true", default=False, help="Use log2(counts + 1) values")
+    parser.add_argument("--no-cache", action="store_true", default=False,
+                        help="Do not use the on-disk cache of the size factors and normalized counts.\n" \
+                        "By default they are stored (keyed by the content of the filtered counts\n" \
+                        "and the normalization options) so the next runs on the same datasets\n" \
+                        "skip the normalization (see STANALYSIS_CACHE_DIR and STANALYSIS_CACHE_SIZE)")
     args = parser.parse_args()
 
     main(args.counts_table_files,
@@ -211,4 +222,5 @@ if __name__ == '__main__':
          args.normalization,
          args.show_genes,
          args.outdir,
-         args.use_log_scale)
+         args.use_log_scale,
+         args.no_cache)
@@ -6,7 +6,9 @@ Script that creates a 3D scatter plot from an ST atlas.
 It needs a matrix of counts with all the sections and a meta-data
 matrix with information about the spots such as the 3D coordiantes (ML, AP and DV).
 
-The output will be an image file for each gene given as input.
+The output will be a self-contained HTML file with the 3D plot of
+the genes given as input (a selector allows to choose the gene to show)
+or an HTML file for each gene (--per-gene-files). No browser is opened.
 
 It allows to choose transparency for the data points and their size.
 
@@ -18,7 +20,9 @@ It allows to apply a cut-off on the number of reads.
 """
 
 import argparse
+import json
 import plotly
+import plotly.offline
 from plotly.graph_objs import Scatter3d, Layout, ColorBar
 from stanalysis.preprocessing import *
 import pandas as pd
@@ -34,9 +38,10 @@ def main(counts_table,
          normalization,
          genes,
          outdir,
-         use_log_scale):
+         use_log_scale,
+         per_gene_files):
 
-    if not os.path.isfile(counts_table) or not os.path.isfile(meta_info):
+    if not os.path.exists(counts_table) or not os.path.isfile(meta_info):
         sys.stderr.write("Error, input file/s not present or invalid format\n")
         sys.exit(1)
     
@@ -46,7 +51,7 @@ def main(counts_table,
     print("Output directory {}".format(outdir))
          
     # Counts table (Spots are rows and genes are columns)
-    counts = pd.read_table(counts_table, sep="\t", header=0, index_col=0)
+    counts = read_counts(counts_table)
     print("Total number of spots {}".format(len(counts.index)))
     print("Total number of genes {}".format(len(counts.columns)))
 
@@ -62,44 +67,120 @@ def main(counts_table,
     print("Computing per spot normalization...")
     counts = normalize_data(counts, normalization)      
     
-    # Create a 3D scatter plot for each gene
+    if not genes:
+        sys.stderr.write("Error, no genes given to plot\n")
+        sys.exit(1)
+    missing = [gene for gene in genes if gene not in counts.columns]
+    if len(missing) > 0:
+        print("Warning, the genes {} are not present in the data".format(", ".join(missing)))
+    genes = [gene for gene in genes if gene in counts.columns]
+    if len(genes) == 0:
+        sys.stderr.write("Error, none of the genes given is present in the data\n")
+        sys.exit(1)
+    
+    # Join the 3D coordinates of the spots and extract the expression of the genes (once)
+    spots = counts.index[counts.index.isin(meta.index)]
+    coordinates = meta.loc[spots, ["ML", "AP", "DV"]].astype(float)
+    expression = to_dense(counts.loc[spots, genes]).values.astype(float)
+    if use_log_scale:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            expression = np.where(expression > cutoff, np.log2(expression), np.nan)
+    else:
+        expression = np.where(expression > cutoff, expression, np.nan)
+    
+    # The coordinates are shared by all the genes (the plot is updated in the browser)
+    trace = Scatter3d(mode='markers',
+                      marker=dict(size=dot_size,
+                                  colorbar=ColorBar(title='Colorbar'),
+                                  colorscale='Jet',
+                                  opacity=data_alpha))        
+    layout = Layout(margin=dict(l=0,r=0,b=0,t=0), 
+                    scene=dict(xaxis=dict(title='x = Medial-lateral (mm)', range=[0, 5],),
+                               yaxis=dict(title='y = Anterior-posterior (mm)', range=[-5.9, 3],),
+                               zaxis=dict(title='z = Dorsal-ventral (mm)', range=[-7.9, 0],),))
     print("Plotting data...")
-    for gene in genes:
-        vmin = 10e6
-        vmax = -1
-        x = list()
-        y = list()
-        z = list()
-        colors = list()
-        # First try the super non-optimal way
-        # TODO this can be done in few lines using slicing
-        # TODO no need to iterate all the spots every time
-        for spot in counts.index:
-            exp = counts.at[spot,gene]
-            if exp > cutoff:
-                x.append(float(meta.at[spot,"ML"]))
-                y.append(float(meta.at[spot,"AP"]))
-                z.append(float(meta.at[spot,"DV"]))
-                if use_log_scale: 
-                    exp = np.log2(exp)
-                vmin = min(vmin, exp)
-                vmax = max(vmax, exp)
-                colors.append(exp)     
-        trace = Scatter3d(x=x, y=y, z=z,
-                          mode='markers',
-                          marker=dict(size=dot_size,
-                                      cmin=vmin,
-                                      cmax=vmax,
-                                      color=colors,
-                                      colorbar=ColorBar(title='Colorbar'),
-                                      colorscale='Jet',
-                                      opacity=data_alpha))        
-        layout = Layout(margin=dict(l=0,r=0,b=0,t=0), 
-                        title=gene,
-                        scene=dict(xaxis=dict(title='x = Medial-lateral (mm)', range=[0, 5],),
-                                   yaxis=dict(title='y = Anterior-posterior (mm)', range=[-5.9, 3],),
-                                   zaxis=dict(title='z = Dorsal-ventral (mm)', range=[-7.9, 0],),))
-        plotly.offline.plot({"data": [trace],"layout": layout})
+    if per_gene_files:
+        for k, gene in enumerate(genes):
+            write_html(os.path.join(outdir, "{}.html".format(gene)), [gene], 
+                       coordinates, expression[:,[k]], trace, layout)
+    else:
+        name = os.path.splitext(os.path.basename(counts_table))[0]
+        write_html(os.path.join(outdir, "{}_3D.html".format(name)), genes, 
+                   coordinates, expression, trace, layout)
+
+def write_html(filename, genes, coordinates, expression, trace, layout):
+    """ Writes a self-contained HTML file with a 3D scatter plot 
+    of the expression of the given genes and a selector of the gene
+    to show. The coordinates are stored once and only the spots where
+    each gene is expressed (missing values are not shown) are stored as
+    (spot indexes, values) and plotted in the browser.
+    """
+    expressed = [np.flatnonzero(~np.isnan(expression[:,k])) for k in range(len(genes))]
+    data = {"genes" : genes,
+            "x" : coordinates["ML"].tolist(),
+            "y" : coordinates["AP"].tolist(),
+            "z" : coordinates["DV"].tolist(),
+            "spots" : [spots.tolist() for spots in expressed],
+            "values" : [expression[spots,k].tolist() for k, spots in enumerate(expressed)]}
+    html = HTML_TEMPLATE.replace("@PLOTLYJS@", plotly.offline.get_plotlyjs()) \
+    .replace("@DATA@", json.dumps(data)) \
+    .replace("@TRACE@", json.dumps(trace, cls=plotly.utils.PlotlyJSONEncoder)) \
+    .replace("@LAYOUT@", json.dumps(layout, cls=plotly.utils.PlotlyJSONEncoder)) \
+    .replace("@SELECTOR@", "none" if len(genes) == 1 else "block")
+    with open(filename, "w") as filehandler:
+        filehandler.write(html)
+    print("Plot written to {}".format(filename))
+
+HTML_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8"/>
+<script type="text/javascript">@PLOTLYJS@</script>
+</head>
+<body>
+<select id="gene" style="display:@SELECTOR@"></select>
+<div id="plot" style="width:100%;height:95vh;"></div>
+<script type="text/javascript">
+var data = @DATA@;
+var trace = @TRACE@;
+var layout = @LAYOUT@;
+var selector = document.getElementById("gene");
+data.genes.forEach(function(gene, k) {
+    var option = document.createElement("option");
+    option.value = k;
+    option.text = gene;
+    selector.appendChild(option);
+});
+function show(k) {
+    var spots = data.spots[k], colors = data.values[k];
+    var x = new Array(spots.length), y = new Array(spots.length), z = new Array(spots.length);
+    // A loop instead of Math.min.apply() (that overflows the stack with many spots)
+    var cmin = Infinity, cmax = -Infinity;
+    for (var i = 0; i < spots.length; i++) {
+        x[i] = data.x[spots[i]];
+        y[i] = data.y[spots[i]];
+        z[i] = data.z[spots[i]];
+        if (colors[i] < cmin) { cmin = colors[i]; }
+        if (colors[i] > cmax) { cmax = colors[i]; }
+    }
+    var gene_trace = JSON.parse(JSON.stringify(trace));
+    gene_trace.x = x;
+    gene_trace.y = y;
+    gene_trace.z = z;
+    gene_trace.marker.color = colors;
+    if (spots.length > 0) {
+        gene_trace.marker.cmin = cmin;
+        gene_trace.marker.cmax = cmax;
+    }
+    layout.title = {text: data.genes[k]};
+    Plotly.react("plot", [gene_trace], layout);
+}
+selector.onchange = function() { show(parseInt(selector.value)); };
+show(0);
+</script>
+</body>
+</html>
+"""
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__,
@@ -136,6 +217,9 @@ if __name__ == '__main__':
                         action='append')
     parser.add_argument("--outdir", default=None, help="Path to output dir")
     parser.add_argument("--use-log-scale", action="store_true", default=False, help="Use log2(counts + 1) values")
+    parser.add_argument("--per-gene-files", action="store_true", default=False,
+                        help="Write one HTML file for each gene instead of a single HTML file\n" \
+                        "with a selector of the gene to show")
     args = parser.parse_args()
 
     main(args.counts_table,
@@ -146,4 +230,5 @@ if __name__ == '__main__':
          args.normalization,
          args.show_genes,
          args.outdir,
-         args.use_log_scale)
+         args.use_log_scale,
+         args.per_gene_files)
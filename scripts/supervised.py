@@ -5,7 +5,7 @@ using a training set and a test set.
 
 The training set will be one or more matrices of
 with counts (genes as columns and spots as rows)
-and the test set will be one matrix of counts.
+and the test set will be one or more matrices of counts.
 
 One file or files with class labels for the training set is needed
 so the classifier knows what class each spot(row) in
@@ -24,24 +24,43 @@ methods.
 The script will output the predicted classes and the spots
 plotted on top of an image if the image is given.
 
+The trained model can be saved (--save-model) and used later to
+predict new test sets without training again (--load-model).
+
+The parameters of the SVC classifier (C, kernel and gamma) can be
+tuned with a cross validation before training it (--tune).
+
 @Author Jose Fernandez Navarro <jose.fernandez.navarro@scilifelab.se>
 """
 import argparse
 import sys
 import os
+import time
+import pickle
+import tempfile
+import multiprocessing
 import numpy as np
 import pandas as pd
+import sklearn
 #from sklearn.feature_selection import VarianceThreshold
 from stanalysis.preprocessing import *
 from sklearn.svm import LinearSVC, SVC
+from sklearn.linear_model import SGDClassifier
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.preprocessing import StandardScaler
+from sklearn.pipeline import Pipeline
 from sklearn import metrics
+from sklearn.model_selection import StratifiedKFold, ParameterGrid, ParameterSampler
+from scipy.stats import reciprocal
 from sklearn.multiclass import OneVsRestClassifier
 from stanalysis.visualization import scatter_plot, color_map
 from stanalysis.alignment import parseAlignmentMatrix
 from stanalysis.analysis import weighted_color, composite_colors
-from cProfile import label
 from matplotlib.colors import LinearSegmentedColormap
 
+# Version of the format of the model files (increased when it changes)
+MODEL_VERSION = 1
+
 def main(train_data, 
          test_data, 
          classes_train, 
@@ -51,127 +70,175 @@ def main(train_data,
          outdir,
          alignment, 
          image,
-         spot_size):
+         spot_size,
+         save_model,
+         load_model,
+         classifier_name,
+         batch_size,
+         tune,
+         num_folds,
+         num_iterations,
+         num_workers):
 
-    if len(train_data) == 0 or any([not os.path.isfile(f) for f in train_data]) \
+    if load_model is None and (train_data is None or classes_train is None):
+        sys.stderr.write("Error, the train data and classes are needed to train the classifier\n")
+        sys.exit(1)
+        
+    if load_model is not None and not os.path.isfile(load_model):
+        sys.stderr.write("Error, the model file is not present\n")
+        sys.exit(1)
+        
+    if load_model is None and (len(train_data) == 0 or any([not os.path.exists(f) for f in train_data]) \
     or len(train_data) != len(classes_train) \
-    or len(classes_train) == 0 or any([not os.path.isfile(f) for f in classes_train]) \
-    or not os.path.isfile(classes_test):
+    or len(classes_train) == 0 or any([not os.path.isfile(f) for f in classes_train])):
         sys.stderr.write("Error, input file/s not present or invalid format\n")
         sys.exit(1)
+        
+    test_data = test_data if test_data is not None else list()
+    if any([not os.path.exists(f) for f in test_data]) or (classes_test is not None \
+    and (len(classes_test) != len(test_data) or any([not os.path.isfile(f) for f in classes_test]))):
+        sys.stderr.write("Error, test file/s not present or invalid format\n")
+        sys.exit(1)
+        
+    if batch_size <= 0:
+        sys.stderr.write("Error, the batch size must be bigger than 0\n")
+        sys.exit(1)
+        
+    if tune is not None and (load_model is not None or classifier_name != "SVC"):
+        sys.stderr.write("Error, the parameters can only be tuned when training the SVC classifier\n")
+        sys.exit(1)
+        
+    if num_folds < 2 or num_iterations <= 0 or (num_workers is not None and num_workers <= 0):
+        sys.stderr.write("Error, invalid number of folds, iterations or workers\n")
+        sys.exit(1)
+        
+    if len(test_data) == 0 and save_model is None:
+        sys.stderr.write("Error, no test data to predict and no model file to save\n")
+        sys.exit(1)
      
     if not outdir or not os.path.isdir(outdir):
         outdir = os.getcwd()
         
     print("Output folder {}".format(outdir))
-  
-    # Merge input train datasets (Spots are rows and genes are columns)
-    train_data_frame = aggregate_datatasets(train_data)
-    train_genes = list(train_data_frame.columns.values)
-    
-    # loads all the classes for the training set
-    train_labels_dict = dict()
-    for i,labels_file in enumerate(classes_train):
-        with open(labels_file) as filehandler:
-            for line in filehandler.readlines():
-                tokens = line.split()
-                train_labels_dict["{}_{}".format(i,tokens[0])] = int(tokens[1])
-    # make sure the spots in the training set data frame
-    # and the label training spots have the same order
-    # and are the same 
-    train_labels = list()
-    for spot in train_data_frame.index:
-        try:
-            train_labels.append(train_labels_dict[spot])
-        except KeyError:
-            train_data_frame.drop(spot, axis=0, inplace=True)
-    if len(train_labels) != len(train_data_frame.index):
-        sys.stderr.write("Error, none of the train labels were not found in the train data\n")
-        sys.exit(1)
-         
-    # loads the test set
-    # spots are rows and genes are columns
-    test_data_frame = pd.read_table(test_data, sep="\t", header=0, index_col=0)    
-    test_genes = list(test_data_frame.columns.values)
     
-    # loads all the classes for the test set
-    # filter out labels whose spot is not present and
-    # also make sure that the order of the labels is the same in the data frame
-    test_labels = list()
-    if classes_test is not None:
-        spot_label = dict()
-        with open(classes_test) as filehandler:
-            for line in filehandler.readlines():
-                tokens = line.split()
-                assert(len(tokens) == 2)
-                spot_label[tokens[0]] = int(tokens[1])      
-        for spot in test_data_frame.index:
-            try:
-                test_labels.append(spot_label[spot])
-            except KeyError:
-                test_data_frame.drop(spot, axis=0, inplace=True)
-        if len(test_labels) != len(test_data_frame.index):
-            sys.stderr.write("Error, none of the test labels were not found in the test data\n")
+    # loads the test sets (spots are rows and genes are columns)
+    # and their classes (if given)
+    test_sets = list()
+    for i, test_file in enumerate(test_data):
+        test_data_frame = read_counts(test_file)
+        test_labels = None
+        if classes_test is not None:
+            test_data_frame, test_labels = attach_labels(test_data_frame, 
+                                                         read_labels(classes_test[i]))
+            if len(test_labels) == 0:
+                sys.stderr.write("Error, none of the test labels were found in the test data\n")
+                sys.exit(1)
+        test_sets.append((test_file, test_data_frame, test_labels))
+        
+    if load_model is not None:
+        model = read_model(load_model)
+        print("Loaded model from {} trained with {} genes".format(load_model, len(model["genes"])))
+    else:
+        # Merge input train datasets (Spots are rows and genes are columns)
+        train_data_frame = aggregate_datatasets(train_data)
+        # loads all the classes for the training set
+        train_labels_dict = dict()
+        for i,labels_file in enumerate(classes_train):
+            for spot, label in read_labels(labels_file).items():
+                train_labels_dict["{}_{}".format(i,spot)] = label
+        # make sure the spots in the training set data frame
+        # and the label training spots have the same order
+        # and are the same 
+        train_data_frame, train_labels = attach_labels(train_data_frame, train_labels_dict)
+        if len(train_labels) == 0:
+            sys.stderr.write("Error, none of the train labels were found in the train data\n")
+            sys.exit(1)
+        
+        # Keep only the genes in the training set that intersect with the test sets
+        train_genes = list(train_data_frame.columns.values)
+        print("Training genes {}".format(len(train_genes)))
+        intersect_genes = train_genes
+        for test_file, test_data_frame, _ in test_sets:
+            print("Test genes {}".format(len(test_data_frame.columns)))
+            intersect_genes = np.intersect1d(intersect_genes, test_data_frame.columns.values)
+        if len(intersect_genes) == 0:
+            sys.stderr.write("Error, there are no genes intersecting the train and test datasets\n")
             sys.exit(1)  
-          
-    # Keep only the record in the training set that intersects with the test set
-    print("Training genes {}".format(len(train_genes)))
-    print("Test genes {}".format(len(test_genes)))
-    intersect_genes = np.intersect1d(train_genes, test_genes)
-    if len(intersect_genes) == 0:
-        sys.stderr.write("Error, there are no genes intersecting the train and test datasets\n")
-        sys.exit(1)  
-            
-    print("Intersected genes {}".format(len(intersect_genes)))
-    train_data_frame = train_data_frame.ix[:,intersect_genes]
-    test_data_frame = test_data_frame.ix[:,intersect_genes]
-    
-    # Classes in test and train must be the same
-    print("Training elements {}".format(len(train_labels)))
-    print("Test elements {}".format(len(test_labels)))
-    print("Class labels {}".format(sorted(set(train_labels))))
-    
-    # Get the normalized counts
-    train_data_frame = normalize_data(train_data_frame, normalization)
-    test_data_frame = normalize_data(test_data_frame, normalization)
-    test_counts = test_data_frame.values 
-    train_counts = train_data_frame.values 
-    
-    # Log the counts
-    if use_log_scale:
-        train_counts = np.log2(train_counts + 1)
-        test_counts = np.log2(test_counts + 1)
+        print("Intersected genes {}".format(len(intersect_genes)))
         
-    # Train the classifier and predict
-    # TODO optimize parameters of the classifier (kernel="rbf" or "sigmoid")
-    classifier = OneVsRestClassifier(SVC(probability=True, random_state=0, 
-                                         decision_function_shape="ovr", kernel="linear"), n_jobs=4)
-    classifier = classifier.fit(train_counts, train_labels)
+        # Classes in test and train must be the same
+        print("Training elements {}".format(len(train_labels)))
+        print("Class labels {}".format(sorted(set(train_labels))))
+        
+        # Train the classifier
+        train_counts = prepare_counts(train_data_frame, intersect_genes, 
+                                      normalization, use_log_scale)
+        params = None
+        if tune is not None:
+            print("Tuning the parameters of the classifier ({} search)".format(tune))
+            params = tune_classifier(train_counts, train_labels, tune, num_folds, 
+                                     num_iterations, num_workers, outdir)
+            print("Best parameters {}".format(params))
+        print("Training the classifier {}".format(classifier_name))
+        classifier = train_classifier(classifier_name, train_counts, train_labels, 
+                                      batch_size, params=params)
+        model = {"version" : MODEL_VERSION,
+                 "sklearn_version" : sklearn.__version__,
+                 "method" : classifier_name,
+                 "classifier" : classifier,
+                 "genes" : list(intersect_genes),
+                 "normalization" : normalization,
+                 "use_log_scale" : use_log_scale,
+                 "classes" : list(classifier.classes_),
+                 "class_colors" : dict((label, color_map[int(label) % len(color_map)]) 
+                                       for label in classifier.classes_)}
+        if save_model is not None:
+            write_model(model, save_model)
+            print("Model saved to {}".format(save_model))
+            
+    # Predict the classes of each test set
+    for test_file, test_data_frame, test_labels in test_sets:
+        test_outdir = outdir
+        if len(test_sets) > 1:
+            test_outdir = os.path.join(outdir, os.path.splitext(os.path.basename(test_file))[0])
+            if not os.path.isdir(test_outdir):
+                os.makedirs(test_outdir)
+        print("Predicting {} with {} elements".format(test_file, len(test_data_frame.index)))
+        predict(model, test_data_frame, test_labels, test_outdir, alignment, image, spot_size)
+
+def predict(model, test_data_frame, test_labels, outdir, alignment, image, spot_size):
+    """ Predicts the classes of the spots of a test set with the given model and 
+    writes the predicted classes and probabilities and the plots of the spots
+    to the output folder.
+    """
+    missing_genes = len(np.setdiff1d(model["genes"], test_data_frame.columns.values))
+    if missing_genes > 0:
+        print("Warning, {} genes of the model are not present in the test data " \
+              "(they will have zero counts)".format(missing_genes))
+    test_counts = prepare_counts(test_data_frame, model["genes"], 
+                                 model["normalization"], model["use_log_scale"])
+    classifier = model["classifier"]
     predicted_class = classifier.predict(test_counts) 
     predicted_prob = classifier.predict_proba(test_counts)
      
     # Compute accuracy
-    if classes_test is not None:
+    if test_labels is not None:
         print("Classification report for classifier {0}:\n{1}\n".
               format(classifier, metrics.classification_report(test_labels, predicted_class)))
         print("Confusion matrix:\n{}".format(metrics.confusion_matrix(test_labels, predicted_class)))
     
     # Write the spots and their predicted classes/probs to a file
-    x_points = list()
-    y_points = list()
+    test_spots = parse_spots(test_data_frame.index, datasets=False)
+    x_points = test_spots["x"].tolist()
+    y_points = test_spots["y"].tolist()
     merged_prob_colors = list()
-    unique_colors = [color_map[i] for i in set(sorted(predicted_class))]
+    # The colors of the classes in the same order as the probabilities
+    unique_colors = [model["class_colors"][label] for label in model["classes"]]
     with open(os.path.join(outdir, "predicted_classes.txt"), "w") as filehandler:
         labels = list(test_data_frame.index)
         for i,label in enumerate(predicted_class):
             probs = predicted_prob[i].tolist()
-            merged_prob_colors.append(composite_colors(unique_colors, probs))
-            tokens = labels[i].split("x")
-            assert(len(tokens) == 2)
-            y = float(tokens[1])
-            x = float(tokens[0])
-            x_points.append(x)
-            y_points.append(y)
+            merged_prob_colors.append(tuple(composite_colors(unique_colors, probs)))
             filehandler.write("{0}\t{1}\t{2}\n".format(labels[i], label,
                                                        "\t".join(['{:.6f}'.format(x) for x in probs])))
             
@@ -211,18 +278,226 @@ def main(train_data,
                  size=spot_size,
                  show_legend=True,
                  show_color_bar=False)
+
+def train_classifier(classifier_name, counts, labels, batch_size=5000, num_epochs=5, params=None):
+    """ Trains a classifier with the given counts (spots as rows) and classes.
+    SVC is a linear kernel SVM (libsvm) whose probabilities are computed with
+    an internal cross validation. LinearSVC is a linear SVM (liblinear) with 
+    probabilities calibrated with a 3-fold cross validation. SGD is a logistic
+    regression trained with stochastic gradient descent on standardized counts 
+    by mini-batches of spots (partial fitting) so the training time grows 
+    linearly with the number of spots (the counts are in memory).
+    :param classifier_name: the classifier (SVC, LinearSVC or SGD)
+    :param counts: the counts (NumPy array)
+    :param labels: the class of each spot
+    :param batch_size: the number of spots of each mini-batch (SGD)
+    :param num_epochs: the number of passes over all the mini-batches (SGD)
+    :param params: the parameters of the SVC (C, kernel and gamma) 
+    linear kernel if None (see tune_classifier())
+    :return the trained classifier
+    """
+    if classifier_name == "SVC":
+        classifier = OneVsRestClassifier(svc_classifier(params, probability=True), n_jobs=4)
+        return classifier.fit(counts, labels)
+    elif classifier_name == "LinearSVC":
+        classifier = CalibratedClassifierCV(LinearSVC(random_state=0), method="sigmoid", cv=3)
+        return classifier.fit(counts, labels)
+    elif classifier_name == "SGD":
+        labels = np.asarray(labels)
+        classes = np.unique(labels)
+        batches = [(start, min(start + batch_size, counts.shape[0])) 
+                   for start in range(0, counts.shape[0], batch_size)]
+        scaler = StandardScaler()
+        for start, end in batches:
+            scaler.partial_fit(counts[start:end])
+        loss = "log_loss" if "log_loss" in SGDClassifier.loss_functions else "log"
+        # Strong regularization (alpha) so the probabilities are not overconfident
+        classifier = SGDClassifier(loss=loss, alpha=0.01, random_state=0)
+        random_state = np.random.RandomState(0)
+        for epoch in range(num_epochs):
+            # The spots are shuffled within each mini-batch and the mini-batches in each epoch
+            for i in random_state.permutation(len(batches)):
+                start, end = batches[i]
+                order = start + random_state.permutation(end - start)
+                classifier.partial_fit(scaler.transform(counts[order]), labels[order], classes=classes)
+        return Pipeline([("scaler", scaler), ("classifier", classifier)])
+    else:
+        raise RuntimeError("Error, invalid classifier {}\n".format(classifier_name))
+
+def svc_classifier(params=None, probability=False):
+    """ Returns a SVC with the given parameters (C, kernel 
+    and gamma) and a linear kernel by default
+    """
+    svc_params = {"kernel" : "linear"}
+    svc_params.update(params or {})
+    return SVC(probability=probability, random_state=0, 
+               decision_function_shape="ovr", **svc_params)
+
+def tune_classifier(counts, labels, search="Grid", num_folds=5, num_iterations=20, 
+                    num_workers=None, outdir=None):
+    """ Searches the parameters of the SVC (C, kernel and gamma) that give the 
+    best accuracy with a stratified k-fold cross validation. Each fold of each 
+    candidate is trained in a pool of processes. The counts are stored once in a
+    temporary file that the processes memory map (read only) and the folds are sent
+    once to each process so only the parameters are sent for each fold.
+    The accuracy and the time of each fold are written to tuning_results.txt
+    in the output folder if given.
+    :param counts: the counts (NumPy array, spots as rows)
+    :param labels: the class of each spot
+    :param search: Grid (all the combinations) or Random (num_iterations 
+    random combinations)
+    :param num_folds: the number of folds of the cross validation
+    :param num_iterations: the number of combinations of the random search
+    :param num_workers: the number of processes (default number of CPUs)
+    :param outdir: the folder where to write the results
+    :return the best parameters (dictionary)
+    """
+    labels = np.asarray(labels)
+    kernels = ["rbf", "sigmoid"]
+    if search == "Grid":
+        C_values = np.logspace(-3, 2, 6).tolist()
+        candidates = list(ParameterGrid([{"kernel" : ["linear"], "C" : C_values},
+                                         {"kernel" : kernels, "C" : C_values,
+                                          "gamma" : ["scale"] + np.logspace(-4, -1, 4).tolist()}]))
+    elif search == "Random":
+        candidates = [dict((k, float(v) if isinstance(v, float) else v) for k, v in params.items())
+                      for params in ParameterSampler([{"kernel" : ["linear"], "C" : reciprocal(1e-3, 1e2)},
+                                                      {"kernel" : kernels, "C" : reciprocal(1e-3, 1e2),
+                                                       "gamma" : reciprocal(1e-5, 1.0)}], 
+                                                     num_iterations, random_state=0)]
+    else:
+        raise RuntimeError("Error, invalid search {}\n".format(search))
+    folds = list(StratifiedKFold(n_splits=num_folds, shuffle=True, 
+                                 random_state=0).split(counts, labels))
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    fd, path = tempfile.mkstemp(suffix=".npy")
+    try:
+        with os.fdopen(fd, "wb") as filehandler:
+            np.save(filehandler, np.ascontiguousarray(counts))
+        tasks = [(i, params, fold) for i, params in enumerate(candidates) for fold in range(num_folds)]
+        pool = multiprocessing.Pool(num_workers, initializer=_init_tune_worker, 
+                                    initargs=(path, labels, folds))
+        try:
+            results = pool.map(_tune_fold, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        os.remove(path)
+    # Accuracy and times (fit, score) of each fold of each candidate
+    scores = np.zeros((len(candidates), num_folds))
+    times = np.zeros((len(candidates), num_folds, 2))
+    for i, fold, score, fit_time, score_time in results:
+        scores[i,fold] = score
+        times[i,fold] = [fit_time, score_time]
+    best = int(np.argmax(scores.mean(axis=1)))
+    lines = ["{}\t{:.4f}\t{:.4f}\t{}\t{}".format(",".join(["{}={:g}".format(k, v) if isinstance(v, float) 
+                                                           else "{}={}".format(k, v) 
+                                                           for k, v in sorted(candidates[i].items())]),
+                                                 scores[i].mean(), scores[i].std(),
+                                                 ",".join(["{:.4f}".format(x) for x in scores[i]]),
+                                                 ",".join(["{:.2f}/{:.2f}".format(*x) for x in times[i]]))
+             for i in np.argsort(-scores.mean(axis=1), kind="mergesort")]
+    header = "parameters\tmean_accuracy\tstd_accuracy\tfold_accuracy\tfold_time_fit/score(s)"
+    print("Cross validation results (best first):\n{}\n{}".format(header, "\n".join(lines[:10])))
+    print("Fit time per fold {:.2f}s (mean) {:.2f}s (max)".format(times[:,:,0].mean(), times[:,:,0].max()))
+    if outdir is not None:
+        with open(os.path.join(outdir, "tuning_results.txt"), "w") as filehandler:
+            filehandler.write("{}\n{}\n".format(header, "\n".join(lines)))
+    return candidates[best]
+
+# Counts, labels and folds of the cross validation (tuning worker processes)
+_tune_counts = None
+_tune_labels = None
+_tune_folds = None
+
+def _init_tune_worker(path, labels, folds):
+    """ Helper function that memory maps the counts 
+    in a tuning worker process
+    """
+    global _tune_counts, _tune_labels, _tune_folds
+    _tune_counts = np.load(path, mmap_mode="r")
+    _tune_labels = labels
+    _tune_folds = folds
+
+def _tune_fold(task):
+    """ Helper function that trains and scores a candidate
+    in a fold (executed in a tuning worker process)
+    """
+    candidate, params, fold = task
+    train, test = _tune_folds[fold]
+    start = time.time()
+    classifier = OneVsRestClassifier(svc_classifier(params))
+    classifier.fit(_tune_counts[train], _tune_labels[train])
+    fit_time = time.time() - start
+    start = time.time()
+    score = classifier.score(_tune_counts[test], _tune_labels[test])
+    return candidate, fold, score, fit_time, time.time() - start
+
+def read_labels(labels_file):
+    """ Reads a file with the class of each spot (SPOT_NAME CLASS_NUMBER)
+    and returns a dictionary of spot to class.
+    """
+    spot_label = dict()
+    with open(labels_file) as filehandler:
+        for line in filehandler.readlines():
+            tokens = line.split()
+            assert(len(tokens) == 2)
+            spot_label[tokens[0]] = int(tokens[1])
+    return spot_label
+
+def attach_labels(counts, spot_label):
+    """ Keeps the spots of the data frame that have a class
+    and returns the data frame and the list of classes (same order).
+    """
+    labels = pd.Series(spot_label)
+    counts = counts.loc[counts.index.isin(labels.index)]
+    return counts, labels.loc[counts.index].tolist()
+
+def prepare_counts(counts, genes, normalization, use_log_scale):
+    """ Returns the normalized counts (spots as rows) of the given genes 
+    (genes not present have zero counts) as a NumPy array in log2 + 1 
+    scale if use_log_scale is True.
+    """
+    counts = to_dense(counts).reindex(columns=genes, fill_value=0)
+    counts = normalize_data(counts, normalization).values
+    if use_log_scale:
+        counts = np.log2(counts + 1)
+    return counts
+
+def write_model(model, filename):
+    """ Writes a trained model (classifier, genes, normalization
+    and classes) to a file.
+    """
+    with open(filename, "wb") as filehandler:
+        pickle.dump(model, filehandler, pickle.HIGHEST_PROTOCOL)
+
+def read_model(filename):
+    """ Reads a trained model written with write_model()
+    and checks its version.
+    """
+    with open(filename, "rb") as filehandler:
+        model = pickle.load(filehandler)
+    if not isinstance(model, dict) or model.get("version") != MODEL_VERSION:
+        sys.stderr.write("Error, the model file has an invalid format or version\n")
+        sys.exit(1)
+    if model["sklearn_version"] != sklearn.__version__:
+        print("Warning, the model was trained with scikit-learn {} " \
+              "and the installed version is {}".format(model["sklearn_version"], sklearn.__version__))
+    return model
        
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("--train-data", required=True, nargs='+', type=str,
+    parser.add_argument("--train-data", default=None, nargs='+', type=str,
                         help="One or more data frames with normalized counts")
-    parser.add_argument("--test-data", required=True,
-                        help="One data frame with normalized counts")
-    parser.add_argument("--train-classes", required=True, nargs='+', type=str,
+    parser.add_argument("--test-data", default=None, nargs='+', type=str,
+                        help="One or more data frames with normalized counts to predict")
+    parser.add_argument("--train-classes", default=None, nargs='+', type=str,
                         help="One of more files with the class of each spot in the train data as: XxY INT")
-    parser.add_argument("--test-classes", default=None,
-                        help="One file with the class of each spot in the test data as: XxY INT")
+    parser.add_argument("--test-classes", default=None, nargs='+', type=str,
+                        help="One file for each test data frame with the class of each spot as: XxY INT")
     parser.add_argument("--use-log-scale", action="store_true", default=False,
                         help="Use log2 + 1 for the training and test set instead of raw/normalized counts.")
     parser.add_argument("--normalization", default="DESeq2", metavar="[STR]", 
@@ -251,8 +526,40 @@ if __name__ == '__main__':
     parser.add_argument("--outdir", help="Path to output dir")
     parser.add_argument("--spot-size", default=20, metavar="[INT]", type=int, choices=range(1, 100),
                         help="The size of the spots when generating the plots. (default: %(default)s)")
+    parser.add_argument("--save-model", default=None, metavar="[FILE]",
+                        help="Save the trained model (classifier, genes, normalization and\n" \
+                        "colors of the classes) to this file so it can be used with --load-model.\n" \
+                        "The test data is optional when a model is saved")
+    parser.add_argument("--load-model", default=None, metavar="[FILE]",
+                        help="Load a model saved with --save-model and predict the test data with it\n" \
+                        "(no training, the train data and classes are not needed)")
+    parser.add_argument("--classifier", default="SVC", metavar="[STR]", type=str, 
+                        choices=["SVC", "LinearSVC", "SGD"],
+                        help="The classifier to use:\n" \
+                        "SVC = linear kernel SVM with probabilities (slow with many spots)\n" \
+                        "LinearSVC = linear SVM (liblinear) with calibrated probabilities\n" \
+                        "SGD = logistic regression trained by mini-batches of spots (stochastic gradient descent)\n" \
+                        "(default: %(default)s)")
+    parser.add_argument("--batch-size", default=5000, metavar="[INT]", type=int,
+                        help="The number of spots in each mini-batch when training with SGD.\n" \
+                        "The normalized train counts are kept in memory (default: %(default)s)")
+    parser.add_argument("--tune", default=None, metavar="[STR]", type=str, choices=["Grid", "Random"],
+                        help="Search the parameters of the SVC classifier (C, kernel and gamma)\n" \
+                        "with a stratified k-fold cross validation before training it:\n" \
+                        "Grid = all the combinations of a grid of values\n" \
+                        "Random = --num-iterations random combinations\n" \
+                        "The results are written to tuning_results.txt")
+    parser.add_argument("--num-folds", default=5, metavar="[INT]", type=int,
+                        help="The number of folds of the cross validation (--tune) (default: %(default)s)")
+    parser.add_argument("--num-iterations", default=20, metavar="[INT]", type=int,
+                        help="The number of combinations of the random search (--tune) (default: %(default)s)")
+    parser.add_argument("--num-workers", default=None, metavar="[INT]", type=int,
+                        help="The number of processes used in the search (--tune)\n" \
+                        "(default: the number of CPUs)")
     args = parser.parse_args()
     main(args.train_data, args.test_data, args.train_classes, 
          args.test_classes, args.use_log_scale, args.normalization, 
-         args.outdir, args.alignment, args.image, args.spot_size)
+         args.outdir, args.alignment, args.image, args.spot_size,
+         args.save_model, args.load_model, args.classifier, args.batch_size,
+         args.tune, args.num_folds, args.num_iterations, args.num_workers)
 
@@ -26,17 +26,19 @@ import sys
 import os
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from sklearn.manifold import TSNE
 from sklearn.decomposition import PCA, FastICA, SparsePCA
 from sklearn.cluster import DBSCAN
 from sklearn.cluster import KMeans
 from sklearn.cluster import AgglomerativeClustering
+from sklearn.cluster import MiniBatchKMeans, Birch
+from sklearn.neighbors import kneighbors_graph, KDTree
 from sklearn.mixture import GaussianMixture
 from stanalysis.visualization import scatter_plot, scatter_plot3d, histogram
 from stanalysis.preprocessing import *
 from stanalysis.alignment import parseAlignmentMatrix
-from stanalysis.analysis import Rtsne, linear_conv, computeNClusters
-from collections import defaultdict
+from stanalysis.analysis import Rtsne, tsne, linear_conv, computeNClusters, computePCA
 import matplotlib.pyplot as plt
   
 def main(counts_table_files, 
@@ -58,10 +60,17 @@ def main(counts_table_files,
          use_adjusted_log,
          tsne_perplexity,
          tsne_theta,
-         color_space_plots):
+         color_space_plots,
+         use_sparse,
+         tsne_exaggeration,
+         num_threads,
+         pca_components,
+         no_cache,
+         tsne_early_iter,
+         tsne_learning_rate):
 
     if len(counts_table_files) == 0 or \
-    any([not os.path.isfile(f) for f in counts_table_files]):
+    any([not os.path.exists(f) for f in counts_table_files]):
         sys.stderr.write("Error, input file/s not present or invalid format\n")
         sys.exit(1)
     
@@ -85,6 +94,15 @@ def main(counts_table_files,
     if tsne_theta < 0.0 or tsne_theta > 1.0:
         sys.stdout.write("Warning, invalid value for theta. Using default..\n")
         tsne_theta = 0.5
+        
+    if tsne_learning_rate != "auto":
+        try:
+            tsne_learning_rate = float(tsne_learning_rate)
+        except ValueError:
+            tsne_learning_rate = -1.0
+        if tsne_learning_rate <= 0.0:
+            sys.stderr.write("Error, the t-sne learning rate must be > 0 or auto\n")
+            sys.exit(1)
                  
     if num_exp_genes <= 0 or num_exp_spots <= 0:
         sys.stdout.write("Error, min_exp_genes and min_exp_spots must be > 0.\n")
@@ -98,7 +116,8 @@ def main(counts_table_files,
     print("Input datasets {}".format(" ".join(counts_table_files))) 
          
     # Merge input datasets (Spots are rows and genes are columns)
-    counts = aggregate_datatasets(counts_table_files)
+    counts, spots = aggregate_datatasets(counts_table_files, use_sparse=use_sparse, 
+                                         return_spots=True)
     print("Total number of spots {}".format(len(counts.index)))
     print("Total number of genes {}".format(len(counts.columns)))
     
@@ -110,60 +129,129 @@ def main(counts_table_files,
         sys.stdout.write("Error, too many spots/genes were filtered.\n")
         sys.exit(1) 
                 
+    # Compute the expected number of clusters before the normalization
+    # only for Scran (the clusters are re-used in the normalization)
+    spot_clusters = None
+    if num_clusters is None and normalization == "Scran":
+        num_clusters, spot_clusters = computeNClusters(sparse_matrix(counts), return_labels=True,
+                                                       use_cache=not no_cache)
+        print("Computation of number of clusters obtained {} clusters".format(num_clusters))
+        
     # Normalize data
     print("Computing per spot normalization...")
     center_size_factors = not use_adjusted_log
     norm_counts = normalize_data(counts, normalization, 
-                                 center=center_size_factors, adjusted_log=use_adjusted_log)
+                                 center=center_size_factors, adjusted_log=use_adjusted_log,
+                                 clusters=spot_clusters, use_cache=not no_cache)
 
     # Keep top genes (variance or expressed)
     norm_counts = keep_top_genes(norm_counts, num_genes_keep / 100.0, criteria=top_genes_criteria)
        
-    # Compute the expected number of clusters
-    if num_clusters is None:
-        num_clusters = computeNClusters(counts)
-        print("Computation of number of clusters obtained {} clusters".format(num_clusters))
+    # Spots as rows and genes as columns (sparse if the counts are sparse)
+    norm_data = sparse_matrix(norm_counts) if is_sparse(norm_counts) else norm_counts.values
         
     if use_log_scale:
         print("Using pseudo-log counts log2(counts + 1)")
-        norm_counts = np.log2(norm_counts + 1)  
+        norm_data = norm_data.log1p() / np.log(2) if sp.issparse(norm_data) else np.log2(norm_data + 1)
+    
+    # Reduce the data to its principal components before the dimensionality reduction
+    incremental = dimensionality == "IncrementalPCA"
+    if pca_components is not None:
+        print("Computing {} principal components...".format(pca_components))
+        norm_data = computePCA(norm_data, pca_components, incremental=incremental)
       
     print("Performing dimensionality reduction...") 
+    
+    if dimensionality not in ["RandomizedPCA", "IncrementalPCA"] and sp.issparse(norm_data):
+        # The rest of the dimensionality reduction methods need the dense data
+        norm_data = norm_data.toarray()
            
-    if "tSNE" in dimensionality:
-        # NOTE the Scipy tsne seems buggy so we use the R one instead
-        reduced_data = Rtsne(norm_counts, num_dimensions, theta=tsne_theta, perplexity=tsne_perplexity)
-    elif "PCA" in dimensionality:
+    if dimensionality in ["RandomizedPCA", "IncrementalPCA"]:
+        reduced_data = computePCA(norm_data, num_dimensions, incremental=incremental, whiten=True)
+    elif dimensionality == "tSNE":
+        reduced_data = tsne(norm_data, num_dimensions, theta=tsne_theta, perplexity=tsne_perplexity,
+                            early_exaggeration=tsne_exaggeration, num_threads=num_threads,
+                            n_iter_early=tsne_early_iter, learning_rate=tsne_learning_rate)
+    elif dimensionality == "Rtsne":
+        reduced_data = Rtsne(norm_data, num_dimensions, theta=tsne_theta, perplexity=tsne_perplexity)
+    elif dimensionality == "PCA":
         # n_components = None, number of mle to estimate optimal
         decomp_model = PCA(n_components=num_dimensions, whiten=True, copy=True)
-    elif "ICA" in dimensionality:
+    elif dimensionality == "ICA":
         decomp_model = FastICA(n_components=num_dimensions, 
                                algorithm='parallel', whiten=True,
                                fun='logcosh', w_init=None, random_state=None)
-    elif "SPCA" in dimensionality:
+    elif dimensionality == "SPCA":
         decomp_model = SparsePCA(n_components=num_dimensions, alpha=1)
     else:
         sys.stderr.write("Error, incorrect dimensionality reduction method\n")
         sys.exit(1)
      
-    if not "tSNE" in dimensionality:
+    if dimensionality in ["PCA", "ICA", "SPCA"]:
         # Perform dimensionality reduction, outputs a bunch of 2D/3D coordinates
-        reduced_data = decomp_model.fit_transform(norm_counts)
+        reduced_data = decomp_model.fit_transform(norm_data)
     
+    # Compute the expected number of clusters (not used by DBSCAN)
+    if num_clusters is None and clustering not in ["DBSCAN", "DBSCANTree"]:
+        num_clusters = computeNClusters(sparse_matrix(counts), use_cache=not no_cache)
+        print("Computation of number of clusters obtained {} clusters".format(num_clusters))
+
     print("Performing clustering...")
     # Do clustering of the dimensionality reduced coordinates
-    if "KMeans" in clustering:
+    if clustering == "KMeans":
         labels = KMeans(init='k-means++',
                         n_clusters=num_clusters,
                         n_init=10).fit_predict(reduced_data)
-    elif "Hierarchical" in clustering:
+    elif clustering == "MiniBatchKMeans":
+        labels = MiniBatchKMeans(init='k-means++',
+                                 n_clusters=num_clusters,
+                                 batch_size=max(1024, 10 * num_clusters),
+                                 n_init=3,
+                                 random_state=0).fit_predict(reduced_data)
+    elif clustering == "Hierarchical":
+        labels = AgglomerativeClustering(n_clusters=num_clusters,
+                                         linkage='ward').fit_predict(reduced_data)
+    elif clustering == "HierarchicalKNN":
+        # Only the neighbouring spots can be merged (sparse connectivity graph)
+        connectivity = kneighbors_graph(reduced_data, 
+                                        n_neighbors=min(10, len(reduced_data) - 1),
+                                        include_self=False, n_jobs=-1)
         labels = AgglomerativeClustering(n_clusters=num_clusters,
-                                         affinity='euclidean',
+                                         connectivity=connectivity,
                                          linkage='ward').fit_predict(reduced_data)
-    elif "DBSCAN" in clustering:
+    elif clustering == "HierarchicalBirch":
+        # The spots are summarized in sub-clusters (radius 2% of the extent)
+        # that are merged with Ward. Ward is quadratic in the number of
+        # sub-clusters so the radius is increased until there are at most 2000
+        max_subclusters = 2000
+        threshold = np.max(np.ptp(reduced_data, axis=0)) / 50.0
+        birch = Birch(threshold=threshold, n_clusters=None).fit(reduced_data)
+        while len(birch.subcluster_centers_) > max_subclusters:
+            # The number of sub-clusters decreases as the radius ^ dimensions
+            threshold *= max((len(birch.subcluster_centers_) / float(max_subclusters)) \
+                             ** (1.0 / reduced_data.shape[1]), 1.1)
+            birch = Birch(threshold=threshold, n_clusters=None).fit(reduced_data)
+        print("Merging {} BIRCH sub-clusters".format(len(birch.subcluster_centers_)))
+        labels = birch.labels_
+        if len(birch.subcluster_centers_) > num_clusters:
+            subcluster_labels = AgglomerativeClustering(n_clusters=num_clusters, 
+                                                        linkage='ward').fit_predict(
+                                                            birch.subcluster_centers_)
+            labels = subcluster_labels[labels]
+    elif clustering == "DBSCAN":
         labels = DBSCAN(eps=0.5, min_samples=5, 
                         metric='euclidean', n_jobs=-1).fit_predict(reduced_data)
-    elif "Gaussian" in clustering:
+    elif clustering == "DBSCANTree":
+        dbscan = DBSCAN(eps=0.5, min_samples=5, metric='euclidean', 
+                        algorithm='kd_tree', n_jobs=-1).fit(reduced_data)
+        labels = dbscan.labels_
+        # The noisy spots are assigned to the cluster of the closest core spot
+        noise = labels == -1
+        if np.any(noise) and len(dbscan.core_sample_indices_) > 0:
+            core_tree = KDTree(reduced_data[dbscan.core_sample_indices_])
+            closest = core_tree.query(reduced_data[noise], k=1, return_distance=False).ravel()
+            labels[noise] = labels[dbscan.core_sample_indices_][closest]
+    elif clustering == "Gaussian":
         gm = GaussianMixture(n_components=num_clusters,
                              covariance_type='full').fit(reduced_data)
         labels = gm.predict(reduced_data)
@@ -199,41 +287,27 @@ def main(counts_table_files,
         b = linear_conv(z, z_min, z_max, 0.0, 1.0) if num_dimensions == 3 else 1.0
         labels_colors.append((r,g,b))
 
-    # Write the spots and their classes to a file
-    file_writers = [open(os.path.join(outdir,
-                                      "{}_clusters.tsv".format(
-                                      os.path.splitext(os.path.basename(name))[0])),"w")
-                    for name in counts_table_files]
-    # Write the coordinates and the label/class that they belong to
-    spot_plot_data = defaultdict(lambda: [[],[],[],[]])
-    for i, spot in enumerate(norm_counts.index):
-        tokens = spot.split("x")
-        assert(len(tokens) == 2)
-        y = float(tokens[1])
-        tokens2 = tokens[0].split("_")
-        # This is to account for the cases where the spots already contain a tag (separated by "_")
-        if len(tokens2) == 3:
-            x = float(tokens2[2])
-        elif len(tokens2) == 2:
-            x = float(tokens2[1])
-        else:
-            sys.stderr.write("Error, the spots in the input data have "
-                             "the wrong format {}\n.".format(spot))
-            sys.exit(1)
-        index = int(tokens2[0])
-        spot_plot_data[index][0].append(x)
-        spot_plot_data[index][1].append(y)
-        spot_plot_data[index][2].append(labels[i])
-        spot_plot_data[index][3].append(labels_colors[i])
-        # This is to account for the cases where the spots already contain a tag (separated by "_")
-        if len(tokens2) == 3:
-            spot_str = "{}_{}x{}".format(tokens2[1],x,y)
-        else:
-            spot_str = "{}x{}".format(x,y)
-        file_writers[index].write("{0}\t{1}\n".format(spot_str, labels[i]))
-    # Close the files
-    for file_writer in file_writers:
-        file_writer.close()
+    # Write the spots and their classes to a file (one for each dataset)
+    # The coordinates and the label/class that they belong to are kept to plot them
+    spots = spots.loc[norm_counts.index]
+    # This is to account for the cases where the spots already contain a tag (separated by "_")
+    spot_names = spots["x"].astype(str) + "x" + spots["y"].astype(str)
+    has_tag = spots["tag"].notnull()
+    spot_names[has_tag] = spots["tag"][has_tag] + "_" + spot_names[has_tag]
+    labels_colors = np.asarray(labels_colors)
+    spot_plot_data = dict()
+    for i, name in enumerate(counts_table_files):
+        in_dataset = (spots["dataset"] == i).values
+        spot_plot_data[i] = [spots["x"].values[in_dataset].tolist(),
+                             spots["y"].values[in_dataset].tolist(),
+                             labels[in_dataset].tolist(),
+                             [tuple(color) for color in labels_colors[in_dataset]]]
+        pd.DataFrame({"spot" : spot_names.values[in_dataset], 
+                      "class" : labels[in_dataset]},
+                     columns=["spot", "class"]).to_csv(
+                         os.path.join(outdir, "{}_clusters.tsv".format(
+                         os.path.splitext(os.path.basename(name))[0])), 
+                         sep="\t", header=False, index=False)
         
     print("Generating plots...")
      
@@ -355,18 +429,32 @@ if __name__ == '__main__':
                         "(see --top-genes-criteria)\n " \
                         "Low variance or low expressed will be discarded (default: %(default)s)")
     parser.add_argument("--clustering", default="KMeans", metavar="[STR]", 
-                        type=str, choices=["Hierarchical", "KMeans", "DBSCAN", "Gaussian"],
+                        type=str, choices=["Hierarchical", "HierarchicalKNN", "HierarchicalBirch",
+                                           "KMeans", "MiniBatchKMeans", "DBSCAN", "DBSCANTree", 
+                                           "Gaussian"],
                         help="What clustering algorithm to use after the dimensionality reduction:\n" \
                         "Hierarchical = Hierarchical Clustering (Ward)\n" \
+                        "HierarchicalKNN = Ward restricted to a k-nearest neighbours graph\n" \
+                        "(memory linear in the number of spots)\n" \
+                        "HierarchicalBirch = BIRCH pre-clustering followed by Ward\n" \
+                        "(memory linear in the number of spots)\n" \
                         "KMeans = Suitable for small number of clusters\n" \
+                        "MiniBatchKMeans = K-means with mini-batches (suitable for many spots)\n" \
                         "DBSCAN = Number of clusters will be automatically inferred\n" \
+                        "DBSCANTree = DBSCAN with a KD-tree neighbours index where the noisy spots\n" \
+                        "are assigned to the closest cluster (suitable for many spots)\n" \
                         "Gaussian = Gaussian Mixtures Model\n" \
                         "(default: %(default)s)")
     parser.add_argument("--dimensionality", default="tSNE", metavar="[STR]", 
-                        type=str, choices=["tSNE", "PCA", "ICA", "SPCA"],
+                        type=str, choices=["tSNE", "Rtsne", "PCA", "RandomizedPCA", 
+                                           "IncrementalPCA", "ICA", "SPCA"],
                         help="What dimensionality reduction algorithm to use:\n" \
-                        "tSNE = t-distributed stochastic neighbor embedding\n" \
+                        "tSNE = t-distributed stochastic neighbor embedding (Barnes-Hut)\n" \
+                        "Rtsne = t-distributed stochastic neighbor embedding (R Rtsne)\n" \
                         "PCA = Principal Component Analysis\n" \
+                        "RandomizedPCA = Principal Component Analysis (randomized SVD, sparse data is kept sparse)\n" \
+                        "IncrementalPCA = Principal Component Analysis (fitted in blocks of spots\n" \
+                        "of the normalized data, which is kept in memory)\n" \
                         "ICA = Independent Component Analysis\n" \
                         "SPCA = Sparse Principal Component Analysis\n" \
                         "(default: %(default)s)")
@@ -398,10 +486,33 @@ if __name__ == '__main__':
                         help="The value of the perplexity for the t-sne method. (default: %(default)s)")
     parser.add_argument("--tsne-theta", default=0.5, metavar="[FLOAT]", type=float,
                         help="The value of theta for the t-sne method. (default: %(default)s)")
+    parser.add_argument("--tsne-exaggeration", default=12.0, metavar="[FLOAT]", type=float,
+                        help="The early exaggeration factor for the t-sne method. (default: %(default)s)")
+    parser.add_argument("--tsne-early-iter", default=250, metavar="[INT]", type=int, choices=range(0, 10000),
+                        help="The number of iterations with early exaggeration for the t-sne method.\n" \
+                        "(default: %(default)s)")
+    parser.add_argument("--tsne-learning-rate", default="200", metavar="[STR]", type=str,
+                        help="The learning rate for the t-sne method or auto to use the number of\n" \
+                        "spots / early exaggeration / 4 (recommended for many spots). (default: %(default)s)")
+    parser.add_argument("--num-threads", default=None, metavar="[INT]", type=int,
+                        help="The number of threads to use in the t-sne method (all the CPUs by default)")
+    parser.add_argument("--pca-components", default=None, metavar="[INT]", type=int,
+                        help="Reduce the data to this number of principal components (for example 50)\n" \
+                        "before the dimensionality reduction (recommended for many spots/genes).\n" \
+                        "The components are computed with a randomized PCA (incremental PCA\n" \
+                        "if --dimensionality is IncrementalPCA)")
     parser.add_argument("--outdir", default=None, help="Path to output dir")
     parser.add_argument("--color-space-plots", action="store_true", default=False,
                         help="Generate also plots using the representation in color space of the\n" \
                         "dimensionality reduced coordinates")   
+    parser.add_argument("--use-sparse", action="store_true", default=False,
+                        help="Keep the counts in a sparse representation during the aggregation,\n" \
+                        "filtering and normalization steps (recommended for many datasets)")
+    parser.add_argument("--no-cache", action="store_true", default=False,
+                        help="Do not use the on-disk cache of the size factors and normalized counts.\n" \
+                        "By default they are stored (keyed by the content of the filtered counts\n" \
+                        "and the normalization options) so the next runs on the same datasets\n" \
+                        "skip the normalization (see STANALYSIS_CACHE_DIR and STANALYSIS_CACHE_SIZE)")
     args = parser.parse_args()
     main(args.counts_table_files, 
          args.normalization, 
@@ -422,5 +533,12 @@ if __name__ == '__main__':
          args.use_adjusted_log,
          args.tsne_perplexity,
          args.tsne_theta,
-         args.color_space_plots)
+         args.color_space_plots,
+         args.use_sparse,
+         args.tsne_exaggeration,
+         args.num_threads,
+         args.pca_components,
+         args.no_cache,
+         args.tsne_early_iter,
+         args.tsne_learning_rate)
 
@@ -40,7 +40,7 @@ setup(
     'jinja2',
     'tzlocal'
   ],
-  #test_suite = 'tests',
+  test_suite = 'tests',
   scripts = glob.glob('scripts/*.py'),
   classifiers = [
     'Development Status :: 4 - Beta',
@@ -1,88 +1,490 @@
 """ Different functions for
 analysis of ST datasets
 """
-from stanalysis.normalization import RimportLibrary
+from stanalysis.rsession import RimportLibrary, r_call, r_call_async, r_converter, r_to_numpy, \
+     r_workers, r_serialize, r_unserialize, SharedMatrix
 from matplotlib.colors import LinearSegmentedColormap
 from matplotlib import colors as mpcolors
 from collections import Counter
+from stanalysis.cache import fingerprint, cache_get, cache_put
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import re
 import multiprocessing
-import rpy2.robjects.packages as rpackages
-import rpy2.robjects as robjects
-from rpy2.robjects import pandas2ri, r, numpy2ri, globalenv
-robjects.conversion.py2ri = numpy2ri
-base = rpackages.importr("base")
+from multiprocessing.pool import ThreadPool
 
-def computeNClusters(counts, min_size=20):
+def computeNClusters(counts, min_size=20, use_r=False, return_labels=False,
+                     use_cache=False):
     """Computes the number of clusters
-    from the data using Scran::quickCluster"""
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts.transpose())
+    from the data (Spots as rows) using quickClusters()
+    (Scran::quickCluster if use_r is True).
+    If return_labels is True the cluster labels of the spots
+    are also returned so they can be re-used.
+    If use_cache is True the labels are stored in the on-disk cache
+    (see stanalysis.cache) so they are not computed again for the same counts"""
+    if use_cache:
+        key = fingerprint("quick_clusters", counts, min_size, use_r)
+        labels = cache_get(key)
+        if labels is None:
+            labels = quickClusters(counts.transpose(), min_size, use_r=use_r)
+            cache_put(key, labels)
+    else:
+        labels = quickClusters(counts.transpose(), min_size, use_r=use_r)
+    num_clusters = len(set(labels))
+    return (num_clusters, labels) if return_labels else num_clusters
+
+def quickClusters(counts, min_size=20, use_r=False, num_neighbours=10, 
+                  num_components=50, min_mean=1.0, random_state=0):
+    """Computes clusters of spots (Genes as rows) similar to
+    Scran::quickCluster and returns the cluster label 
+    of each spot as a vector. The spots are represented by the
+    scaled ranks of their genes (Spearman correlation) reduced 
+    with PCA, a shared nearest neighbour graph is built from 
+    the (approximate for large datasets) nearest neighbours and
+    the clusters are the communities of the graph (Louvain). 
+    Clusters smaller than min_size are merged with the closest cluster.
+    :param counts: a matrix of counts (genes as rows) dense or sparse
+    :param min_size: the minimum size of the clusters
+    :param use_r: True to use Scran::quickCluster (R)
+    :param num_neighbours: the number of nearest neighbours of each spot
+    :param num_components: the number of principal components of the ranks
+    :param min_mean: the minimum average count of the genes to be used
+    :param random_state: the seed of the random number generator
+    :return: the cluster label (int) of each spot
+    """
+    if use_r:
+        with SharedMatrix(counts) as shared_counts:
+            return r_call(_quickClusters, shared_counts, min_size)
+    counts = sp.csc_matrix(counts, dtype=np.float64)
+    n_spots = counts.shape[1]
+    if n_spots <= min_size or n_spots < 3:
+        return np.ones(n_spots, dtype=int)
+    # Genes with low average counts (scaled by library size) are not used
+    lib_size = np.asarray(counts.sum(axis=0)).ravel()
+    with np.errstate(divide="ignore"):
+        inv_lib_size = np.where(lib_size > 0, 1.0 / lib_size, 0.0)
+    ave_counts = np.asarray(counts.dot(inv_lib_size)).ravel() * np.mean(lib_size) / n_spots
+    if np.count_nonzero(ave_counts >= min_mean) > 1:
+        counts = counts[ave_counts >= min_mean]
+    random = np.random.RandomState(random_state)
+    points = _rankComponents(counts, num_components, random)
+    neighbours = _nearestNeighbours(points, min(num_neighbours, n_spots - 1), random)
+    graph = _snnGraph(neighbours)
+    labels = _louvain(graph, random)
+    labels = _mergeSmallClusters(graph, labels, min_size)
+    return labels + 1
+
+def _quickClusters(counts, min_size):
+    """ Executed in the R session (see quickClusters()) """
     scran = RimportLibrary("scran")
-    multicore = RimportLibrary("BiocParallel")
-    multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))  
-    as_matrix = r["as.matrix"]
-    clusters = scran.quickCluster(as_matrix(r_counts), min_size)
-    n_clust = len(set(clusters))
-    pandas2ri.deactivate()
-    return n_clust
-
-def deaDESeq2(counts, conds, comparisons, alpha, size_factors=None):
+    with r_converter():
+        clusters = scran.quickCluster(counts.to_r(), min_size)
+        return np.asarray([str(cluster) for cluster in clusters])
+
+def _rankComponents(counts, num_components, random, num_iter=4):
+    """ Helper function that computes the principal components
+    of the scaled ranks of the genes in each spot (counts as a CSC matrix
+    with genes as rows). The ranks are never stored as a dense matrix, 
+    the zeroes share the same rank in each spot so the ranks are a sparse 
+    matrix plus a constant for each spot. The components are obtained
+    with a randomized SVD (matrix free).
+    """
+    n_genes, n_spots = counts.shape
+    counts = counts.tocsc()
+    counts.sort_indices()
+    nnz_spot = np.diff(counts.indptr)
+    spot_ids = np.repeat(np.arange(n_spots), nnz_spot)
+    # Average ranks (ties) of the non zero counts within each spot
+    order = np.lexsort((counts.data, spot_ids))
+    sorted_values = counts.data[order]
+    sorted_spots = spot_ids[order]
+    positions = np.arange(len(order))
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = (sorted_values[1:] != sorted_values[:-1]) | (sorted_spots[1:] != sorted_spots[:-1])
+    ends = np.ones(len(order), dtype=bool)
+    ends[:-1] = starts[1:]
+    first = np.maximum.accumulate(np.where(starts, positions, 0))
+    last = np.minimum.accumulate(np.where(ends, positions, len(order))[::-1])[::-1]
+    spot_start = counts.indptr[:-1][sorted_spots]
+    ranks = np.empty(len(order))
+    ranks[order] = (first + last) / 2.0 - spot_start + 1
+    # The zeroes have the average of the lowest ranks
+    num_zeroes = n_genes - nnz_spot
+    zero_rank = (num_zeroes + 1) / 2.0
+    mean_rank = (n_genes + 1) / 2.0
+    # Scaled ranks = (sparse + constant) / norm (so the dot product is the correlation)
+    sparse_ranks = sp.csr_matrix((ranks + num_zeroes[spot_ids] - zero_rank[spot_ids], 
+                                  counts.indices, counts.indptr), 
+                                 shape=(n_spots, n_genes))
+    constant = zero_rank - mean_rank
+    norm = np.sqrt(num_zeroes * constant ** 2 + 
+                   np.bincount(spot_ids, (ranks + num_zeroes[spot_ids] - mean_rank) ** 2, 
+                               minlength=n_spots))
+    norm[norm == 0] = 1.0
+    scale = 1.0 / norm
+    gene_means = (np.asarray(sparse_ranks.T.dot(scale)).ravel() + np.sum(constant * scale)) / n_spots
+    def dot(values):
+        # Centered scaled ranks (spots as rows) times a matrix
+        product = sparse_ranks.dot(values) + np.outer(constant, values.sum(axis=0))
+        return product * scale[:,np.newaxis] - gene_means.dot(values)[np.newaxis,:]
+    def dot_t(values):
+        values = values * scale[:,np.newaxis]
+        product = sparse_ranks.T.dot(values) + np.outer(np.ones(n_genes), constant.dot(values))
+        return product - np.outer(gene_means, (values / scale[:,np.newaxis]).sum(axis=0))
+    num_components = max(min(num_components, n_spots - 1, n_genes - 1), 1)
+    u, s = _randomizedSVD(dot, dot_t, n_genes, num_components, random, num_iter)
+    return u * s
+
+def _randomizedSVD(dot, dot_t, n_columns, num_components, random, num_iter=4):
+    """ Helper function that computes the left singular vectors and the
+    singular values of a matrix given only its products with a dense matrix 
+    (dot) and the products of its transpose (dot_t) with a randomized SVD 
+    (power iterations) so the matrix is never built.
+    """
+    basis, _ = np.linalg.qr(dot(random.normal(size=(n_columns, num_components + 10))))
+    for _ in range(num_iter):
+        basis, _ = np.linalg.qr(dot(dot_t(basis)))
+    u, s, _ = np.linalg.svd(dot_t(basis).T, full_matrices=False)
+    return basis.dot(u[:,:num_components]), s[:num_components]
+
+def _nearestNeighbours(points, num_neighbours, random, max_exact=10000):
+    """ Helper function that returns the nearest neighbours of each point
+    (the point itself excluded). The search is exact for small datasets 
+    and approximate (inverted lists of k-means clusters) for large datasets.
+    """
+    from sklearn.neighbors import NearestNeighbors
+    n_points = points.shape[0]
+    if n_points <= max_exact:
+        model = NearestNeighbors(n_neighbors=num_neighbours + 1).fit(points)
+        return model.kneighbors(points, return_distance=False)[:,1:]
+    from sklearn.cluster import MiniBatchKMeans
+    num_lists = int(np.sqrt(n_points))
+    num_probes = min(8, num_lists)
+    kmeans = MiniBatchKMeans(n_clusters=num_lists, random_state=random.randint(2**31 - 1),
+                             n_init=3).fit(points)
+    lists = kmeans.labels_
+    centers = kmeans.cluster_centers_
+    probes = NearestNeighbors(n_neighbors=num_probes).fit(centers).kneighbors(
+        centers, return_distance=False)
+    neighbours = np.empty((n_points, num_neighbours), dtype=int)
+    for list_id in range(num_lists):
+        queries = np.flatnonzero(lists == list_id)
+        if len(queries) == 0:
+            continue
+        candidates = np.flatnonzero(np.isin(lists, probes[list_id]))
+        k = min(num_neighbours + 1, len(candidates))
+        model = NearestNeighbors(n_neighbors=k).fit(points[candidates])
+        found = candidates[model.kneighbors(points[queries], return_distance=False)]
+        # Remove the point itself
+        not_self = found != queries[:,np.newaxis]
+        for row, query in enumerate(queries):
+            selected = found[row][not_self[row]][:num_neighbours]
+            neighbours[query,:len(selected)] = selected
+            neighbours[query,len(selected):] = query
+    return neighbours
+
+def _snnGraph(neighbours):
+    """ Helper function that builds a shared nearest neighbour graph
+    (sparse and symmetric). Two spots are connected if they share 
+    neighbours and the weight is the number of shared neighbours
+    (each spot is a neighbour of itself).
+    """
+    n_points, num_neighbours = neighbours.shape
+    rows = np.repeat(np.arange(n_points), num_neighbours + 1)
+    cols = np.column_stack([np.arange(n_points), neighbours]).ravel()
+    knn = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_points, n_points))
+    knn.data[:] = 1.0
+    graph = sp.csr_matrix(knn.dot(knn.T))
+    graph.setdiag(0)
+    graph.eliminate_zeros()
+    return graph
+
+def _louvain(graph, random, resolution=1.0, max_levels=20, max_sweeps=20):
+    """ Helper function that finds the communities of a weighted graph
+    (sparse and symmetric) maximizing the modularity with the Louvain method.
+    Returns the community (0..N-1) of each node.
+    """
+    membership = np.arange(graph.shape[0])
+    for _ in range(max_levels):
+        communities = _louvainMoveNodes(graph, random, resolution, max_sweeps)
+        num_communities = communities.max() + 1
+        if num_communities == graph.shape[0]:
+            break
+        membership = communities[membership]
+        # Aggregate the communities into nodes
+        indicator = sp.csr_matrix((np.ones(len(communities)), 
+                                   (np.arange(len(communities)), communities)))
+        graph = sp.csr_matrix(indicator.T.dot(graph).dot(indicator))
+    return membership
+
+def _louvainMoveNodes(graph, random, resolution, max_sweeps, num_batches=128):
+    """ Helper function that moves each node to the community of its 
+    neighbours that gives the largest gain in modularity until no node 
+    moves (first phase of the Louvain method). The nodes are visited in
+    num_batches random batches (one node at a time for small graphs) and 
+    the best community of all the nodes of a batch is computed at once 
+    (sparse matrix of links between the nodes and the communities). 
+    A single node only moves to another single node community with a 
+    smaller label so two nodes do not swap communities in the same batch.
+    Returns the communities numbered consecutively.
+    """
+    n_nodes = graph.shape[0]
+    degrees = np.asarray(graph.sum(axis=1)).ravel()
+    total_weight = degrees.sum()
+    if total_weight == 0:
+        return np.arange(n_nodes)
+    communities = np.arange(n_nodes)
+    community_degrees = degrees.copy()
+    community_sizes = np.ones(n_nodes, dtype=int)
+    batch_size = max(n_nodes // num_batches, 1)
+    for _ in range(max_sweeps):
+        moved = False
+        order = random.permutation(n_nodes)
+        for start in range(0, n_nodes, batch_size):
+            nodes = order[start:start + batch_size]
+            node_degrees = degrees[nodes]
+            current = communities[nodes]
+            # Links of each node (rows) to each community (columns) without self loops
+            block = graph[nodes].tocoo()
+            not_self = block.col != nodes[block.row]
+            links = sp.csr_matrix((block.data[not_self], 
+                                   (block.row[not_self], communities[block.col[not_self]])), 
+                                  shape=(len(nodes), n_nodes))
+            links.sum_duplicates()
+            rows = np.repeat(np.arange(len(nodes)), np.diff(links.indptr))
+            candidates = links.indices
+            # The node is removed from its community before the gains are computed
+            is_current = candidates == current[rows]
+            removed = np.where(is_current, node_degrees[rows], 0.0)
+            gains = links.data - resolution * (community_degrees[candidates] - removed) \
+            * node_degrees[rows] / total_weight
+            current_gains = -resolution * (community_degrees[current] - node_degrees) \
+            * node_degrees / total_weight
+            current_gains[rows[is_current]] = gains[is_current]
+            # The best community of each node (the smallest label in ties)
+            best_order = np.lexsort((candidates, -gains, rows))
+            first = np.ones(len(best_order), dtype=bool)
+            first[1:] = rows[best_order][1:] != rows[best_order][:-1]
+            best_rows = rows[best_order[first]]
+            best = current.copy()
+            best_gains = current_gains.copy()
+            best[best_rows] = candidates[best_order[first]]
+            best_gains[best_rows] = gains[best_order[first]]
+            move = (best != current) & (best_gains > current_gains)
+            # Single nodes do not swap communities
+            move &= ~((community_sizes[current] == 1) & (community_sizes[best] == 1) 
+                      & (best > current))
+            if not np.any(move):
+                continue
+            moved = True
+            nodes, current, best = nodes[move], current[move], best[move]
+            communities[nodes] = best
+            np.subtract.at(community_degrees, current, degrees[nodes])
+            np.add.at(community_degrees, best, degrees[nodes])
+            np.subtract.at(community_sizes, current, 1)
+            np.add.at(community_sizes, best, 1)
+        if not moved:
+            break
+    return np.unique(communities, return_inverse=True)[1]
+
+def _mergeSmallClusters(graph, labels, min_size):
+    """ Helper function that merges the clusters smaller than min_size 
+    with the cluster they are most connected to (relative to its size) 
+    until all the clusters have at least min_size spots.
+    """
+    labels = np.unique(labels, return_inverse=True)[1]
+    while True:
+        sizes = np.bincount(labels)
+        if len(sizes) < 2 or sizes.min() >= min_size:
+            return labels
+        smallest = np.argmin(sizes)
+        indicator = sp.csr_matrix((np.ones(len(labels)), (np.arange(len(labels)), labels)))
+        links = np.asarray(indicator.T.dot(graph.dot(indicator[:,smallest].toarray()))).ravel()
+        links = links / sizes
+        links[smallest] = -1
+        # Clusters not connected are merged with the largest cluster
+        target = np.argmax(links) if links.max() > 0 else np.argmax(np.where(
+            np.arange(len(sizes)) == smallest, -1, sizes))
+        labels[labels == smallest] = target
+        labels = np.unique(labels, return_inverse=True)[1]
+
+def deaDESeq2(counts, conds, comparisons, alpha, size_factors=None, num_chunks=None):
     """Makes a call to DESeq2 to
     perform D.E.A. in the given
     counts matrix with the given conditions and comparisons.
     Can be given size factors. 
+    When there are several R workers (see set_r_workers()) the genes
+    are split in chunks and the dispersions and Wald tests are fitted in 
+    parallel sharing the size factors, the design and the dispersion trend.
+    :param num_chunks: the number of chunks of genes (the number of R workers by default)
     Returns a list of DESeq2 results for each comparison
     """
+    if num_chunks is None:
+        num_chunks = r_workers()
+    num_chunks = min(num_chunks, counts.shape[0])
+    with SharedMatrix(counts) as shared_counts:
+        if num_chunks <= 1:
+            return r_call(_deaDESeq2, shared_counts, conds, comparisons, alpha, size_factors)
+        if size_factors is None:
+            from stanalysis.normalization import computeSizeFactors
+            size_factors = computeSizeFactors(counts)
+        size_factors = np.asarray(size_factors, dtype=np.float64)
+        if not np.all(np.isfinite(size_factors)):
+            raise RuntimeError("Error, every gene contains at least one zero, "
+                               "the size factors cannot be computed\n")
+        bounds = np.linspace(0, counts.shape[0], num_chunks + 1).astype(int)
+        chunks = [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])]
+        # Gene-wise dispersions in parallel
+        gene_est = [r_call_async(_deseq2GeneEst, shared_counts, conds, size_factors, chunk)
+                    for chunk in chunks]
+        gene_est = [result.get() for result in gene_est]
+        # Dispersion trend and prior with all the genes
+        disp_function, prior_var = r_call(_deseq2DispersionFit, shared_counts, 
+                                          conds, size_factors, gene_est)
+        # Final dispersions and Wald tests in parallel
+        wald = [r_call_async(_deseq2WaldTest, shared_counts, conds, size_factors, 
+                             chunk, est, disp_function, prior_var)
+                for chunk, est in zip(chunks, gene_est)]
+        wald = [result.get() for result in wald]
+        # The results are computed with all the genes (p-values adjustment)
+        return r_call(_deseq2MergedResults, shared_counts, conds, size_factors,
+                      wald, comparisons, alpha)
+
+def _deaDESeq2(counts, conds, comparisons, alpha, size_factors):
+    """ Executed in the R session (see deaDESeq2()) """
+    from rpy2.robjects import r
     results = list()
-    try:
-        pandas2ri.activate()
-        deseq2 = RimportLibrary("DESeq2")
-        multicore = RimportLibrary("BiocParallel")
-        multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-        # Create the R conditions and counts data
-        r_counts = pandas2ri.py2ri(counts)
-        cond = robjects.DataFrame({"conditions": robjects.StrVector(conds)})
-        design = r('formula(~ conditions)')
-        dds = r.DESeqDataSetFromMatrix(countData=r_counts, colData=cond, design=design)
+    deseq2 = RimportLibrary("DESeq2")
+    with r_converter():
+        dds = _deseq2Dataset(counts, conds, size_factors)
         if size_factors is None:
             dds = r.DESeq(dds, parallel=True)
         else:
-            assign_sf = r["sizeFactors<-"]
-            dds = assign_sf(object=dds, value=robjects.FloatVector(size_factors))
             dds = r.estimateDispersions(dds)
             dds = r.nbinomWaldTest(dds)
         # Perform the comparisons and store results in list
         for A,B in comparisons:
-            result = r.results(dds, contrast=r.c("conditions", A, B), alpha=alpha)
-            result = r['as.data.frame'](result)
-            genes = r['rownames'](result)
-            result = pandas2ri.ri2py_dataframe(result)
-            # There seems to be a problem parsing the rownames from R to pandas
-            # so we do it manually
-            result.index = genes
-            results.append(result)
-        pandas2ri.deactivate()
-    except Exception as e:
-        raise e
+            results.append(_deseq2Results(dds, A, B, alpha))
     return results
 
-def deaScranDESeq2(counts, conds, comparisons, alpha, scran_clusters=False):
+def _deseq2Dataset(counts, conds, size_factors, rows=None):
+    """ Helper function (executed in the R session) that creates
+    the DESeq2 data set of the counts (or the given rows of the counts)
+    with the conditions as design and the size factors (if given)
+    """
+    import rpy2.robjects as robjects
+    from rpy2.robjects import r
+    # Create the R conditions and counts data
+    r_counts = counts.to_r(rows)
+    cond = robjects.DataFrame({"conditions": robjects.StrVector(conds)})
+    design = r('formula(~ conditions)')
+    dds = r.DESeqDataSetFromMatrix(countData=r_counts, colData=cond, design=design)
+    if size_factors is not None:
+        assign_sf = r["sizeFactors<-"]
+        dds = assign_sf(object=dds, value=robjects.FloatVector(size_factors))
+    return dds
+
+def _deseq2GeneEst(counts, conds, size_factors, rows):
+    """ Executed in the R session (see deaDESeq2()).
+    Returns the gene-wise dispersions of a chunk of genes (serialized) """
+    from rpy2.robjects import r
+    deseq2 = RimportLibrary("DESeq2")
+    with r_converter():
+        dds = _deseq2Dataset(counts, conds, size_factors, rows)
+        dds = r.estimateDispersionsGeneEst(dds)
+        return r_serialize(r.mcols(dds))
+
+def _deseq2DispersionFit(counts, conds, size_factors, gene_est):
+    """ Executed in the R session (see deaDESeq2()).
+    Returns the dispersion trend (serialized) and the
+    dispersion prior variance fitted with all the genes """
+    from rpy2.robjects import r
+    deseq2 = RimportLibrary("DESeq2")
+    with r_converter():
+        dds = _deseq2Dataset(counts, conds, size_factors)
+        dds = r["mcols<-"](dds, value=r.rbind(*[r_unserialize(est) for est in gene_est]))
+        dds = r.estimateDispersionsFit(dds)
+        prior_var = r.estimateDispersionsPriorVar(dds)
+        return r_serialize(r.dispersionFunction(dds)), float(prior_var[0])
+
+def _deseq2WaldTest(counts, conds, size_factors, rows, gene_est, disp_function, prior_var):
+    """ Executed in the R session (see deaDESeq2()).
+    Returns the final dispersions and Wald tests of a chunk of genes
+    and the attributes of the fitted model (serialized) """
+    from rpy2.robjects import r
+    deseq2 = RimportLibrary("DESeq2")
+    with r_converter():
+        dds = _deseq2Dataset(counts, conds, size_factors, rows)
+        dds = r["mcols<-"](dds, value=r_unserialize(gene_est))
+        dds = r["dispersionFunction<-"](dds, value=r_unserialize(disp_function))
+        dds = r.estimateDispersionsMAP(dds, dispPriorVar=prior_var)
+        dds = r.nbinomWaldTest(dds)
+        model_attributes = r("""
+            function(dds) {
+                attrs <- attributes(dds)
+                attrs[setdiff(names(attrs), c(slotNames(dds), "class"))]
+            }
+        """)
+        return r_serialize(r.mcols(dds)), r_serialize(model_attributes(dds))
+
+def _deseq2MergedResults(counts, conds, size_factors, wald, comparisons, alpha):
+    """ Executed in the R session (see deaDESeq2()).
+    Merges the Wald tests of the chunks of genes and returns
+    the DESeq2 results for each comparison """
+    from rpy2.robjects import r
+    deseq2 = RimportLibrary("DESeq2")
+    with r_converter():
+        dds = _deseq2Dataset(counts, conds, size_factors)
+        dds = r["mcols<-"](dds, value=r.rbind(*[r_unserialize(mcols) for mcols, _ in wald]))
+        assign_attributes = r("""
+            function(dds, attrs) {
+                for (name in names(attrs)) attr(dds, name) <- attrs[[name]]
+                dds
+            }
+        """)
+        dds = assign_attributes(dds, r_unserialize(wald[0][1]))
+        return [_deseq2Results(dds, A, B, alpha) for A,B in comparisons]
+
+def _deseq2Results(dds, A, B, alpha):
+    """ Helper function (executed in the R session) that returns 
+    the DESeq2 results of a comparison as a Pandas data frame
+    """
+    from rpy2.robjects import pandas2ri, r
+    result = r.results(dds, contrast=r.c("conditions", A, B), alpha=alpha)
+    result = r['as.data.frame'](result)
+    genes = r['rownames'](result)
+    result = pandas2ri.ri2py_dataframe(result)
+    # There seems to be a problem parsing the rownames from R to pandas
+    # so we do it manually
+    result.index = genes
+    return result
+
+def deaScranDESeq2(counts, conds, comparisons, alpha, scran_clusters=False, use_r=False):
     """Makes a call to DESeq2 with SCRAN to
     perform D.E.A. in the given
     counts matrix with the given conditions and comparisons.
+    The SCRAN size factors are computed natively unless use_r is True.
     Returns a list of DESeq2 results for each comparison
     """
+    if not use_r:
+        from stanalysis.normalization import computeSumFactors
+        size_factors = computeSumFactors(counts, scran_clusters)
+        return deaDESeq2(counts, conds, comparisons, alpha, size_factors=size_factors)
+    with SharedMatrix(counts) as shared_counts:
+        return r_call(_deaScranDESeq2, shared_counts, conds, comparisons, alpha, scran_clusters)
+
+def _deaScranDESeq2(counts, conds, comparisons, alpha, scran_clusters):
+    """ Executed in the R session (see deaScranDESeq2()) """
+    import rpy2.robjects as robjects
+    from rpy2.robjects import r
     results = list()
-    n_cells = len(counts.columns)
-    try:
-        pandas2ri.activate()
-        deseq2 = RimportLibrary("DESeq2")
-        scran = RimportLibrary("scran")
-        multicore = RimportLibrary("BiocParallel")
-        multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-        as_matrix = r["as.matrix"]
+    n_cells = counts.shape[1]
+    deseq2 = RimportLibrary("DESeq2")
+    scran = RimportLibrary("scran")
+    with r_converter():
         # Create the R conditions and counts data
-        r_counts = pandas2ri.py2ri(counts)
+        r_counts = counts.to_r()
         cond = robjects.StrVector(conds)
         r_call = """
             function(r_counts) {
@@ -91,9 +493,9 @@ def deaScranDESeq2(counts, conds, comparisons, alpha, scran_clusters=False):
             }
         """
         r_func = r(r_call)
-        sce = r_func(as_matrix(r_counts))
+        sce = r_func(r_counts)
         if scran_clusters:
-            r_clusters = scran.quickCluster(as_matrix(r_counts), max(n_cells/10, 10))
+            r_clusters = scran.quickCluster(r_counts, max(n_cells/10, 10))
             min_cluster_size = min(Counter(r_clusters).values())
             sizes = list(set([round((min_cluster_size/2) / i) for i in [5,4,3,2,1]]))
             sce = scran.computeSumFactors(sce, clusters=r_clusters, sizes=sizes, positive=True)
@@ -114,19 +516,465 @@ def deaScranDESeq2(counts, conds, comparisons, alpha, scran_clusters=False):
         dds = r.DESeq(dds)
         # Perform the comparisons and store results in list
         for A,B in comparisons:
-            result = r.results(dds, contrast=r.c("conditions", A, B), alpha=alpha)
-            result = r['as.data.frame'](result)
-            genes = r['rownames'](result)
-            result = pandas2ri.ri2py_dataframe(result)
-            # There seems to be a problem parsing the rownames from R to pandas
-            # so we do it manually
-            result.index = genes
-            results.append(result)
-        pandas2ri.deactivate()
-    except Exception as e:
-        raise e
+            results.append(_deseq2Results(dds, A, B, alpha))
     return results
 
+def deaNegativeBinomial(counts, conds, comparisons, alpha, size_factors=None,
+                        min_disp=1e-8, block_size=None, num_workers=None):
+    """Performs D.E.A. natively (without R) in the given counts matrix
+    with the given conditions and comparisons. A negative binomial GLM 
+    (design ~ conditions) is fitted to each gene as in DESeq2. The GLMs are
+    fitted with IRLS for blocks of genes at once, the gene-wise dispersions
+    (Cox-Reid adjusted) are shrunk towards a trend of the mean and the 
+    comparisons are tested with Wald tests (adjusted with Benjamini-Hochberg).
+    :param counts: a matrix of counts (genes as rows) Pandas, NumPy or scipy.sparse
+    :param conds: the condition of each spot
+    :param comparisons: a list of tuples of conditions (A, B) to compare
+    :param alpha: the FDR threshold (kept for compatibility with deaDESeq2())
+    :param size_factors: the size factors of the spots (DESeq2 median of ratios if None)
+    :param min_disp: the minimum dispersion
+    :param block_size: the number of genes fitted at once (computed if None)
+    :param num_workers: the number of blocks fitted in parallel (the number of CPUs if None)
+    Returns a list of results (genes as rows) for each comparison with the columns
+    baseMean, log2FoldChange, lfcSE, stat, pvalue and padj
+    """
+    from scipy.special import polygamma
+    from scipy.stats import norm
+    counts, genes = _geneRows(counts)
+    n_genes, n_spots = counts.shape
+    levels, design = _conditionsDesign(conds, comparisons, n_spots)
+    if n_spots <= len(levels):
+        raise RuntimeError("Error, the conditions have no replicates\n")
+    size_factors = _deaSizeFactors(counts, size_factors)
+    if block_size is None:
+        block_size = max(2**20 // n_spots, 1)
+    blocks = [(start, min(start + block_size, n_genes)) 
+              for start in range(0, n_genes, block_size)]
+    bounds = (np.log(min_disp), np.log(max(10.0, n_spots)))
+    # Gene-wise dispersions
+    results = _mapBlocks(_nbGeneWiseBlock, [(counts, start, end, size_factors, design, bounds) 
+                                            for start, end in blocks], num_workers)
+    base_mean = np.concatenate([result[0] for result in results])
+    disp_gene = np.concatenate([result[1] for result in results])
+    # Dispersion trend (disp = a0 + a1 / mean) and prior of the log dispersions
+    use = np.isfinite(disp_gene) & (disp_gene >= 100 * min_disp)
+    if not np.any(use):
+        raise RuntimeError("Error, all the gene-wise dispersions are close to zero\n")
+    coefs = _nbDispersionTrend(base_mean[use], disp_gene[use])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if coefs is None:
+            disp_trend = np.full(n_genes, np.mean(disp_gene[use]))
+        else:
+            disp_trend = coefs[0] + coefs[1] / base_mean
+    log_residuals = np.log(disp_gene[use]) - np.log(disp_trend[use])
+    var_log_disp = (1.4826 * np.median(np.abs(log_residuals - np.median(log_residuals))))**2
+    prior_var = max(var_log_disp - polygamma(1, (n_spots - len(levels)) / 2.0), 0.25)
+    # Shrunken dispersions, GLM fit and Wald tests
+    results = _mapBlocks(_nbWaldBlock, [(counts, start, end, size_factors, design, bounds,
+                                         disp_gene[start:end], disp_trend[start:end], 
+                                         prior_var, var_log_disp) 
+                                        for start, end in blocks], num_workers)
+    beta = np.vstack([result[0] for result in results])
+    info = np.vstack([result[1] for result in results])
+    dea_results = list()
+    for A,B in comparisons:
+        a, b = levels.index(A), levels.index(B)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lfc = (beta[:,a] - beta[:,b]) / np.log(2)
+            lfc_se = np.sqrt(1.0 / info[:,a] + 1.0 / info[:,b]) / np.log(2)
+            stat = lfc / lfc_se
+        pvalue = 2.0 * norm.sf(np.abs(stat))
+        dea_results.append(_deaFrame(genes, base_mean, lfc, lfc_se, stat, pvalue))
+    return dea_results
+
+def deaWilcoxon(counts, conds, comparisons, alpha, size_factors=None,
+                block_size=None, num_workers=None):
+    """Performs D.E.A. with two-sample Wilcoxon rank-sum tests (normal
+    approximation with tie and continuity corrections) in the given counts matrix
+    with the given conditions and comparisons. The counts of each gene are sorted
+    only once and the ranks are re-used in all the comparisons.
+    The log fold changes are the differences of the means of the 
+    log2 normalized counts (log2(counts / size factors + 1)).
+    :param counts: a matrix of counts (genes as rows) Pandas, NumPy or scipy.sparse
+    :param conds: the condition of each spot
+    :param comparisons: a list of tuples of conditions (A, B) to compare
+    :param alpha: the FDR threshold (kept for compatibility with deaDESeq2())
+    :param size_factors: the size factors of the spots (DESeq2 median of ratios if None)
+    :param block_size: the number of genes ranked at once (computed if None)
+    :param num_workers: the number of blocks ranked in parallel (the number of CPUs if None)
+    Returns a list of results (genes as rows) for each comparison with the columns
+    baseMean, log2FoldChange, lfcSE, stat, pvalue and padj
+    """
+    from scipy.stats import norm
+    counts, genes = _geneRows(counts)
+    n_genes, n_spots = counts.shape
+    levels, design = _conditionsDesign(conds, comparisons, n_spots)
+    size_factors = _deaSizeFactors(counts, size_factors)
+    log_counts = _logNormalized(counts, size_factors)
+    pairs = [(levels.index(A), levels.index(B)) for A,B in comparisons]
+    groups = np.argmax(design, axis=1)
+    if block_size is None:
+        block_size = max(2**20 // (n_spots * (len(levels) + 2)), 1)
+    blocks = [(start, min(start + block_size, n_genes)) 
+              for start in range(0, n_genes, block_size)]
+    results = _mapBlocks(_wilcoxonBlock, [(log_counts, start, end, groups, len(levels), pairs) 
+                                          for start, end in blocks], num_workers)
+    rank_sums = np.vstack([result[0] for result in results])
+    ties = np.vstack([result[1] for result in results])
+    base_mean, means, _ = _groupMoments(counts, log_counts, size_factors, design)
+    n_group = design.sum(axis=0)
+    dea_results = list()
+    for k, (a, b) in enumerate(pairs):
+        n_a, n_b = n_group[a], n_group[b]
+        n = n_a + n_b
+        mean_u = n_a * n_b / 2.0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sigma = np.sqrt(n_a * n_b / 12.0 * ((n + 1) - ties[:,k] / (n * (n - 1))))
+            stat = (rank_sums[:,k] - mean_u) / sigma
+            pvalue = np.minimum(2.0 * norm.sf((np.abs(rank_sums[:,k] - mean_u) - 0.5) / sigma), 1.0)
+        # All the values are tied (not tested)
+        pvalue[~(sigma > 0)] = np.nan
+        dea_results.append(_deaFrame(genes, base_mean, means[:,a] - means[:,b], 
+                                     np.full(n_genes, np.nan), stat, pvalue))
+    return dea_results
+
+def _wilcoxonBlock(args):
+    """ Helper function that sorts the values of a block of genes once and
+    returns the Mann-Whitney U statistics of the comparisons (pairs of groups)
+    and their ties (sum of t^3 - t of the tied values of both groups).
+    """
+    values, start, end, groups, n_groups, pairs = args
+    values = np.asarray(_denseRows(values, start, end), dtype=np.float64)
+    n_genes, n_spots = values.shape
+    order = np.argsort(values, axis=1, kind="mergesort")
+    sorted_values = np.take_along_axis(values, order, axis=1)
+    sorted_groups = groups[order]
+    # First and last position of the tied values of each position
+    positions = np.arange(n_spots)
+    first = np.ones((n_genes, n_spots), dtype=bool)
+    first[:,1:] = sorted_values[:,1:] != sorted_values[:,:-1]
+    last = np.ones((n_genes, n_spots), dtype=bool)
+    last[:,:-1] = first[:,1:]
+    tie_start = np.maximum.accumulate(np.where(first, positions, 0), axis=1)
+    tie_end = np.minimum.accumulate(np.where(last, positions, n_spots - 1)[:,::-1], axis=1)[:,::-1]
+    # Number of values of each group below (half of the ties) each position
+    # and number of tied values of each group
+    below, tied = list(), list()
+    for group in range(n_groups):
+        cumulative = np.zeros((n_genes, n_spots + 1))
+        cumulative[:,1:] = np.cumsum(sorted_groups == group, axis=1)
+        before = np.take_along_axis(cumulative, tie_start, axis=1)
+        until = np.take_along_axis(cumulative, tie_end + 1, axis=1)
+        below.append((before + until) / 2.0)
+        tied.append(np.where(last, until - before, 0.0))
+    rank_sums = np.empty((n_genes, len(pairs)))
+    ties = np.empty((n_genes, len(pairs)))
+    for k, (a, b) in enumerate(pairs):
+        rank_sums[:,k] = np.sum(np.where(sorted_groups == a, below[b], 0.0), axis=1)
+        ties[:,k] = np.sum((tied[a] + tied[b])**3 - (tied[a] + tied[b]), axis=1)
+    return rank_sums, ties
+
+def deaTTest(counts, conds, comparisons, alpha, size_factors=None):
+    """Performs D.E.A. with Welch t-tests of the log2 normalized counts
+    (log2(counts / size factors + 1)) in the given counts matrix with the given
+    conditions and comparisons. The means and variances of the conditions are
+    computed only once (without densifying sparse matrices).
+    :param counts: a matrix of counts (genes as rows) Pandas, NumPy or scipy.sparse
+    :param conds: the condition of each spot
+    :param comparisons: a list of tuples of conditions (A, B) to compare
+    :param alpha: the FDR threshold (kept for compatibility with deaDESeq2())
+    :param size_factors: the size factors of the spots (DESeq2 median of ratios if None)
+    Returns a list of results (genes as rows) for each comparison with the columns
+    baseMean, log2FoldChange, lfcSE, stat, pvalue and padj
+    """
+    from scipy.stats import t as student
+    counts, genes = _geneRows(counts)
+    levels, design = _conditionsDesign(conds, comparisons, counts.shape[1])
+    size_factors = _deaSizeFactors(counts, size_factors)
+    log_counts = _logNormalized(counts, size_factors)
+    base_mean, means, variances = _groupMoments(counts, log_counts, size_factors, design)
+    n_group = design.sum(axis=0)
+    dea_results = list()
+    for A,B in comparisons:
+        a, b = levels.index(A), levels.index(B)
+        var_a, var_b = variances[:,a] / n_group[a], variances[:,b] / n_group[b]
+        lfc = means[:,a] - means[:,b]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lfc_se = np.sqrt(var_a + var_b)
+            stat = lfc / lfc_se
+            df = (var_a + var_b)**2 / (var_a**2 / (n_group[a] - 1) + var_b**2 / (n_group[b] - 1))
+        pvalue = 2.0 * student.sf(np.abs(stat), df)
+        dea_results.append(_deaFrame(genes, base_mean, lfc, lfc_se, stat, pvalue))
+    return dea_results
+
+def _groupMoments(counts, log_counts, size_factors, design):
+    """ Helper function that returns the mean of the normalized counts of each gene
+    and the means and variances of the log normalized counts of each condition.
+    """
+    n_group = design.sum(axis=0)
+    base_mean = np.asarray(counts.dot(1.0 / size_factors)).ravel() / counts.shape[1]
+    squares = log_counts.multiply(log_counts) if sp.issparse(log_counts) else log_counts**2
+    means = np.asarray(log_counts.dot(design)) / n_group
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variances = (np.asarray(squares.dot(design)) - n_group * means**2) / (n_group - 1)
+    return base_mean, means, np.maximum(variances, 0.0)
+
+def _logNormalized(counts, size_factors):
+    """ Helper function that returns the log2 normalized counts (genes as rows)
+    log2(counts / size factors + 1) keeping the sparse matrices sparse.
+    """
+    if sp.issparse(counts):
+        # Same operations as the dense counts so the ties are the same
+        log_counts = sp.csr_matrix(counts, dtype=np.float64, copy=True)
+        log_counts.data = np.log2(log_counts.data / size_factors[log_counts.indices] + 1.0)
+        return log_counts
+    return np.log2(counts / size_factors + 1.0)
+
+def _conditionsDesign(conds, comparisons, n_spots):
+    """ Helper function that checks the conditions and the comparisons and
+    returns the conditions (sorted) and the design matrix (spots as rows and
+    an indicator column for each condition).
+    """
+    levels, groups = np.unique(np.asarray(conds).astype(str), return_inverse=True)
+    levels = list(levels)
+    if len(groups) != n_spots:
+        raise RuntimeError("Error, the number of conditions and spots is different\n")
+    for A,B in comparisons:
+        if A not in levels or B not in levels:
+            raise RuntimeError("Error, invalid comparison {}-{}\n".format(A, B))
+    design = np.zeros((n_spots, len(levels)))
+    design[np.arange(n_spots), groups] = 1.0
+    return levels, design
+
+def _deaSizeFactors(counts, size_factors):
+    """ Helper function that returns the given size factors or computes 
+    them (DESeq2 median of ratios or poscounts if no gene is expressed
+    in every spot).
+    """
+    if size_factors is None:
+        from stanalysis.normalization import computeSizeFactors
+        size_factors = computeSizeFactors(counts)
+        if not np.all(np.isfinite(size_factors)):
+            size_factors = _posCountsFactors(counts)
+    size_factors = np.asarray(size_factors, dtype=np.float64)
+    if not np.all(np.isfinite(size_factors) & (size_factors > 0)):
+        raise RuntimeError("Error, the size factors must be positive (spots without counts?)\n")
+    return size_factors
+
+def _deaFrame(genes, base_mean, lfc, lfc_se, stat, pvalue):
+    """ Helper function that returns the results of a comparison
+    as a data frame with the DESeq2 columns (the p-values are 
+    adjusted with Benjamini-Hochberg).
+    """
+    return pd.DataFrame({"baseMean" : base_mean,
+                         "log2FoldChange" : lfc,
+                         "lfcSE" : lfc_se,
+                         "stat" : stat,
+                         "pvalue" : pvalue,
+                         "padj" : _adjustPvalues(pvalue)}, 
+                        index=genes, 
+                        columns=["baseMean", "log2FoldChange", "lfcSE",
+                                 "stat", "pvalue", "padj"])
+
+def _nbGeneWiseBlock(args):
+    """ Helper function that computes the mean of the normalized
+    counts and the gene-wise dispersions of a block of genes.
+    """
+    counts, start, end, size_factors, design, bounds = args
+    y, mu, expressed = _nbBlockMeans(counts, start, end, size_factors, design)
+    base_mean = np.mean(y / size_factors, axis=1)
+    disp = np.full(end - start, np.nan)
+    if np.any(expressed):
+        # The method of moments is the starting point
+        normalized = y[expressed] / size_factors
+        mean = base_mean[expressed]
+        start_disp = (np.var(normalized, axis=1, ddof=1) - 
+                      mean * np.mean(1.0 / size_factors)) / mean**2
+        start_disp = np.log(np.clip(start_disp, np.exp(bounds[0]), np.exp(bounds[1])))
+        disp[expressed] = np.exp(_nbDispersion(y[expressed], mu[expressed], 
+                                               design, start_disp, bounds))
+    return base_mean, disp
+
+def _nbWaldBlock(args):
+    """ Helper function that computes the shrunken (maximum a posteriori) 
+    dispersions of a block of genes and fits the GLMs returning the 
+    coefficients (log means of the conditions) and their information.
+    """
+    counts, start, end, size_factors, design, bounds, \
+    disp_gene, disp_trend, prior_var, var_log_disp = args
+    y, mu, expressed = _nbBlockMeans(counts, start, end, size_factors, design)
+    beta = np.full((end - start, design.shape[1]), np.nan)
+    info = np.full((end - start, design.shape[1]), np.nan)
+    if not np.any(expressed):
+        return beta, info
+    y, mu = y[expressed], mu[expressed]
+    log_gene, log_trend = np.log(disp_gene[expressed]), np.log(disp_trend[expressed])
+    log_disp = _nbDispersion(y, mu, design, log_gene, bounds, log_trend, prior_var)
+    # The dispersion outliers keep the gene-wise estimates
+    outliers = log_gene > log_trend + 2.0 * np.sqrt(var_log_disp)
+    disp = np.exp(np.where(outliers, log_gene, log_disp))[:,np.newaxis]
+    # IRLS (Fisher scoring) the coefficients of the conditions are independent
+    min_beta = -30.0 * np.log(2)
+    with np.errstate(divide="ignore"):
+        group_beta = np.log(y.dot(design) / size_factors.dot(design))
+    group_beta = np.maximum(group_beta, min_beta)
+    for _ in range(100):
+        mu = np.exp(group_beta.dot(design.T)) * size_factors
+        denominator = 1.0 + disp * mu
+        group_info = (mu / denominator).dot(design)
+        step = ((y - mu) / denominator).dot(design) / group_info
+        group_beta = np.maximum(group_beta + step, min_beta)
+        if np.max(np.abs(step)) < 1e-8:
+            break
+    mu = np.exp(group_beta.dot(design.T)) * size_factors
+    beta[expressed] = group_beta
+    info[expressed] = (mu / (1.0 + disp * mu)).dot(design)
+    return beta, info
+
+def _nbBlockMeans(counts, start, end, size_factors, design):
+    """ Helper function that returns the counts of a block of genes,
+    the means of the conditions (linear model of the normalized counts)
+    and the expressed genes.
+    """
+    y = np.asarray(_denseRows(counts, start, end), dtype=np.float64)
+    group_means = (y / size_factors).dot(design) / design.sum(axis=0)
+    mu = np.maximum(group_means.dot(design.T) * size_factors, 0.5)
+    return y, mu, y.sum(axis=1) > 0
+
+def _nbDispersion(y, mu, design, log_disp, bounds, prior_mean=None, 
+                  prior_var=None, max_iter=50, tol=1e-6):
+    """ Helper function that maximizes the Cox-Reid adjusted log-likelihood
+    of the dispersions of a block of genes (plus a normal prior of the
+    log dispersions if given) with Newton iterations in the log scale.
+    Returns the log dispersions.
+    """
+    from scipy.special import digamma, polygamma
+    log_disp = np.array(log_disp, dtype=np.float64)
+    active = np.arange(len(log_disp))
+    for _ in range(max_iter):
+        if len(active) == 0:
+            break
+        disp = np.exp(log_disp[active])
+        a = disp[:,np.newaxis]
+        y_active, mu_active = y[active], mu[active]
+        size = 1.0 / a
+        denominator = 1.0 + a * mu_active
+        log_term = np.log(denominator) - (digamma(y_active + size) - digamma(size))
+        trigamma = polygamma(1, y_active + size) - polygamma(1, size)
+        residuals = y_active - mu_active
+        # Derivatives of the log-likelihood
+        d1 = np.sum(log_term / a**2 + residuals / (a * denominator), axis=1)
+        d2 = np.sum(-2.0 * log_term / a**3 + (mu_active / denominator + trigamma / a**2) / a**2
+                    - residuals * (1.0 + 2.0 * a * mu_active) / (a * denominator)**2, axis=1)
+        # Derivatives of the Cox-Reid adjustment (-log(det(X'WX)) / 2)
+        weights = mu_active / denominator
+        w1, w2, w3 = weights.dot(design), (weights**2).dot(design), (weights**3).dot(design)
+        d1 += 0.5 * np.sum(w2 / w1, axis=1)
+        d2 += 0.5 * np.sum((w2 / w1)**2 - 2.0 * w3 / w1, axis=1)
+        # Derivatives in the log scale
+        gradient = disp * d1
+        hessian = disp**2 * d2 + disp * d1
+        if prior_var is not None:
+            gradient -= (log_disp[active] - prior_mean[active]) / prior_var
+            hessian -= 1.0 / prior_var
+        concave = hessian < 0
+        step = np.where(concave, -gradient / np.where(concave, hessian, -1.0), np.sign(gradient))
+        updated = np.clip(log_disp[active] + np.clip(step, -1.0, 1.0), bounds[0], bounds[1])
+        converged = np.abs(updated - log_disp[active]) < tol
+        log_disp[active] = updated
+        active = active[~converged]
+    return log_disp
+
+def _nbDispersionTrend(means, disps, max_iter=10):
+    """ Helper function that fits the trend of the dispersions 
+    (disp = a0 + a1 / mean) with a Gamma GLM (identity link) excluding
+    the outliers iteratively. Returns the coefficients or None if 
+    the fit does not converge.
+    """
+    coefs = np.array([0.1, 1.0])
+    for _ in range(max_iter):
+        residuals = disps / (coefs[0] + coefs[1] / means)
+        good = (residuals > 1e-4) & (residuals < 15)
+        X = np.column_stack([np.ones(np.sum(good)), 1.0 / means[good]])
+        new_coefs = coefs
+        for _ in range(50):
+            fitted = X.dot(new_coefs)
+            if np.any(fitted <= 0):
+                return None
+            weighted = X.T / fitted**2
+            step = np.linalg.solve(weighted.dot(X), weighted.dot(disps[good])) - new_coefs
+            new_coefs = new_coefs + step
+            if np.all(np.abs(step) <= 1e-8 * np.abs(new_coefs)):
+                break
+        if not np.all(new_coefs > 0):
+            return None
+        old_coefs, coefs = coefs, new_coefs
+        if np.sum(np.log(coefs / old_coefs)**2) < 1e-6:
+            return coefs
+    return None
+
+def _posCountsFactors(counts):
+    """ Helper function that computes the size factors with the geometric 
+    means of the positive counts (DESeq2 poscounts) used when no gene
+    is expressed in every spot (genes as rows).
+    """
+    counts = sp.csc_matrix(counts, dtype=np.float64)
+    counts.eliminate_zeros()
+    log_counts = counts.copy()
+    log_counts.data = np.log(log_counts.data)
+    log_geo_means = np.asarray(log_counts.sum(axis=1)).ravel() / counts.shape[1]
+    factors = np.full(counts.shape[1], np.nan)
+    for j in range(counts.shape[1]):
+        rows = log_counts.indices[log_counts.indptr[j]:log_counts.indptr[j+1]]
+        if len(rows) > 0:
+            log_ratios = log_counts.data[log_counts.indptr[j]:log_counts.indptr[j+1]] \
+            - log_geo_means[rows]
+            factors[j] = np.exp(np.median(log_ratios))
+    return factors / np.exp(np.mean(np.log(factors[np.isfinite(factors)])))
+
+def _adjustPvalues(pvalues):
+    """ Helper function that adjusts the given p-values
+    with Benjamini-Hochberg (missing p-values are ignored).
+    """
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    padj = np.full(len(pvalues), np.nan)
+    valid = np.flatnonzero(np.isfinite(pvalues))
+    order = valid[np.argsort(pvalues[valid], kind="mergesort")[::-1]]
+    n_tests = len(valid)
+    adjusted = pvalues[order] * n_tests / np.arange(n_tests, 0, -1)
+    padj[order] = np.minimum(np.minimum.accumulate(adjusted), 1.0)
+    return padj
+
+def _geneRows(counts):
+    """ Helper function that returns the counts (genes as rows) of a Pandas data
+    frame (dense or sparse), NumPy array or scipy.sparse matrix as a NumPy array or
+    a CSR matrix (float64) and the names of the genes.
+    """
+    if hasattr(counts, "columns"):
+        from stanalysis.preprocessing import is_sparse, sparse_matrix
+        genes = counts.index
+        counts = sparse_matrix(counts) if is_sparse(counts) else counts.values
+    else:
+        genes = pd.RangeIndex(counts.shape[0])
+    if sp.issparse(counts):
+        return sp.csr_matrix(counts, dtype=np.float64), genes
+    return np.asarray(counts, dtype=np.float64), genes
+
+def _mapBlocks(func, args, num_workers=None):
+    """ Helper function that applies a function to the given list 
+    of arguments (blocks) in parallel with threads.
+    """
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    num_workers = max(min(num_workers, len(args)), 1)
+    if num_workers == 1:
+        return [func(arg) for arg in args]
+    pool = ThreadPool(num_workers)
+    try:
+        return pool.map(func, args)
+    finally:
+        pool.terminate()
+
 def linear_conv(old, min, max, new_min, new_max):
     """ A simple linear conversion of one value for one scale to another
     """
@@ -158,13 +1006,13 @@ def composite_colors(colors, probs):
 def Rtsne(counts, dimensions, theta=0.5, dims=50, perplexity=30, max_iter=1000):
     """Performs dimensionality reduction
     using the R package Rtsne"""
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts)
+    with SharedMatrix(counts) as shared_counts:
+        return r_call(_Rtsne, shared_counts, dimensions, theta, dims, perplexity, max_iter)
+
+def _Rtsne(counts, dimensions, theta, dims, perplexity, max_iter):
+    """ Executed in the R session (see Rtsne()) """
     tsne = RimportLibrary("Rtsne")
-    multicore = RimportLibrary("BiocParallel")
-    multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-    as_matrix = r["as.matrix"]
-    tsne_out = tsne.Rtsne(as_matrix(counts), 
+    tsne_out = tsne.Rtsne(counts.to_r(), 
                           dims=dimensions, 
                           theta=theta, 
                           check_duplicates=False, 
@@ -173,6 +1021,126 @@ def Rtsne(counts, dimensions, theta=0.5, dims=50, perplexity=30, max_iter=1000):
                           perplexity=perplexity, 
                           max_iter=max_iter, 
                           verbose=False)
-    pandas_tsne_out = pandas2ri.ri2py(tsne_out.rx2('Y'))
-    pandas2ri.deactivate()
-    return pandas_tsne_out
\ No newline at end of file
+    return r_to_numpy(tsne_out.rx2('Y'))
+
+def tsne(counts, dimensions, theta=0.5, dims=50, perplexity=30, max_iter=1000,
+         early_exaggeration=12.0, num_threads=None, random_state=0,
+         n_iter_early=250, learning_rate=200.0):
+    """Performs dimensionality reduction 
+    using Barnes-Hut t-SNE (Scikit-learn) with the same 
+    defaults as the R package Rtsne (without R).
+    The data is first reduced to dims principal components 
+    that are also used to initialize the embedding.
+    :param counts: a matrix of counts (spots as rows)
+    :param dimensions: the number of dimensions of the embedding
+    :param theta: the Barnes-Hut trade-off between speed and accuracy
+    :param dims: the number of principal components (initial dimensions)
+    :param perplexity: the perplexity
+    :param max_iter: the number of iterations (at least 250 and n_iter_early)
+    :param early_exaggeration: the exaggeration factor of the first n_iter_early iterations
+    :param num_threads: the number of threads (all the CPUs if None)
+    :param random_state: the seed of the random number generator
+    :param n_iter_early: the number of iterations with early exaggeration
+    (stop_lying_iter of Rtsne)
+    :param learning_rate: the learning rate (eta of Rtsne) or "auto" to use
+    the number of spots / early_exaggeration / 4 (at least 50) which
+    converges faster with many spots
+    :return: the embedding as a NumPy array (spots as rows)
+    """
+    import sklearn
+    from sklearn.decomposition import PCA
+    from sklearn.manifold import TSNE
+    counts = np.asarray(counts, dtype=np.float64)
+    n_spots = counts.shape[0]
+    dims = max(min(dims, n_spots, counts.shape[1]), dimensions)
+    components = PCA(n_components=dims, random_state=random_state).fit_transform(counts)
+    # Same initialization as the PCA initialization of Scikit-learn
+    init = components[:,:dimensions] / np.std(components[:,0]) * 1e-4
+    params = dict(n_components=dimensions,
+                  perplexity=min(perplexity, (n_spots - 1) / 3.0),
+                  early_exaggeration=early_exaggeration,
+                  learning_rate=learning_rate,
+                  init=init,
+                  method="barnes_hut",
+                  angle=theta,
+                  random_state=random_state,
+                  n_jobs=num_threads if num_threads is not None else -1)
+    # The number of iterations (at least 250) was renamed in Scikit-learn 1.5
+    sklearn_version = tuple(int(x) for x in re.findall(r"\d+", sklearn.__version__)[:2])
+    iter_param = "max_iter" if sklearn_version >= (1, 5) else "n_iter"
+    params[iter_param] = max(max_iter, 250, n_iter_early)
+    if n_iter_early != 250:
+        # Scikit-learn has no parameter for the number of iterations with early
+        # exaggeration (a class constant) so it is set in a subclass
+        constants = [name for name in ["_EXPLORATION_MAX_ITER", "_EXPLORATION_N_ITER"]
+                     if isinstance(getattr(TSNE, name, None), int)]
+        if len(constants) == 0:
+            raise RuntimeError("Error, the number of iterations with early exaggeration "
+                               "cannot be changed with this version of Scikit-learn\n")
+        TSNE = type("TSNE", (TSNE,), {constants[0] : n_iter_early})
+    model = TSNE(**params)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return model.fit_transform(components)
+    # Limit the threads of the gradient computation (OpenMP)
+    with threadpool_limits(limits=num_threads, user_api="openmp"):
+        return model.fit_transform(components)
+
+def computePCA(counts, n_components, incremental=False, whiten=False, 
+               batch_size=1000, random_state=0):
+    """Computes the principal components of a matrix of counts
+    (spots as rows) dense or sparse without the exact (full) PCA.
+    The components are computed with a randomized SVD of the centered
+    matrix (sparse matrices are centered implicitly in the products so 
+    they are kept sparse) or with an incremental PCA that is fitted on
+    blocks of spots (the matrix is in memory, only the block being
+    processed is made dense when the matrix is sparse).
+    :param counts: a matrix of counts (spots as rows) NumPy, Pandas or scipy.sparse
+    :param n_components: the number of components
+    :param incremental: True to use the incremental PCA
+    :param whiten: True to whiten the components (unit variance)
+    :param batch_size: the number of spots of each block (incremental)
+    :param random_state: the seed of the random number generator
+    :return: the components as a NumPy array (spots as rows)
+    """
+    from sklearn.decomposition import PCA, IncrementalPCA
+    if not sp.issparse(counts):
+        counts = np.asarray(counts, dtype=np.float64)
+    n_spots = counts.shape[0]
+    n_components = max(min(n_components, n_spots, counts.shape[1]), 1)
+    if incremental:
+        batch_size = max(batch_size, n_components)
+        model = IncrementalPCA(n_components=n_components, whiten=whiten)
+        blocks = [(start, min(start + batch_size, n_spots)) 
+                  for start in range(0, n_spots, batch_size)]
+        # The last block is merged with the previous one if smaller than n_components
+        if len(blocks) > 1 and blocks[-1][1] - blocks[-1][0] < n_components:
+            blocks[-2:] = [(blocks[-2][0], n_spots)]
+        for start, end in blocks:
+            model.partial_fit(_denseRows(counts, start, end))
+        return np.vstack([model.transform(_denseRows(counts, start, end)) 
+                          for start, end in blocks])
+    if sp.issparse(counts):
+        counts = sp.csr_matrix(counts, dtype=np.float64)
+        n_components = max(min(n_components, n_spots - 1, counts.shape[1] - 1), 1)
+        means = np.asarray(counts.mean(axis=0)).ravel()
+        def dot(values):
+            # (counts - means) times a matrix
+            return counts.dot(values) - means.dot(values)[np.newaxis,:]
+        def dot_t(values):
+            return counts.T.dot(values) - np.outer(means, values.sum(axis=0))
+        u, s = _randomizedSVD(dot, dot_t, counts.shape[1], n_components, 
+                              np.random.RandomState(random_state))
+        # Same scaling as the whitening of Scikit-learn (variance of the components)
+        return u * np.sqrt(n_spots - 1) if whiten else u * s
+    return PCA(n_components=n_components, svd_solver="randomized", whiten=whiten, 
+               random_state=random_state).fit_transform(counts)
+
+def _denseRows(counts, start, end):
+    """ Helper function that returns a block of rows of a dense 
+    or sparse matrix as a dense NumPy array.
+    """
+    block = counts[start:end]
+    return block.toarray() if sp.issparse(block) else block
+
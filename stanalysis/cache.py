@@ -0,0 +1,153 @@
+"""
+On-disk cache of expensive results (size factors, normalized counts
+and clusters of the spots) for the st analysis package. The results
+are stored in a folder keyed by a fingerprint (content hash) of the
+counts and the options used to compute them so repeated runs on the
+same datasets can skip the computation. The size of the cache is
+bounded and the least recently used results are removed first.
+
+The cache folder, its maximum size (in MB) and whether it is enabled
+can be set with the environment variables STANALYSIS_CACHE_DIR
+(default ~/.cache/stanalysis), STANALYSIS_CACHE_SIZE (default 2048)
+and STANALYSIS_CACHE (0 disables it) or with set_cache().
+"""
+import os
+import hashlib
+import tempfile
+import numpy as np
+import scipy.sparse as sp
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+_cache_dir = os.environ.get("STANALYSIS_CACHE_DIR",
+                            os.path.join(os.path.expanduser("~"), ".cache", "stanalysis"))
+_max_size = int(os.environ.get("STANALYSIS_CACHE_SIZE", 2048)) * 1024 * 1024
+_enabled = os.environ.get("STANALYSIS_CACHE", "1") != "0"
+_suffix = ".pkl"
+
+def set_cache(enabled=True, cache_dir=None, max_size=None):
+    """ Sets whether the cache is enabled, its folder and
+    its maximum size.
+    :param enabled: False to disable the cache
+    :param cache_dir: the folder where the results are stored
+    :param max_size: the maximum size of the cache in MB
+    """
+    global _enabled, _cache_dir, _max_size
+    _enabled = enabled
+    if cache_dir is not None:
+        _cache_dir = cache_dir
+    if max_size is not None:
+        if max_size < 0:
+            raise RuntimeError("Error, the size of the cache must be >= 0\n")
+        _max_size = int(max_size * 1024 * 1024)
+
+def cache_enabled():
+    """ Returns True if the cache is enabled
+    """
+    return _enabled and _max_size > 0
+
+def fingerprint(*objects):
+    """ Computes a content hash of the given objects (Pandas data frames
+    dense or sparse, NumPy arrays, scipy.sparse matrices or options).
+    The data frames and the arrays are hashed by blocks of rows so they
+    are not copied.
+    :return: the fingerprint (hexadecimal string)
+    """
+    digest = hashlib.sha1()
+    for obj in objects:
+        _update(digest, obj)
+    return digest.hexdigest()
+
+def _update(digest, obj, block_size=1000):
+    """ Helper function that adds an object to a hash
+    """
+    if hasattr(obj, "columns") and hasattr(obj, "index"):
+        _update(digest, [str(x) for x in obj.index])
+        _update(digest, [str(x) for x in obj.columns])
+        try:
+            obj = sp.csr_matrix(obj.sparse.to_coo())
+        except AttributeError:
+            obj = obj.values
+    if sp.issparse(obj):
+        obj = sp.csr_matrix(obj)
+        digest.update(repr(("sparse", obj.shape, str(obj.dtype))).encode("utf-8"))
+        for values in [obj.data, obj.indices, obj.indptr]:
+            digest.update(np.ascontiguousarray(values).tobytes())
+    elif isinstance(obj, np.ndarray) and obj.dtype == object:
+        _update(digest, [str(x) for x in obj.ravel()])
+    elif isinstance(obj, np.ndarray):
+        digest.update(repr(("array", obj.shape, str(obj.dtype))).encode("utf-8"))
+        for start in range(0, max(obj.shape[0] if obj.ndim > 0 else 1, 1), block_size):
+            digest.update(np.ascontiguousarray(obj[start:start + block_size]
+                                               if obj.ndim > 0 else obj).tobytes())
+    else:
+        digest.update(repr(obj).encode("utf-8"))
+
+def cache_get(key):
+    """ Returns the result stored in the cache with the given
+    key or None if it is not present (or the cache is disabled).
+    The result is marked as recently used.
+    :param key: the key (see fingerprint())
+    :return: the stored result or None
+    """
+    if not cache_enabled():
+        return None
+    path = os.path.join(_cache_dir, key + _suffix)
+    try:
+        with open(path, "rb") as filehandler:
+            value = pickle.load(filehandler)
+        os.utime(path, None)
+        return value
+    except Exception:
+        return None
+
+def cache_put(key, value):
+    """ Stores a result in the cache with the given key and removes
+    the least recently used results if the cache is bigger than
+    its maximum size. Errors are ignored (the cache is optional).
+    :param key: the key (see fingerprint())
+    :param value: the result (it must be picklable)
+    """
+    if not cache_enabled():
+        return
+    try:
+        if not os.path.isdir(_cache_dir):
+            os.makedirs(_cache_dir)
+        # Written to a temporary file first so a result is never read half written
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=_cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as filehandler:
+                pickle.dump(value, filehandler, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, os.path.join(_cache_dir, key + _suffix))
+        finally:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+        _evict()
+    except (IOError, OSError, pickle.PicklingError):
+        pass
+
+def _evict():
+    """ Helper function that removes the least recently used
+    results until the cache is not bigger than its maximum size
+    """
+    entries = list()
+    for name in os.listdir(_cache_dir):
+        if name.endswith(_suffix):
+            stat = os.stat(os.path.join(_cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total_size <= _max_size:
+            break
+        os.remove(os.path.join(_cache_dir, name))
+        total_size -= size
+
+def clear_cache():
+    """ Removes all the results stored in the cache
+    """
+    if os.path.isdir(_cache_dir):
+        for name in os.listdir(_cache_dir):
+            if name.endswith(_suffix):
+                os.remove(os.path.join(_cache_dir, name))
@@ -3,87 +3,437 @@ Normalization functions for the st analysis package
 """
 import numpy as np
 import pandas as pd
-from collections import Counter
+import scipy.sparse as sp
 import multiprocessing
-import rpy2.robjects.packages as rpackages
-from rpy2.robjects import pandas2ri, r, numpy2ri
-import rpy2.robjects as ro
-ro.conversion.py2ri = numpy2ri
-base = rpackages.importr("base")
-
-def RimportLibrary(lib_name):
-    """ Helper function to import R libraries
-    using the rpy2 binder
-    """
-    if not rpackages.isinstalled(lib_name):
-        base.source("http://www.bioconductor.org/biocLite.R")
-        biocinstaller = rpackages.importr("BiocInstaller")
-        biocinstaller.biocLite(lib_name)
-    return rpackages.importr(lib_name)
-
-def computeTMMFactors(counts):
+from multiprocessing.pool import ThreadPool
+from collections import Counter
+from stanalysis.rsession import RimportLibrary, r_call, r_converter, r_to_numpy, SharedMatrix
+
+def computeTMMFactors(counts, use_r=False, log_ratio_trim=0.3, sum_trim=0.05,
+                      do_weighting=True, a_cutoff=-1e10, block_size=512):
     """ Compute normalization size factors
     using the TMM method described in EdgeR and returns then as a vector.
-    :param counts: a matrix of counts (genes as rows)
+    The factors are computed natively (same as edgeR::calcNormFactors)
+    unless use_r is True.
+    :param counts: a matrix of counts (genes as rows) dense or sparse
+    :param use_r: True to use EdgeR (R) to compute the factors
+    :param log_ratio_trim: the amount of trim to use on the log-ratios
+    :param sum_trim: the amount of trim to use on the absolute expression
+    :param do_weighting: True to compute the weighted TMM
+    :param a_cutoff: cutoff on the absolute expression
+    :param block_size: the number of spots processed at a time
     :return returns the normalization factors a vector
     """
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts)
-    edger = RimportLibrary("edgeR")
-    multicore = RimportLibrary("BiocParallel")
-    multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-    as_matrix = r["as.matrix"]
-    dds = edger.calcNormFactors(as_matrix(r_counts), method="TMM")
-    pandas_sf = pandas2ri.ri2py(dds)
-    pandas_cm = pandas2ri.ri2py(r.colSums(counts))
-    pandas2ri.deactivate()
-    return pandas_sf * pandas_cm
-
-def computeRLEFactors(counts):
+    if use_r:
+        return computeEdgeRFactorsR(counts, "TMM")
+    counts, lib_size = _expressed_genes(counts)
+    n_spots = len(lib_size)
+    if counts.shape[0] == 0 or n_spots == 1:
+        return lib_size
+    # Choose the reference spot (upper quartile closest to the mean)
+    upper_quartile = np.empty(n_spots)
+    for start, block in _column_blocks(counts, block_size):
+        upper_quartile[start:start + block.shape[1]] = np.percentile(block, 75, axis=0)
+    upper_quartile = upper_quartile / lib_size
+    if np.median(upper_quartile) < 1e-20:
+        ref_column = np.argmax(np.asarray(_sqrt_sum(counts)).ravel())
+    else:
+        ref_column = np.argmin(np.abs(upper_quartile - np.mean(upper_quartile)))
+    ref = _dense_column(counts, ref_column)
+    # Genes not expressed in the reference have infinite log ratios
+    counts = counts[ref > 0]
+    ref = ref[ref > 0]
+    factors = np.empty(n_spots)
+    for start, block in _column_blocks(counts, block_size):
+        end = start + block.shape[1]
+        factors[start:end] = _tmm_block(block, lib_size[start:end], ref, lib_size[ref_column],
+                                        log_ratio_trim, sum_trim, do_weighting, a_cutoff)
+    # Factors must multiply to one
+    factors = factors / np.exp(np.mean(np.log(factors)))
+    return factors * lib_size
+
+def _tmm_block(obs, obs_lib_size, ref, ref_lib_size, 
+               log_ratio_trim, sum_trim, do_weighting, a_cutoff):
+    """ Helper function that computes the TMM factors of a block
+    of spots (columns) against the reference spot.
+    """
+    ref = ref[:,np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Same operations as edgeR so ties are the same
+        log_ratio = np.log2((obs / obs_lib_size) / (ref / ref_lib_size))
+        abs_exp = (np.log2(obs / obs_lib_size) + np.log2(ref / ref_lib_size)) / 2.0
+        variance = (obs_lib_size - obs) / obs_lib_size / obs + (ref_lib_size - ref) / ref_lib_size / ref
+    # Remove infinite values and apply the cutoff based on the absolute expression
+    finite = np.isfinite(log_ratio) & np.isfinite(abs_exp) & (abs_exp > a_cutoff)
+    log_ratio[~finite] = np.nan
+    abs_exp[~finite] = np.nan
+    n = finite.sum(axis=0)
+    lo_l = np.floor(n * log_ratio_trim) + 1
+    hi_l = n + 1 - lo_l
+    lo_s = np.floor(n * sum_trim) + 1
+    hi_s = n + 1 - lo_s
+    rank_ratio = _column_ranks(log_ratio)
+    rank_exp = _column_ranks(abs_exp)
+    with np.errstate(invalid="ignore"):
+        keep = (rank_ratio >= lo_l) & (rank_ratio <= hi_l) & \
+        (rank_exp >= lo_s) & (rank_exp <= hi_s)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if do_weighting:
+            factors = np.nansum(np.where(keep, log_ratio / variance, 0.0), axis=0) / \
+            np.nansum(np.where(keep, 1.0 / variance, 0.0), axis=0)
+        else:
+            factors = np.sum(np.where(keep, log_ratio, 0.0), axis=0) / keep.sum(axis=0)
+    # Results will be missing if the two spots share no genes with positive counts
+    factors[np.isnan(factors)] = 0.0
+    factors = 2 ** factors
+    # Spots identical to the reference
+    max_ratio = np.max(np.where(finite, np.abs(log_ratio), 0.0), axis=0)
+    factors[max_ratio < 1e-6] = 1.0
+    return factors
+
+def _column_ranks(values):
+    """ Helper function that computes the rank (average for ties)
+    of the values in each column ignoring NaN values (same as R rank()).
+    """
+    n_rows = values.shape[0]
+    order = np.argsort(values, axis=0, kind="mergesort")
+    sorted_values = np.take_along_axis(values, order, axis=0)
+    positions = np.broadcast_to(np.arange(n_rows)[:,np.newaxis], values.shape)
+    # Groups of ties (NaN values are sorted last)
+    starts = np.ones(values.shape, dtype=bool)
+    starts[1:] = sorted_values[1:] != sorted_values[:-1]
+    ends = np.ones(values.shape, dtype=bool)
+    ends[:-1] = starts[1:]
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=0)
+    last = np.minimum.accumulate(np.where(ends, positions, n_rows)[::-1], axis=0)[::-1]
+    ranks = np.empty(values.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2.0 + 1, axis=0)
+    ranks[np.isnan(values)] = np.nan
+    return ranks
+
+def computeRLEFactors(counts, use_r=False):
     """ Compute normalization size factors
     using the RLE method described in EdgeR and returns then as a vector.
+    The factors are computed natively (same as edgeR::calcNormFactors)
+    unless use_r is True.
+    :param counts: a matrix of counts (genes as rows) dense or sparse
+    :param use_r: True to use EdgeR (R) to compute the factors
+    :return returns the normalization factors a vector
+    """
+    if use_r:
+        return computeEdgeRFactorsR(counts, "RLE")
+    counts, lib_size = _expressed_genes(counts)
+    if counts.shape[0] == 0 or len(lib_size) == 1:
+        return lib_size
+    # Only the genes expressed in every spot have a positive geometric mean
+    if sp.issparse(counts):
+        counts = counts[counts.getnnz(axis=1) == counts.shape[1]].toarray()
+    else:
+        counts = counts[(counts > 0).all(axis=1)]
+    if counts.shape[0] == 0:
+        # No gene is expressed in every spot (EdgeR returns NA)
+        return np.full(len(lib_size), np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        geo_means = np.exp(np.mean(np.log(counts), axis=1))
+        factors = np.median(counts / geo_means[:,np.newaxis], axis=0) / lib_size
+        # Factors must multiply to one
+        factors = factors / np.exp(np.mean(np.log(factors)))
+    return factors * lib_size
+
+def _expressed_genes(counts):
+    """ Helper function that returns the counts (genes as rows)
+    without the genes that are not expressed in any spot
+    (as a float NumPy array or a CSR matrix) and the library sizes.
+    """
+    if sp.issparse(counts):
+        counts = sp.csr_matrix(counts, dtype=np.float64)
+        lib_size = np.asarray(counts.sum(axis=0)).ravel()
+        return counts[counts.getnnz(axis=1) > 0], lib_size
+    counts = np.asarray(counts, dtype=np.float64)
+    lib_size = counts.sum(axis=0)
+    return counts[(counts > 0).any(axis=1)], lib_size
+
+def _column_blocks(counts, block_size):
+    """ Helper function that iterates the columns of a dense
+    or sparse matrix in dense blocks of block_size columns.
+    """
+    counts = counts.tocsc() if sp.issparse(counts) else counts
+    for start in range(0, counts.shape[1], block_size):
+        block = counts[:,start:start + block_size]
+        yield start, block.toarray() if sp.issparse(block) else block
+
+def _dense_column(counts, column):
+    """ Helper function that returns a column of a
+    dense or sparse matrix as a 1D NumPy array.
+    """
+    if sp.issparse(counts):
+        return counts[:,column].toarray().ravel()
+    return counts[:,column]
+
+def _sqrt_sum(counts):
+    """ Helper function that returns the sum of the
+    square root of the counts of each column.
+    """
+    if sp.issparse(counts):
+        return counts.sqrt().sum(axis=0)
+    return np.sqrt(counts).sum(axis=0)
+
+def computeEdgeRFactorsR(counts, method):
+    """ Compute normalization size factors
+    using EdgeR (R) and returns then as a vector.
     :param counts: a matrix of counts (genes as rows)
+    :param method: the EdgeR method (TMM or RLE)
     :return returns the normalization factors a vector
     """
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts)
+    lib_size = np.asarray(counts.sum(axis=0), dtype=np.float64).ravel()
+    with SharedMatrix(counts) as shared_counts:
+        return r_call(_edgeRFactors, shared_counts, method) * lib_size
+
+def _edgeRFactors(counts, method):
+    """ Executed in the R session (see computeEdgeRFactorsR()) """
     edger = RimportLibrary("edgeR")
-    multicore = RimportLibrary("BiocParallel")
-    multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-    as_matrix = r["as.matrix"]
-    dds = edger.calcNormFactors(as_matrix(r_counts), method="RLE")
-    pandas_sf = pandas2ri.ri2py(dds)
-    pandas_cm = pandas2ri.ri2py(r.colSums(counts))
-    pandas2ri.deactivate()
-    return pandas_sf * pandas_cm
-
-def computeSumFactors(counts, scran_clusters=True):
+    dds = edger.calcNormFactors(counts.to_r(), method=method)
+    return r_to_numpy(dds)
+
+def computeSumFactors(counts, scran_clusters=True, use_r=False, clusters=None,
+                      sizes=None, min_mean=1.0, positive=True, num_workers=None):
     """ Compute normalization factors
     using the deconvolution method
     described in Merioni et al.
     Returns the computed size factors as a vector.
+    The factors are computed natively (same approach as scran::computeSumFactors)
+    unless use_r is True. In each cluster the genes with a low average count
+    (min_mean, scaled by library size) are discarded, the spots are pooled in a 
+    ring ordered by library size, the size factor of each pool is the median 
+    ratio to the average spot and the factors of the spots are obtained solving 
+    the linear system of the pools (least squares). Each cluster of spots is 
+    computed in parallel. The clusters are then rescaled to the cluster with the
+    median library size by the median ratio of their average profiles (genes
+    with an average count of both clusters >= min_mean) as Scran does.
+    Scran splits the clusters bigger than 3000 spots, this is not done here.
+    Unlike Scran, a cluster without genes >= min_mean gets NaN factors 
+    instead of an error.
+    :param counts: a matrix of counts (genes as rows) dense or sparse
+    :param scran_clusters: True to deconvolute the spots in clusters (quickClusters())
+    :param use_r: True to use Scran (R) to compute the factors
+    :param clusters: an optional cluster label for each spot (computed if None
+    and scran_clusters is True)
+    :param sizes: the sizes of the pools (computed from the number of spots if None)
+    :param min_mean: the minimum average count of the genes to be used
+    :param positive: True to enforce the factors to be positive
+    :param num_workers: the number of clusters computed in parallel 
+    (the number of CPUs if None)
+    :return returns the normalization factors a vector
+    """
+    if use_r:
+        return computeSumFactorsR(counts, scran_clusters)
+    if sp.issparse(counts):
+        counts = sp.csc_matrix(counts, dtype=np.float64)
+    else:
+        counts = np.asfortranarray(counts, dtype=np.float64)
+    n_cells = counts.shape[1]
+    if clusters is None and scran_clusters:
+        from stanalysis.analysis import quickClusters
+        clusters = quickClusters(counts, max(n_cells // 10, 10))
+    if clusters is None:
+        cluster_indexes = [np.arange(n_cells)]
+        sizes = sizes or [n_cells / 2.0 * i for i in [0.1,0.2,0.3,0.4,0.5]]
+    else:
+        codes = pd.Categorical(np.asarray(clusters)).codes
+        cluster_indexes = [np.flatnonzero(codes == k) for k in np.unique(codes)]
+        min_cluster_size = min(len(indexes) for indexes in cluster_indexes)
+        sizes = sizes or [(min_cluster_size / 2.0) / i for i in [5,4,3,2,1]]
+    min_cluster_size = min(len(indexes) for indexes in cluster_indexes)
+    sizes = sorted(set([int(round(size)) for size in sizes 
+                        if 1 <= int(round(size)) <= min_cluster_size]))
+    if len(sizes) == 0:
+        raise RuntimeError("Error, the clusters are too small to compute the Scran factors\n")
+    lib_size = np.asarray(counts.sum(axis=0), dtype=np.float64).ravel()
+    # Deconvolute each cluster in parallel
+    args = [(counts[:,indexes], lib_size[indexes], sizes, min_mean, positive) 
+            for indexes in cluster_indexes]
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    num_workers = max(min(num_workers, len(args)), 1)
+    if num_workers == 1:
+        results = [_sumFactorsCluster(arg) for arg in args]
+    else:
+        pool = ThreadPool(num_workers)
+        try:
+            results = pool.map(_sumFactorsCluster, args)
+        finally:
+            pool.terminate()
+    # Rescale the clusters to the cluster with the median library size
+    mean_lib_sizes = [np.mean(lib_size[indexes]) for indexes in cluster_indexes]
+    ref_cluster = np.argsort(mean_lib_sizes, kind="mergesort")[len(cluster_indexes) // 2]
+    ref_profile = results[ref_cluster][1]
+    factors = np.empty(n_cells)
+    for k, (indexes, (cluster_factors, profile)) in enumerate(zip(cluster_indexes, results)):
+        factors[indexes] = cluster_factors if k == ref_cluster \
+        else cluster_factors * _rescaleCluster(profile, ref_profile, min_mean)
+    # Factors are centered at unity (positive factors)
+    positive_factors = factors[factors > 0]
+    if len(positive_factors) == 0:
+        return np.full(n_cells, np.nan)
+    return factors / np.mean(positive_factors)
+
+def _sumFactorsCluster(args):
+    """ Helper function that computes the deconvoluted size factors
+    of a cluster of spots (genes as rows) and returns them together
+    with the average expression profile of the cluster (average counts
+    scaled by library size, all the genes).
+    """
+    counts, lib_size, sizes, min_mean, positive = args
+    n_cells = counts.shape[1]
+    with np.errstate(divide="ignore"):
+        inv_lib_size = np.where(lib_size > 0, 1.0 / lib_size, 0.0)
+    if sp.issparse(counts):
+        exprs = sp.csc_matrix(counts.dot(sp.diags(inv_lib_size)))
+    else:
+        exprs = np.asfortranarray(counts * inv_lib_size)
+    ave_cell = np.asarray(exprs.mean(axis=1)).ravel()
+    profile = ave_cell * np.mean(lib_size)
+    # Genes with low average counts (scaled by library size) are not used
+    expressed = (ave_cell > 0) & (profile >= min_mean)
+    if not np.any(expressed):
+        return np.full(n_cells, np.nan), profile
+    exprs = exprs[expressed]
+    # Spots in a ring ordered by library size (odd positions up and even down)
+    order = np.argsort(lib_size, kind="mergesort")
+    ring = np.concatenate([order[0::2], order[1::2][::-1]])
+    pool_factors = [_poolFactors(exprs, ave_cell[expressed], ring, size) for size in sizes]
+    # Extra equations (very low weight) so the system has a unique solution
+    low_weight = 0.000001
+    target = 1.0 / np.sum(ave_cell)
+    theta = np.empty(n_cells)
+    theta[ring] = _solvePools(pool_factors, sizes, n_cells, low_weight, target)
+    if positive and np.any(theta < 0):
+        theta[ring] = _solvePoolsPositive(pool_factors, sizes, n_cells, 
+                                          low_weight, target)
+    return theta * lib_size / np.mean(lib_size), profile
+
+def _rescaleCluster(profile, ref_profile, min_mean):
+    """ Helper function that returns the factor to rescale a cluster to the 
+    reference cluster as the median ratio of their average profiles using 
+    the genes whose average count in both clusters is >= min_mean.
+    The factor is NaN if no gene can be used (same as the factors of
+    a cluster without genes >= min_mean).
+    """
+    lib_size = np.sum(profile)
+    ref_lib_size = np.sum(ref_profile)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pseudo_average = (profile / lib_size + ref_profile / ref_lib_size) / 2.0 \
+        * (lib_size + ref_lib_size) / 2.0
+        use = pseudo_average >= min_mean
+        ratios = profile[use] / ref_profile[use]
+    ratios = ratios[~np.isnan(ratios)]
+    if len(ratios) == 0:
+        return np.nan
+    factor = np.median(ratios)
+    if not np.isfinite(factor) or factor <= 0:
+        raise RuntimeError("Error, the rescaling factors of the clusters "
+                           "are not strictly positive\n")
+    return factor
+
+def _poolFactors(exprs, ave_cell, ring, size, block_size=256):
+    """ Helper function that computes the size factor of each pool (window of
+    size spots in the ring) as the median ratio of the pooled expression to the 
+    average spot. The pooled expression is updated when sliding the window.
+    """
+    n_cells = len(ring)
+    ring = np.concatenate([ring, ring])
+    if sp.issparse(exprs):
+        def add_column(values, column, sign):
+            start, end = exprs.indptr[column], exprs.indptr[column + 1]
+            values[exprs.indices[start:end]] += sign * exprs.data[start:end]
+    else:
+        def add_column(values, column, sign):
+            values += sign * exprs[:,column]
+    pooled = np.zeros(exprs.shape[0])
+    for column in ring[:size]:
+        add_column(pooled, column, 1)
+    factors = np.empty(n_cells)
+    block = np.empty((exprs.shape[0], min(block_size, n_cells)))
+    for start in range(0, n_cells, block_size):
+        end = min(start + block_size, n_cells)
+        for i in range(start, end):
+            block[:,i - start] = pooled
+            add_column(pooled, ring[i + size], 1)
+            add_column(pooled, ring[i], -1)
+        factors[start:end] = np.median(block[:,:end - start] / ave_cell[:,np.newaxis], axis=0)
+    return factors
+
+def _solvePools(pool_factors, sizes, n_cells, low_weight, target):
+    """ Helper function that solves (least squares) the linear system of the pools
+    in ring order. Each pool is a circular window of spots so the system is 
+    circulant and the normal equations are solved exactly with the FFT.
+    """
+    numerator = np.full(n_cells, low_weight * target * n_cells, dtype=np.complex128)
+    numerator[1:] = 0.0
+    denominator = np.full(n_cells, low_weight)
+    for factors, size in zip(pool_factors, sizes):
+        window = np.zeros(n_cells)
+        window[:size] = 1.0
+        # The transposed window sums are a circular convolution with the window
+        window_fft = np.fft.fft(window)
+        numerator += window_fft * np.fft.fft(factors)
+        denominator += np.abs(window_fft) ** 2
+    return np.real(np.fft.ifft(numerator / denominator))
+
+def _solvePoolsPositive(pool_factors, sizes, n_cells, low_weight, target):
+    """ Helper function that solves the linear system of the pools 
+    in ring order (see _solvePools()) constraining the factors to be positive.
+    """
+    from scipy.optimize import lsq_linear
+    from scipy.sparse.linalg import LinearOperator
+    sqrt_weight = np.sqrt(low_weight)
+    def matvec(theta):
+        theta = np.ravel(theta)
+        sums = np.concatenate([[0.0], np.cumsum(np.concatenate([theta, theta]))])
+        windows = [sums[size:size + n_cells] - sums[:n_cells] for size in sizes]
+        return np.concatenate(windows + [sqrt_weight * theta])
+    def rmatvec(values):
+        values = np.ravel(values)
+        theta = sqrt_weight * values[len(sizes) * n_cells:]
+        for i, size in enumerate(sizes):
+            window = values[i * n_cells:(i + 1) * n_cells]
+            sums = np.concatenate([[0.0], np.cumsum(np.concatenate([window, window]))])
+            positions = np.arange(n_cells) + n_cells
+            theta = theta + sums[positions + 1] - sums[positions + 1 - size]
+        return theta
+    operator = LinearOperator((n_cells * (len(sizes) + 1), n_cells), 
+                              matvec=matvec, rmatvec=rmatvec, dtype=np.float64)
+    values = np.concatenate(list(pool_factors) + [np.full(n_cells, sqrt_weight * target)])
+    return lsq_linear(operator, values, bounds=(0, np.inf), lsq_solver="lsmr", 
+                      tol=1e-12).x
+
+def computeSumFactorsR(counts, scran_clusters=True):
+    """ Compute normalization factors
+    using the deconvolution method
+    described in Merioni et al. with Scran (R)
+    Returns the computed size factors as a vector.
     :param counts: a matrix of counts (genes as rows)
     :return returns the normalization factors a vector
     """
-    n_cells = len(counts.columns)
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts)
+    with SharedMatrix(counts) as shared_counts:
+        return r_call(_sumFactors, shared_counts, scran_clusters)
+
+def _sumFactors(counts, scran_clusters):
+    """ Executed in the R session (see computeSumFactorsR()) """
+    n_cells = counts.shape[1]
     scran = RimportLibrary("scran")
-    multicore = RimportLibrary("BiocParallel")
-    multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-    as_matrix = r["as.matrix"]
-    if scran_clusters:
-        r_clusters = scran.quickCluster(as_matrix(r_counts), max(n_cells/10, 10))
-        min_cluster_size = min(Counter(r_clusters).values())
-        sizes = list(set([round((min_cluster_size/2) / i) for i in [5,4,3,2,1]]))
-        dds = scran.computeSumFactors(as_matrix(r_counts), 
-                                      clusters=r_clusters, sizes=sizes, positive=True)
-    else:
-        sizes = list(set([round((n_cells/2) * i) for i in [0.1,0.2,0.3,0.4,0.5]]))
-        dds = scran.computeSumFactors(as_matrix(r_counts), sizes=sizes, positive=True)        
-    pandas_sf = pandas2ri.ri2py(dds)
-    pandas2ri.deactivate()
-    return pandas_sf
+    with r_converter():
+        r_counts = counts.to_r()
+        if scran_clusters:
+            r_clusters = scran.quickCluster(r_counts, max(n_cells/10, 10))
+            min_cluster_size = min(Counter(r_clusters).values())
+            sizes = list(set([round((min_cluster_size/2) / i) for i in [5,4,3,2,1]]))
+            dds = scran.computeSumFactors(r_counts, clusters=r_clusters, 
+                                          sizes=sizes, positive=True)
+        else:
+            sizes = list(set([round((n_cells/2) * i) for i in [0.1,0.2,0.3,0.4,0.5]]))
+            dds = scran.computeSumFactors(r_counts, sizes=sizes, positive=True)        
+        return r_to_numpy(dds)
 
 def logCountsWithFactors(counts, size_factors):
     """ Uses the R package scater to log a matrix of counts (genes as rows)
@@ -92,57 +442,86 @@ def logCountsWithFactors(counts, size_factors):
     :param size_factors: a vector of size factors
     :return the normalized log counts (genes as rows)
     """
-    columns = counts.columns
-    indexes = counts.index
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts)
+    with SharedMatrix(counts) as shared_counts:
+        norm_counts = r_call(_logCounts, shared_counts, np.asarray(size_factors))
+    return pd.DataFrame(norm_counts, index=counts.index, columns=counts.columns)
+
+def _logCounts(counts, size_factors):
+    """ Executed in the R session (see logCountsWithFactors()) """
+    from rpy2.robjects import r, FloatVector
     scater = RimportLibrary("scran")
     r_call = """
         function(counts, size_factors){
-          sce = SingleCellExperiment(assays=list(counts=as.matrix(counts)))
+          sce = SingleCellExperiment(assays=list(counts=counts))
           sizeFactors(sce) = size_factors
           sce = normalize(sce)
           norm_counts = logcounts(sce)
-          return(as.data.frame(norm_counts))
+          return(as.matrix(norm_counts))
         }
     """
     r_func = r(r_call)
-    r_norm_counts = r_func(r_counts, size_factors)
-    pandas_norm_counts = pandas2ri.ri2py(r_norm_counts)
-    pandas_norm_counts.index = indexes
-    pandas_norm_counts.columns = columns
-    pandas2ri.deactivate()
-    return pandas_norm_counts
-
-def computeSizeFactors(counts):
+    r_norm_counts = r_func(counts.to_r(), FloatVector(size_factors))
+    return r_to_numpy(r_norm_counts)
+
+def computeSizeFactors(counts, use_r=False):
     """ Computes size factors using DESeq
     for the counts matrix given as input (Genes as rows
     and spots as columns).
     Returns the computed size factors as a vector.
+    The size factors are computed natively with the median of ratios
+    method (same as DESeq2::estimateSizeFactorsForMatrix) unless use_r is True.
+    :param counts: a matrix of counts (genes as rows) dense or sparse
+    :param use_r: True to use DESeq2 (R) to compute the factors
+    :return returns the normalization factors a vector
+    """
+    if use_r:
+        return computeSizeFactorsR(counts)
+    if sp.issparse(counts):
+        counts = sp.csr_matrix(counts)
+        # Only the genes expressed in every spot have a finite geometric mean
+        n_spots = counts.shape[1]
+        counts = counts[counts.getnnz(axis=1) == n_spots].toarray()
+    else:
+        counts = np.asarray(counts, dtype=np.float64)
+    with np.errstate(divide="ignore"):
+        log_counts = np.log(counts)
+    log_geo_means = log_counts.mean(axis=1)
+    finite = np.isfinite(log_geo_means)
+    if not finite.any():
+        # No gene is expressed in every spot (DESeq2 returns NA)
+        return np.full(counts.shape[1], np.nan)
+    log_ratios = log_counts[finite] - log_geo_means[finite,np.newaxis]
+    return np.exp(np.median(log_ratios, axis=0))
+
+def computeSizeFactorsR(counts):
+    """ Computes size factors using DESeq2 (R)
+    for the counts matrix given as input (Genes as rows
+    and spots as columns).
+    Returns the computed size factors as a vector.
     :param counts: a matrix of counts (genes as rows)
     :return returns the normalization factors a vector
     """
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts)
+    with SharedMatrix(counts) as shared_counts:
+        return r_call(_sizeFactors, shared_counts)
+
+def _sizeFactors(counts):
+    """ Executed in the R session (see computeSizeFactorsR()) """
     deseq2 = RimportLibrary("DESeq2")
-    multicore = RimportLibrary("BiocParallel")
-    multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-    dds = deseq2.estimateSizeFactorsForMatrix(r_counts)
-    pandas_sf = pandas2ri.ri2py(dds)
-    pandas2ri.deactivate()
-    return pandas_sf
-
-def computeSizeFactorsSizeAdjusted(counts):
+    dds = deseq2.estimateSizeFactorsForMatrix(counts.to_r())
+    return r_to_numpy(dds)
+
+def computeSizeFactorsSizeAdjusted(counts, use_r=False):
     """ Computes size factors using DESeq
     for the counts matrix given as input (Genes as rows
     and spots as columns) the counts are library size adjusted. 
     Returns the computed size factors as a vector.
     :param counts: a matrix of counts (genes as rows)
+    :param use_r: True to use DESeq2 (R) to compute the factors
     :return returns the normalization factors a vector
     """
     lib_size = counts.sum(axis=0)
     counts = counts + (lib_size / np.mean(lib_size))
-    return computeSizeFactors(counts)
+    return computeSizeFactors(counts, use_r)
 
 def computeSizeFactorsLinear(counts):
     """ Computes size factors using DESeq2 iterative size factors
@@ -152,17 +531,19 @@ def computeSizeFactorsLinear(counts):
     :param counts: a matrix of counts (genes as rows)
     :return returns the normalization factors a vector
     """
-    pandas2ri.activate()
-    r_counts = pandas2ri.py2ri(counts)
+    with SharedMatrix(counts) as shared_counts:
+        return r_call(_sizeFactorsLinear, shared_counts)
+
+def _sizeFactorsLinear(counts):
+    """ Executed in the R session (see computeSizeFactorsLinear()) """
+    from rpy2.robjects import r
     deseq2 = RimportLibrary("DESeq2")
-    multicore = RimportLibrary("BiocParallel")
-    multicore.register(multicore.MulticoreParam(multiprocessing.cpu_count()-1))
-    vec = rpackages.importr('S4Vectors')
-    bio_generics = rpackages.importr("BiocGenerics")
+    vec = RimportLibrary("S4Vectors")
+    bio_generics = RimportLibrary("BiocGenerics")
+    base = RimportLibrary("base")
+    r_counts = counts.to_r()
     cond = vec.DataFrame(condition=base.factor(base.c(base.colnames(r_counts))))
     design = r('formula(~ condition)')
     dds = deseq2.DESeqDataSetFromMatrix(countData=r_counts, colData=cond, design=design)
     dds = bio_generics.estimateSizeFactors(dds, type="iterate")
-    pandas_sf = pandas2ri.ri2py(bio_generics.sizeFactors(dds))
-    pandas2ri.deactivate()
-    return pandas_sf
\ No newline at end of file
+    return r_to_numpy(bio_generics.sizeFactors(dds))
\ No newline at end of file
@@ -1,86 +1,486 @@
 """ 
 Pre-processing functions for the ST Analysis packages.
-Mainly function to aggregate datasets and filtering
+Mainly function to read/aggregate datasets and filtering
 functions (noisy spots and noisy genes)
 """
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import math
 import os
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from stanalysis.normalization import *
+from stanalysis.cache import fingerprint, cache_get, cache_put
 
-def merge_datasets(counts_tableA, counts_tableB, merging_action="SUM"):
-    """ This function merges two ST datasts (matrix of counts)
-    assuming that they are consecutive sections and that they
-    are aligned so each spot on the same position on the tissue
-    and the number of spots in the same.
-    The type of merging can be SUM (sum both counts) or AVG (average 
-    sum of both counts).
-    It returns the merged matrix of counts for the commong spots/genes.
-    :param counts_tableA: a ST matrix of counts
-    :param counts_tableB: a ST matrix of counts
-    :param merging_action: Either SUM or AVG (for the merging of counts)
+def sparse_frame(matrix, index, columns):
+    """ Wraps a scipy.sparse matrix of counts (spots as rows
+    and genes as columns) into a Pandas data frame with sparse
+    columns so it can be passed around as the dense data frames.
+    Zeroes are not stored.
+    :param matrix: a scipy.sparse matrix with the counts
+    :param index: the spots (rows)
+    :param columns: the genes (columns)
+    :return: a Pandas data frame with sparse columns
+    """
+    matrix = sp.csc_matrix(matrix)
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    counts = pd.DataFrame.sparse.from_spmatrix(matrix, index=index, columns=columns)
+    if matrix.shape[1] == 0 or counts.iloc[:,0].array.fill_value == 0:
+        return counts
+    # Some versions of Pandas use NaN as the fill value of float matrices
+    # so the columns are created from the CSC arrays with 0 as fill value
+    int_index = type(pd.arrays.SparseArray([0, 1]).sp_index)
+    dtype = pd.SparseDtype(matrix.dtype, 0)
+    sparse_columns = [pd.arrays.SparseArray(matrix.data[start:end], dtype=dtype,
+                                            sparse_index=int_index(matrix.shape[0], 
+                                                                   matrix.indices[start:end]))
+                      for start, end in zip(matrix.indptr[:-1], matrix.indptr[1:])]
+    counts = pd.DataFrame(dict(enumerate(sparse_columns)), index=index)
+    counts.columns = columns
+    return counts
+
+def is_sparse(counts):
+    """ Returns True if the given data frame keeps 
+    its counts in a sparse representation.
+    :param counts: a Pandas data frame with the counts
+    """
+    try:
+        counts.sparse
+        return True
+    except AttributeError:
+        return False
+
+def to_sparse(counts):
+    """ Converts a Pandas data frame of counts to the sparse
+    representation (returns the same data frame if already sparse).
+    :param counts: a Pandas data frame with the counts
+    :return: a Pandas data frame with sparse columns
+    """
+    if is_sparse(counts):
+        return counts
+    return sparse_frame(sp.csr_matrix(counts.values), counts.index, counts.columns)
+
+def to_dense(counts):
+    """ Converts a sparse Pandas data frame of counts to a dense one
+    (returns the same data frame if already dense). This should only
+    be called right before a consumer that needs the dense data.
+    :param counts: a Pandas data frame with the counts
+    :return: a dense Pandas data frame
+    """
+    if not is_sparse(counts):
+        return counts
+    return pd.DataFrame(counts.sparse.to_coo().toarray(),
+                        index=counts.index, columns=counts.columns)
+
+def sparse_matrix(counts):
+    """ Returns the counts of the given data frame (dense or sparse)
+    as a scipy.sparse CSR matrix (spots as rows and genes as columns).
+    :param counts: a Pandas data frame with the counts
+    :return: a scipy.sparse CSR matrix
+    """
+    if is_sparse(counts):
+        return sp.csr_matrix(counts.sparse.to_coo())
+    return sp.csr_matrix(counts.values)
+
+def parse_spots(spots, datasets=True):
+    """ Parses all the spots names at once into a table
+    with the dataset index (appended by aggregate_datatasets()),
+    the optional tag and the coordinates. The spots names
+    must have the format i_XxY or i_tag_XxY (or XxY and tag_XxY
+    if datasets is False).
+    :param spots: a list or index of spots
+    :param datasets: True if the spots contain the dataset index 
+    :return: a Pandas data frame (indexed by spot) with the columns 
+    dataset (int), tag (str or NaN), x (float) and y (float)
+    """
+    spots = pd.Index(spots).astype(str)
+    pattern = r"^(?:(?P<tag>.*)_)?(?P<x>[^_x]+)x(?P<y>[^_x]+)$"
+    if datasets:
+        pattern = r"^(?P<dataset>\d+)_" + pattern[1:]
+    parsed = spots.str.extract(pattern, expand=True)
+    x = pd.to_numeric(parsed["x"], errors="coerce").values.astype(np.float64)
+    y = pd.to_numeric(parsed["y"], errors="coerce").values.astype(np.float64)
+    invalid = np.isnan(x) | np.isnan(y)
+    if invalid.any():
+        raise RuntimeError("Error, the spots in the input data have "
+                           "the wrong format {}\n".format(spots[invalid][0]))
+    spot_table = pd.DataFrame(index=spots)
+    spot_table["dataset"] = parsed["dataset"].values.astype(np.int64) if datasets \
+    else np.zeros(len(spots), dtype=np.int64)
+    spot_table["tag"] = parsed["tag"].values
+    spot_table["x"] = x
+    spot_table["y"] = y
+    return spot_table
+
+def merge_datasets(counts_tables, merging_action="SUM", tolerance=0.6):
+    """ This function merges N ST datasets (matrix of counts)
+    assuming that they are consecutive sections (replicates)
+    and that they are aligned so each spot on the same position 
+    on the tissue. The spots of each dataset are matched to the spots 
+    of the first dataset by their coordinates (nearest neighbour within 
+    the given tolerance) and the genes are matched by name.
+    The type of merging can be SUM (sum of the counts), AVG (average 
+    of the counts) or MEDIAN (median of the counts).
+    It returns the merged matrix of counts for the common spots/genes
+    (with the spots of the first dataset).
+    :param counts_tables: a list of ST matrices of counts
+    :param merging_action: Either SUM, AVG or MEDIAN (for the merging of counts)
+    :param tolerance: the maximum distance between the coordinates of two spots
+    to be considered the same spot
     :return: a ST matrix of counts with the merged counts (for common genes/spots)
     """
-    merged_table = counts_tableA.copy()       
-    for indexA, indexB in zip(counts_tableA.index, counts_tableB.index):
-        tokens = indexA.split("x")
-        assert(len(tokens) == 2)
-        x_a = float(tokens[0])
-        y_a = float(tokens[1])
-        tokens = indexB.split("x")
-        assert(len(tokens) == 2)
-        x_b = float(tokens[0])
-        y_b = float(tokens[1]) 
-        if abs(x_a - x_b) > 0.6 or abs(y_a - y_b) > 0.6:
-            print("Spots {} and {} dot not match and will be skipped".format(indexA, indexB))
-            merged_table.drop(indexA, axis=0, inplace=True)
-            continue        
-        for geneA, geneB in zip(counts_tableA.loc[indexA], counts_tableB.loc[indexB]):
-            if geneA != geneB:
-                print("Genes {} and {} dot not match and will be skipped".format(geneA, geneB))
-                merged_table.drop(geneA, axis=1, inplace=True)
-            elif merging_action == "SUM":
-                merged_table.loc[indexA,geneA] += counts_tableB.loc[indexB, geneB]      
-            else:
-                merged_table.loc[indexA,geneA] += counts_tableB.loc[indexB, geneB]
-                merged_table.loc[indexA,geneA] /= 2
-    return merged_table
+    from scipy.spatial import cKDTree
+    merging_action = merging_action.upper()
+    if merging_action not in ["SUM", "AVG", "MEDIAN"]:
+        raise RuntimeError("Error, invalid merging action {}\n".format(merging_action))
+    if len(counts_tables) < 2:
+        raise RuntimeError("Error, at least two datasets are needed to merge\n")
+    counts_tables = [to_dense(counts) for counts in counts_tables]
+    reference = counts_tables[0]
+    # Genes present in all the datasets (keeping the order of the first one)
+    genes = reference.columns
+    for counts in counts_tables[1:]:
+        genes = genes[genes.isin(counts.columns)]
+    num_discarded = len(reference.columns) - len(genes)
+    if num_discarded > 0:
+        print("{} genes are not present in all the datasets "
+              "and will be skipped".format(num_discarded))
+    # Match the spots of every dataset to the spots of the first one
+    ref_coordinates = parse_spots(reference.index, datasets=False)[["x","y"]].values
+    matches = [np.arange(len(reference.index))]
+    matched = np.ones(len(reference.index), dtype=bool)
+    for counts in counts_tables[1:]:
+        tree = cKDTree(parse_spots(counts.index, datasets=False)[["x","y"]].values)
+        # The maximum norm (p=inf) so both coordinates must be within the tolerance
+        distances, neighbours = tree.query(ref_coordinates, k=1, p=np.inf,
+                                           distance_upper_bound=tolerance)
+        matched &= np.isfinite(distances)
+        matches.append(neighbours)
+    num_discarded = np.count_nonzero(~matched)
+    if num_discarded > 0:
+        print("{} spots do not match in all the datasets "
+              "and will be skipped".format(num_discarded))
+    # Stack the aligned counts (datasets x spots x genes) and merge them
+    merged_counts = np.stack([counts.loc[:,genes].values[index[matched]]
+                              for counts, index in zip(counts_tables, matches)])
+    if merging_action == "SUM":
+        merged_counts = merged_counts.sum(axis=0)
+    elif merging_action == "AVG":
+        merged_counts = merged_counts.mean(axis=0)
+    else:
+        merged_counts = np.median(merged_counts, axis=0)
+    return pd.DataFrame(merged_counts, index=reference.index[matched], columns=genes)
+
+def read_counts(counts_file, genes=None, use_sparse=False):
+    """ Reads a ST matrix of counts (genes as columns and spots as rows)
+    from a TSV file or from a binary matrix (see write_binary_counts()).
+    Binary matrices are memory mapped so only the genes requested
+    are actually read from disk.
+    :param counts_file: the path to the TSV file or to the binary matrix
+    :param genes: an optional list of genes to keep (the rest are not loaded)
+    :param use_sparse: True to return the counts in a sparse data frame
+    :return: a Pandas data frame with the counts
+    """
+    if os.path.isdir(counts_file):
+        return _read_binary_counts(counts_file, genes, use_sparse)
+    if not os.path.isfile(counts_file):
+        raise IOError("Error parsing data frame", "Invalid input file")
+    counts = pd.read_table(counts_file, sep="\t", header=0, index_col=0)
+    if genes is not None:
+        counts = counts.loc[:,counts.columns.isin(genes)]
+    return to_sparse(counts) if use_sparse else counts
+
+def _read_binary_counts(path, genes, use_sparse):
+    """ Helper function that loads a binary matrix
+    of counts with memory mapping (copy on write).
+    """
+    matrix, spots, columns = _read_binary_matrix(path, genes)
+    if use_sparse:
+        return sparse_frame(matrix, spots, columns)
+    if sp.issparse(matrix):
+        matrix = matrix.toarray()
+    return pd.DataFrame(matrix, index=spots, columns=columns, copy=False)
+
+def _read_binary_matrix(path, genes):
+    """ Helper function that loads the matrix (memory mapped), the spots 
+    and the genes of a binary matrix of counts. The matrix is a NumPy 
+    array or a scipy.sparse CSC matrix depending on how it was stored.
+    """
+    spots = np.load(os.path.join(path, "spots.npy"))
+    all_genes = pd.Index(np.load(os.path.join(path, "genes.npy")))
+    gene_indexes = None if genes is None else np.flatnonzero(all_genes.isin(genes))
+    columns = all_genes if gene_indexes is None else all_genes[gene_indexes]
+    dense_file = os.path.join(path, "counts.npy")
+    if os.path.isfile(dense_file):
+        # Genes are stored contiguously (column-major)
+        matrix = np.load(dense_file, mmap_mode="c")
+    else:
+        # Sparse matrices are stored in CSC format (genes are contiguous)
+        matrix = sp.csc_matrix((np.load(os.path.join(path, "data.npy"), mmap_mode="c"),
+                                np.load(os.path.join(path, "indices.npy"), mmap_mode="c"),
+                                np.load(os.path.join(path, "indptr.npy"), mmap_mode="c")),
+                               shape=(len(spots), len(all_genes)))
+    if gene_indexes is not None:
+        matrix = matrix[:,gene_indexes]
+    return matrix, spots, columns
+
+def read_genes(counts_file, genes=None):
+    """ Returns the genes (columns) of a ST matrix of counts
+    (TSV file or binary matrix) without reading the counts.
+    :param counts_file: the path to the TSV file or to the binary matrix
+    :param genes: an optional list of genes to keep
+    :return: a Pandas index with the genes
+    """
+    if os.path.isdir(counts_file):
+        columns = pd.Index(np.load(os.path.join(counts_file, "genes.npy")))
+    elif os.path.isfile(counts_file):
+        columns = pd.read_table(counts_file, sep="\t", header=0, index_col=0, nrows=0).columns
+    else:
+        raise IOError("Error parsing data frame", "Invalid input file")
+    return columns if genes is None else columns[columns.isin(genes)]
 
-def aggregate_datatasets(counts_table_files, plot_hist=False):
+def write_binary_counts(counts, path):
+    """ Writes a ST matrix of counts (genes as columns and spots as rows)
+    to a binary matrix (a folder of .npy files) that can be loaded
+    with read_counts() much faster than a TSV file. Dense data frames
+    are stored column-major and sparse data frames in CSC format
+    so the genes can be loaded individually.
+    :param counts: a Pandas data frame with the counts (dense or sparse)
+    :param path: the path to the output folder
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name in ["counts.npy", "data.npy", "indices.npy", "indptr.npy"]:
+        if os.path.isfile(os.path.join(path, name)):
+            os.remove(os.path.join(path, name))
+    np.save(os.path.join(path, "spots.npy"), np.array(counts.index, dtype=np.str_))
+    np.save(os.path.join(path, "genes.npy"), np.array(counts.columns, dtype=np.str_))
+    if is_sparse(counts):
+        matrix = sp.csc_matrix(counts.sparse.to_coo())
+        np.save(os.path.join(path, "data.npy"), matrix.data)
+        np.save(os.path.join(path, "indices.npy"), matrix.indices)
+        np.save(os.path.join(path, "indptr.npy"), matrix.indptr)
+    else:
+        np.save(os.path.join(path, "counts.npy"), np.asfortranarray(counts.values))
+
+def aggregate_datatasets(counts_table_files, plot_hist=False, use_sparse=False, genes=None,
+                         return_spots=False, num_workers=None):
     """ This functions takes a list of data frames with ST data
     (genes as columns and spots as rows) and merges them into
     one data frame using the genes as merging criteria. 
     An index will append to each spot to be able to identify
     them. Optionally, a histogram of the read/spots and gene/spots
     distributions can be generated for each dataset.
+    The datasets are read in parallel and the merged matrix
+    is allocated only once (see iterate_datasets() to process
+    the datasets one by one instead).
     :param counts_table_files: a list of file names of the datasets
+    (TSV files or binary matrices)
     :param plot_hist: True if we want to generate the histogram plots
-    :return: a Pandas data frame with the merged data frames
+    :param use_sparse: True to keep the counts in a sparse representation
+    (the TSV files are parsed by chunks of spots so only one chunk is 
+    dense in memory at a time)
+    :param genes: an optional list of genes to load (all if None)
+    :param return_spots: True to return also the parsed spots (see parse_spots())
+    :param num_workers: the number of datasets to read in parallel 
+    (the number of CPUs if None)
+    :return: a Pandas data frame with the merged data frames (and the parsed 
+    spots if return_spots is True)
     """
+    # The genes (columns) of the merged matrix
+    all_genes = _genes_union(counts_table_files, genes)
+    # The merged matrix is allocated once (dense) and each block is copied
+    # into it and released as soon as it is read
+    num_spots = sum(_count_spots(counts_file) for counts_file in counts_table_files)
+    values = None
+    sparse_blocks = list()
+    spots = list()
+    start = 0
     # Spots are rows and genes are columns
-    counts = pd.DataFrame()
-    sample_counts = dict()
-    for i,counts_file in enumerate(counts_table_files):
-        if not os.path.isfile(counts_file):
-            raise IOError("Error parsing data frame", "Invalid input file")
-        new_counts = pd.read_table(counts_file, sep="\t", header=0, index_col=0)
+    for i, (chunks, block_spots, columns) in _read_blocks(counts_table_files, genes, 
+                                                          use_sparse, num_workers):
         # Plot reads/genes distributions per spot
         if plot_hist:
-            histogram(x_points=new_counts.sum(axis=1).values,
-                      output=os.path.join(outdir, "hist_reads_{}.png".format(i)))
-            histogram(x_points=(new_counts != 0).sum(axis=1).values, 
-                      output=os.path.join(outdir, "hist_genes_{}.png".format(i)))
-        # Append dataset index to the spots (indexes) so they can be traced
-        new_spots = ["{0}_{1}".format(i, spot) for spot in new_counts.index]
-        new_counts.index = new_spots
-        counts = counts.append(new_counts)
-    # Replace Nan and Inf by zeroes
-    counts.replace([np.inf, -np.inf], np.nan)
-    counts.fillna(0.0, inplace=True)
+            from stanalysis.visualization import histogram
+            histogram(x_points=np.concatenate([np.asarray(matrix.sum(axis=1)).ravel() 
+                                               for matrix in chunks]),
+                      output="hist_reads_{}.png".format(i))
+            histogram(x_points=np.concatenate([np.asarray((matrix != 0).sum(axis=1)).ravel() 
+                                               for matrix in chunks]), 
+                      output="hist_genes_{}.png".format(i))
+        if start + len(block_spots) > num_spots:
+            raise RuntimeError("Error, the number of spots of the dataset {} "
+                               "is not valid\n".format(counts_table_files[i]))
+        while len(chunks) > 0:
+            matrix = chunks.pop(0)
+            end = start + matrix.shape[0]
+            if use_sparse:
+                sparse_blocks.append(_align_sparse_block(matrix, columns, all_genes))
+            else:
+                if values is None:
+                    values = np.zeros((num_spots, len(all_genes)), dtype=matrix.dtype)
+                elif not np.can_cast(matrix.dtype, values.dtype):
+                    values = values.astype(np.result_type(values.dtype, matrix.dtype))
+                _copy_dense_block(values[start:end], matrix, columns, all_genes)
+            start = end
+            del matrix
+        spots.extend(block_spots)
+    if use_sparse:
+        matrix = sp.vstack(sparse_blocks, format="csr") if len(sparse_blocks) > 0 \
+        else sp.csr_matrix((0, len(all_genes)))
+        del sparse_blocks
+        counts = sparse_frame(matrix, spots, all_genes)
+    else:
+        if values is None:
+            values = np.zeros((0, len(all_genes)), dtype=np.float64)
+        counts = pd.DataFrame(values[:start], index=spots, columns=all_genes, copy=False)
+    if return_spots:
+        return counts, parse_spots(counts.index)
     return counts
+
+def iterate_datasets(counts_table_files, use_sparse=False, genes=None, num_workers=None):
+    """ Streaming version of aggregate_datatasets(). It yields one data frame
+    for each dataset (with the index of the dataset appended to the spots and 
+    the union of the genes of all the datasets as columns) so the datasets 
+    can be processed one by one without building the merged matrix. 
+    At most num_workers datasets are read (in parallel) and kept in memory.
+    :param counts_table_files: a list of file names of the datasets
+    (TSV files or binary matrices)
+    :param use_sparse: True to keep the counts in a sparse representation
+    :param genes: an optional list of genes to load (all if None)
+    :param num_workers: the number of datasets to read in parallel 
+    (the number of CPUs if None)
+    :return: a generator of Pandas data frames (one per dataset)
+    """
+    all_genes = _genes_union(counts_table_files, genes)
+    for _, (chunks, spots, columns) in _read_blocks(counts_table_files, genes, 
+                                                     use_sparse, num_workers):
+        if use_sparse:
+            matrix = sp.vstack([_align_sparse_block(matrix, columns, all_genes) 
+                                for matrix in chunks], format="csr") if len(chunks) > 0 \
+            else sp.csr_matrix((0, len(all_genes)))
+            yield sparse_frame(matrix, spots, all_genes)
+        else:
+            values = np.zeros((len(spots), len(all_genes)), 
+                              dtype=np.result_type(*[matrix.dtype for matrix in chunks]) 
+                              if len(chunks) > 0 else np.float64)
+            start = 0
+            for matrix in chunks:
+                _copy_dense_block(values[start:start + matrix.shape[0]], matrix, columns, all_genes)
+                start += matrix.shape[0]
+            yield pd.DataFrame(values, index=spots, columns=all_genes, copy=False)
+
+def _genes_union(counts_table_files, genes):
+    """ Helper function that returns the union of the genes
+    of the datasets reading only the headers.
+    """
+    all_genes = None
+    for counts_file in counts_table_files:
+        columns = read_genes(counts_file, genes)
+        all_genes = columns if all_genes is None else all_genes.union(columns)
+    return pd.Index([]) if all_genes is None else all_genes
+
+def _count_spots(counts_file):
+    """ Helper function that returns the number of spots of a dataset
+    without parsing the counts (the non empty lines of a TSV file
+    minus the header or the spots of a binary matrix).
+    """
+    if os.path.isdir(counts_file):
+        return len(np.load(os.path.join(counts_file, "spots.npy"), mmap_mode="r"))
+    with open(counts_file, "rb") as filehandler:
+        return max(sum(1 for line in filehandler if line.strip()) - 1, 0)
+
+def _read_block(args, chunk_size=1000):
+    """ Helper function that reads a dataset as a (chunks, spots, genes)
+    block where the chunks are consecutive blocks of spots (NumPy arrays 
+    or scipy.sparse CSR matrices) and the index of the dataset is appended 
+    to the spots. TSV files are parsed by chunks of spots (converted to 
+    sparse right away if use_sparse is True) so the parser only keeps one
+    chunk in memory at a time.
+    """
+    i, counts_file, genes, use_sparse = args
+    if os.path.isdir(counts_file):
+        matrix, spots, columns = _read_binary_matrix(counts_file, genes)
+        if use_sparse:
+            matrix = sp.csr_matrix(matrix)
+        elif sp.issparse(matrix):
+            matrix = matrix.toarray()
+        chunks = [matrix]
+    else:
+        if not os.path.isfile(counts_file):
+            raise IOError("Error parsing data frame", "Invalid input file")
+        chunks = list()
+        spots = list()
+        columns = None
+        for counts in pd.read_table(counts_file, sep="\t", header=0, 
+                                    index_col=0, chunksize=chunk_size):
+            if genes is not None:
+                counts = counts.loc[:,counts.columns.isin(genes)]
+            columns = counts.columns
+            if len(counts.index) > 0:
+                chunks.append(sp.csr_matrix(counts.values) if use_sparse else counts.values)
+                spots.extend(counts.index)
+        if columns is None:
+            columns = read_genes(counts_file, genes)
+        if use_sparse and len(chunks) > 1:
+            chunks = [sp.vstack(chunks, format="csr")]
+    # Append dataset index to the spots (indexes) so they can be traced
+    spots = ["{0}_{1}".format(i, spot) for spot in spots]
+    return chunks, spots, columns
+
+def _read_blocks(counts_table_files, genes, use_sparse, num_workers):
+    """ Helper function that reads the datasets in parallel (threads as
+    the parsing releases the GIL and the binary matrices are memory mapped) 
+    and yields (index, block) tuples in the same order as the files.
+    Only num_workers datasets are read ahead and each block is released
+    by the pool as soon as it is yielded.
+    """
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    num_workers = max(min(num_workers, len(counts_table_files)), 1)
+    args = [(i, counts_file, genes, use_sparse) 
+            for i, counts_file in enumerate(counts_table_files)]
+    if num_workers == 1:
+        for arg in args:
+            yield arg[0], _read_block(arg)
+        return
+    pool = ThreadPool(num_workers)
+    try:
+        for start in range(0, len(args), num_workers):
+            chunk = args[start:start + num_workers]
+            for arg, block in zip(chunk, pool.imap(_read_block, chunk)):
+                yield arg[0], block
+                del block
+    finally:
+        pool.terminate()
+
+def _copy_dense_block(values, matrix, block_genes, genes):
+    """ Helper function that copies a dense block (spots as rows) into
+    the rows of the merged matrix using the given genes as columns
+    (missing genes are zero). Nan and Inf are replaced by zeroes.
+    """
+    if genes.equals(pd.Index(block_genes)):
+        values[:] = matrix
+    else:
+        values[:, genes.get_indexer(block_genes)] = matrix
+    if values.dtype.kind == "f":
+        values[~np.isfinite(values)] = 0.0
+
+def _align_sparse_block(matrix, block_genes, genes):
+    """ Helper function that returns a sparse block (spots as rows) as a
+    CSR matrix using the given genes as columns (missing genes are zero).
+    Nan and Inf are replaced by zeroes.
+    """
+    matrix = matrix.astype(np.float64).tocoo()
+    matrix.data[~np.isfinite(matrix.data)] = 0.0
+    cols = genes.get_indexer(block_genes)[matrix.col]
+    return sp.csr_matrix((matrix.data, (matrix.row, cols)),
+                         shape=(matrix.shape[0], len(genes)))
   
-def remove_noise(counts, num_exp_genes=0.01, num_exp_spots=0.01, min_expression=1):
+def remove_noise(counts, num_exp_genes=0.01, num_exp_spots=0.01, min_expression=1,
+                 spot_nnz=None):
     """This functions remove noisy genes and spots 
     for a given data frame (Genes as columns and spots as rows).
     - The noisy spots are removed so to keep a percentage
@@ -88,6 +488,8 @@ def remove_noise(counts, num_exp_genes=0.01, num_exp_spots=0.01, min_expression=
     The percentage is given as a parameter.
     - The noisy genes are removed so every gene that is expressed
     in less than 1% of the total spots. Expressed with a count >= 2. 
+    The statistics are computed in a single pass (see count_statistics())
+    and the filters are applied as masks (no transposes).
     :param counts: a Pandas data frame with the counts
     :param num_exp_genes: a float from 0-1 representing the % of 
     the distribution of expressed genes a spot must have to be kept
@@ -96,29 +498,151 @@ def remove_noise(counts, num_exp_genes=0.01, num_exp_spots=0.01, min_expression=
     than the parameter min_expression in order to be kept
     :param min_expression: the minimum expression for a gene to be
     considered expressed
+    :param spot_nnz: the number of genes expressed in each spot computed over
+    all the genes (see count_spot_genes()) when the counts contain only a subset 
+    of the genes (the spots are then filtered as if all the genes were loaded)
     :return: a new Pandas data frame with noisy spots/genes removed
     """
+    matrix = _count_rows(counts)
+    stats = count_statistics(matrix, min_expression=min_expression, moments=False)
+    num_spots, num_genes = matrix.shape
+    if spot_nnz is None:
+        spot_nnz = stats["spot_nnz"]
+    elif len(spot_nnz) != num_spots:
+        raise RuntimeError("Error, the number of spots of the counts "
+                           "and of spot_nnz do not match\n")
     
     # How many spots do we keep based on the number of genes expressed?
-    num_spots = len(counts.index)
-    num_genes = len(counts.columns)
-    min_genes_spot_exp = round((counts != 0).sum(axis=1).quantile(num_exp_genes))
+    genes_per_spot = pd.Series(spot_nnz)
+    min_genes_spot_exp = round(genes_per_spot.quantile(num_exp_genes))
     print("Number of expressed genes a spot must have to be kept " \
     "({}% of total expressed genes) {}".format(num_exp_genes, min_genes_spot_exp))
-    counts = counts[(counts != 0).sum(axis=1) >= min_genes_spot_exp]
-    print("Dropped {} spots".format(num_spots - len(counts.index)))
-          
-    # Spots are columns and genes are rows
-    counts = counts.transpose()
-  
-    # Remove noisy genes
-    min_features_gene = round(len(counts.columns) * num_exp_spots) 
+    keep_spots = np.asarray(spot_nnz) >= min_genes_spot_exp
+    num_kept_spots = np.count_nonzero(keep_spots)
+    print("Dropped {} spots".format(num_spots - num_kept_spots))
+    
+    # Remove noisy genes (the dropped spots are discounted)
+    min_features_gene = round(num_kept_spots * num_exp_spots) 
     print("Removing genes that are expressed in less than {} " \
     "spots with a count of at least {}".format(min_features_gene, min_expression))
-    counts = counts[(counts >= min_expression).sum(axis=1) >= min_features_gene]
-    print("Dropped {} genes".format(num_genes - len(counts.index)))
+    spots_per_gene = stats["gene_expressed"]
+    if num_kept_spots < num_spots:
+        spots_per_gene = spots_per_gene - count_statistics(
+            matrix[~keep_spots], min_expression=min_expression, moments=False)["gene_expressed"]
+    keep_genes = spots_per_gene >= min_features_gene
+    print("Dropped {} genes".format(num_genes - np.count_nonzero(keep_genes)))
     
-    return counts.transpose()
+    if is_sparse(counts):
+        return sparse_frame(matrix[keep_spots][:,keep_genes], counts.index[keep_spots], 
+                            counts.columns[keep_genes])
+    return counts.iloc[keep_spots, keep_genes]
+
+def count_spot_genes(counts_table_files, block_size=1000):
+    """ Returns the number of genes expressed (not 0) in each spot of the
+    datasets over all their genes, in the same order as the spots of 
+    aggregate_datatasets(). Only the indices of the sparse binary matrices 
+    are read (dense binary matrices are read by blocks of genes) so it is 
+    cheap to compute even when only a few genes are loaded afterwards.
+    :param counts_table_files: a list of file names of the datasets
+    (TSV files or binary matrices)
+    :param block_size: the number of genes of each block (dense binary matrices)
+    :return: a NumPy array with the number of genes expressed in each spot
+    """
+    spot_nnz = list()
+    for counts_file in counts_table_files:
+        if os.path.isdir(counts_file):
+            num_spots = _count_spots(counts_file)
+            dense_file = os.path.join(counts_file, "counts.npy")
+            if os.path.isfile(dense_file):
+                matrix = np.load(dense_file, mmap_mode="r")
+                nnz = np.zeros(num_spots, dtype=np.int64)
+                for start in range(0, matrix.shape[1], block_size):
+                    nnz += np.count_nonzero(matrix[:,start:start + block_size], axis=1)
+            else:
+                data = np.load(os.path.join(counts_file, "data.npy"), mmap_mode="r")
+                indices = np.load(os.path.join(counts_file, "indices.npy"), mmap_mode="r")
+                # Explicit zeros are not counted
+                nnz = np.bincount(indices[data != 0], minlength=num_spots)
+        else:
+            nnz = count_statistics(read_counts(counts_file, use_sparse=True), 
+                                   moments=False)["spot_nnz"]
+        spot_nnz.append(nnz)
+    return np.concatenate(spot_nnz) if len(spot_nnz) > 0 else np.zeros(0, dtype=np.int64)
+
+def count_statistics(counts, min_expression=1, block_size=1000, moments=True):
+    """ Computes the statistics of the spots and the genes of a matrix of counts
+    (genes as columns and spots as rows) in a single streaming pass over
+    blocks of spots so only one dense block is in memory at a time.
+    The means and the sums of squares of the genes are merged block by
+    block (Chan et al) so the variances are numerically stable.
+    :param counts: a Pandas data frame (dense or sparse), NumPy array
+    or scipy.sparse matrix with the counts
+    :param min_expression: the minimum count for a gene to be considered expressed
+    :param block_size: the number of spots of each block
+    :param moments: False to skip the sums, means and sums of squares
+    :return: a dictionary of NumPy arrays with the number of genes
+    expressed (not 0) in each spot (spot_nnz), the number of spots where each 
+    gene is not 0 (gene_nnz) and has a count >= min_expression (gene_expressed),
+    the sum (gene_sum), the mean (gene_mean) and the sum of squared deviations
+    from the mean (gene_m2) of each gene and the number of spots (num_spots)
+    """
+    matrix = _count_rows(counts)
+    num_spots, num_genes = matrix.shape
+    spot_nnz = np.zeros(num_spots, dtype=np.int64)
+    gene_nnz = np.zeros(num_genes, dtype=np.int64)
+    gene_expressed = np.zeros(num_genes, dtype=np.int64)
+    gene_mean = np.zeros(num_genes)
+    gene_m2 = np.zeros(num_genes)
+    seen = 0
+    for start in range(0, num_spots, block_size):
+        end = min(start + block_size, num_spots)
+        block = matrix[start:end]
+        size = end - start
+        if sp.issparse(block):
+            spot_nnz[start:end] = block.getnnz(axis=1)
+            gene_nnz += np.bincount(block.indices, minlength=num_genes)
+            if min_expression > 0:
+                gene_expressed += np.bincount(block.indices[block.data >= min_expression],
+                                              minlength=num_genes)
+            else:
+                gene_expressed += size
+            if not moments:
+                continue
+            block_mean = np.asarray(block.sum(axis=0)).ravel() / size
+            block_m2 = np.asarray(block.multiply(block).sum(axis=0)).ravel() \
+            - size * block_mean ** 2
+        else:
+            nonzero = block != 0
+            spot_nnz[start:end] = np.count_nonzero(nonzero, axis=1)
+            gene_nnz += np.count_nonzero(nonzero, axis=0)
+            gene_expressed += np.count_nonzero(block >= min_expression, axis=0)
+            if not moments:
+                continue
+            block_mean = block.mean(axis=0)
+            block_m2 = ((block - block_mean) ** 2).sum(axis=0, dtype=np.float64)
+        delta = block_mean - gene_mean
+        total = seen + size
+        gene_mean += delta * size / total
+        gene_m2 += block_m2 + delta ** 2 * seen * size / total
+        seen = total
+    return {"num_spots" : num_spots,
+            "spot_nnz" : spot_nnz,
+            "gene_nnz" : gene_nnz,
+            "gene_expressed" : gene_expressed,
+            "gene_sum" : gene_mean * num_spots,
+            "gene_mean" : gene_mean,
+            "gene_m2" : gene_m2}
+
+def _count_rows(counts):
+    """ Helper function that returns the counts of a Pandas data frame 
+    (dense or sparse) as a NumPy array or a CSR matrix (spots as rows)
+    without copying the dense data.
+    """
+    if sp.issparse(counts):
+        return sp.csr_matrix(counts)
+    if isinstance(counts, pd.DataFrame):
+        return sparse_matrix(counts) if is_sparse(counts) else counts.values
+    return np.asarray(counts)
     
 def keep_top_genes(counts, num_genes_keep, criteria="Variance"):
     """ This function takes a Pandas data frame
@@ -130,56 +654,115 @@ def keep_top_genes(counts, num_genes_keep, criteria="Variance"):
     :param criteria: the criteria used to select ("Variance or "TopRanked")
     :return: a new Pandas data frame with only the top ranked genes. 
     """
-    # Spots as columns and genes as rows
-    counts = counts.transpose()
     # Keep only the genes with higher over-all variance
-    num_genes = len(counts.index)
+    num_genes = len(counts.columns)
     print("Removing {}% of genes based on the {}".format(num_genes_keep * 100, criteria))
+    if criteria not in ["Variance", "TopRanked"]:
+        raise RuntimeError("Error, incorrect criteria method\n")
+    stats = count_statistics(counts)
     if criteria == "Variance":
-        min_genes_spot_var = counts.var(axis=1).quantile(num_genes_keep)
+        genes_spot_var = pd.Series(_variance(stats))
+        min_genes_spot_var = genes_spot_var.quantile(num_genes_keep)
         if math.isnan(min_genes_spot_var):
             print("Computed variance is NaN! Check your normalization factors..")
         else:
             print("Min normalized variance a gene must have over all spots " \
             "to be kept ({0}% of total) {1}".format(num_genes_keep, min_genes_spot_var))
-            counts = counts[counts.var(axis=1) >= min_genes_spot_var]
-    elif criteria == "TopRanked":
-        min_genes_spot_sum = counts.sum(axis=1).quantile(num_genes_keep)
-        if math.isnan(min_genes_spot_var):
+            counts = counts.iloc[:,(genes_spot_var >= min_genes_spot_var).values]
+    else:
+        genes_spot_sum = pd.Series(stats["gene_sum"])
+        min_genes_spot_sum = genes_spot_sum.quantile(num_genes_keep)
+        if math.isnan(min_genes_spot_sum):
             print("Computed sum is NaN! Check your normalization factors..")
         else:
             print("Min normalized total count a gene must have over all spots " \
             "to be kept ({0}% of total) {1}".format(num_genes_keep, min_genes_spot_sum))
-            counts = counts[counts.sum(axis=1) >= min_genes_spot_var]
-    else:
-        raise RunTimeError("Error, incorrect criteria method\n")  
-    print("Dropped {} genes".format(num_genes - len(counts.index)))
-    return counts.transpose()
+            counts = counts.iloc[:,(genes_spot_sum >= min_genes_spot_sum).values]
+    print("Dropped {} genes".format(num_genes - len(counts.columns)))
+    return counts
+
+def gene_sum(counts):
+    """ Computes the total count of each gene (column)
+    for a dense or sparse data frame.
+    :param counts: a Pandas data frame with the counts
+    :return: a Pandas series with the sum of each gene
+    """
+    if is_sparse(counts):
+        matrix = sparse_matrix(counts)
+        return pd.Series(np.asarray(matrix.sum(axis=0)).ravel(), index=counts.columns)
+    return counts.sum(axis=0)
+
+def spot_sum(counts):
+    """ Computes the total count of each spot (row)
+    for a dense or sparse data frame.
+    :param counts: a Pandas data frame with the counts
+    :return: a Pandas series with the sum of each spot
+    """
+    if is_sparse(counts):
+        matrix = sparse_matrix(counts)
+        return pd.Series(np.asarray(matrix.sum(axis=1)).ravel(), index=counts.index)
+    return counts.sum(axis=1)
+
+def gene_variance(counts):
+    """ Computes the (unbiased) variance of each gene (column)
+    for a dense or sparse data frame (see count_statistics()).
+    :param counts: a Pandas data frame with the counts
+    :return: a Pandas series with the variance of each gene
+    """
+    return pd.Series(_variance(count_statistics(counts)), index=counts.columns)
+
+def _variance(stats):
+    """ Helper function that returns the unbiased variance
+    of the genes from the statistics of count_statistics()
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.maximum(stats["gene_m2"], 0.0) / (stats["num_spots"] - 1)
 
-def compute_size_factors(counts, normalization, scran_clusters=True):
+def compute_size_factors(counts, normalization, scran_clusters=True, use_r=False, clusters=None,
+                         use_cache=False):
     """ Helper function to compute normalization
-    size factors"""
-    counts = counts.transpose()
+    size factors. The DESeq2, TMM, RLE and Scran factors are computed natively
+    unless use_r is True. Scran can be given the clusters of the spots
+    (see quickClusters()) so they are not computed again. 
+    If use_cache is True the factors are stored in the on-disk cache
+    (see stanalysis.cache) so they are not computed again for the same counts"""
+    if use_cache:
+        # The clusters are only used (and part of the key) in Scran
+        scran = normalization == "Scran"
+        key = fingerprint("size_factors", counts, normalization, use_r,
+                          scran_clusters if scran else None,
+                          np.asarray(clusters) if scran and clusters is not None else None)
+        size_factors = cache_get(key)
+        if size_factors is None:
+            size_factors = compute_size_factors(counts, normalization, scran_clusters, 
+                                                use_r, clusters)
+            cache_put(key, size_factors)
+        return size_factors
+    if is_sparse(counts) and normalization not in ["REL", "RAW", "DESeq2", "TMM", "RLE", "Scran"]:
+        # The rest of the methods need the dense counts
+        counts = to_dense(counts)
+    # Spots as columns and genes as rows
+    counts_t = sparse_matrix(counts).transpose() if is_sparse(counts) else counts.transpose()
     if normalization in "DESeq2":
-        size_factors = computeSizeFactors(counts)
+        size_factors = computeSizeFactors(counts_t, use_r)
     elif normalization in "DESeq2Linear":
-        size_factors = computeSizeFactorsLinear(counts)
+        size_factors = computeSizeFactorsLinear(counts_t)
     elif normalization in "DESeq2PseudoCount":
-        size_factors = computeSizeFactors(counts + 1)
+        size_factors = computeSizeFactors(counts_t + 1, use_r)
     elif normalization in "DESeq2SizeAdjusted":
-        size_factors = computeSizeFactorsSizeAdjusted(counts)
+        size_factors = computeSizeFactorsSizeAdjusted(counts_t, use_r)
     elif normalization in "TMM":
-        size_factors = computeTMMFactors(counts)
+        size_factors = computeTMMFactors(counts_t, use_r)
     elif normalization in "RLE":
-        size_factors = computeRLEFactors(counts)
+        size_factors = computeRLEFactors(counts_t, use_r)
     elif normalization in "REL":
-        size_factors = counts.sum(axis=0)
+        size_factors = spot_sum(counts)
     elif normalization in "RAW":
         size_factors = 1
     elif normalization in "Scran":
-        size_factors = computeSumFactors(counts, scran_clusters)         
+        size_factors = computeSumFactors(counts_t, scran_clusters, use_r, clusters)
     else:
-        raise RunTimeError("Error, incorrect normalization method\n")
+        raise RuntimeError("Error, incorrect normalization method\n")
     if np.isnan(size_factors).any() or np.isinf(size_factors).any():
         print("Warning: Computed size factors contained NaN or Inf."
               "\nThey will be replaced by 1.0!")
@@ -191,7 +774,8 @@ def compute_size_factors(counts, normalization, scran_clusters=True):
         size_factors[size_factors <= 0.0] = 1.0     
     return size_factors
 
-def normalize_data(counts, normalization, center=False, adjusted_log=False):
+def normalize_data(counts, normalization, center=False, adjusted_log=False, use_r=False,
+                   clusters=None, use_cache=False):
     """This functions takes a data frame as input
     with ST data (genes as columns and spots as rows) and 
     returns a data frame with the normalized counts using
@@ -201,12 +785,46 @@ def normalize_data(counts, normalization, center=False, adjusted_log=False):
     :param center: if True the size factors will be centered by their mean
     :param adjusted_log: return adjusted logged normalized counts if True
     (DESeq2, DESeq2Linear, DESeq2PseudoCount, DESeq2SizeAdjusted,RLE, REL, RAW, TMM, Scran)
+    :param use_r: compute the size factors with R instead of natively
+    :param clusters: the clusters of the spots for Scran (computed if None),
+    ignored by the rest of the methods
+    :param use_cache: if True the size factors and the normalized counts are
+    stored in the on-disk cache (see stanalysis.cache) so they are not computed 
+    again for the same counts and options
     :return: a Pandas data frame with the normalized counts (genes as columns)
     """
+    if not use_cache:
+        return _normalize_data(counts, normalization, center, adjusted_log, use_r, clusters)
+    # The clusters are only used (and part of the key) in Scran
+    key = fingerprint("normalize_data", counts, normalization, center, adjusted_log, use_r,
+                      np.asarray(clusters) if normalization == "Scran" and clusters is not None 
+                      else None)
+    norm_counts = cache_get(key)
+    if norm_counts is None:
+        norm_counts = _normalize_data(counts, normalization, center, adjusted_log, 
+                                      use_r, clusters, use_cache)
+        if norm_counts is not counts:
+            cache_put(key, norm_counts)
+    return norm_counts
+
+def _normalize_data(counts, normalization, center, adjusted_log, use_r, clusters, 
+                    use_cache=False):
+    """ Same as normalize_data() without the cache of the normalized counts
+    """
     # Compute the size factors
-    size_factors = compute_size_factors(counts, normalization)
+    size_factors = compute_size_factors(counts, normalization, use_r=use_r, clusters=clusters,
+                                        use_cache=use_cache)
     if np.all(size_factors == 1.0):
         return counts
+    if is_sparse(counts):
+        if not adjusted_log:
+            # Divide each spot (row) by its factor keeping the sparsity
+            size_factors = np.asarray(size_factors, dtype=np.float64)
+            if center:
+                size_factors = size_factors / np.mean(size_factors)
+            norm_counts = sp.diags(1.0 / size_factors).dot(sparse_matrix(counts))
+            return sparse_frame(norm_counts, counts.index, counts.columns)
+        counts = to_dense(counts)
     # Spots as columns and genes as rows
     counts = counts.transpose()
     # Center and/or adjust log the size_factors and counts
@@ -219,7 +837,7 @@ def normalize_data(counts, normalization, center=False, adjusted_log=False):
     # return normalize counts (genes as columns)
     return norm_counts.transpose()
     
-def normalize_samples(counts, number_datasets):
+def normalize_samples(counts, number_datasets=None):
     """ This function takes a data frame
     with ST data (genes as columns and spots as rows)
     that is composed by several datasets (the index
@@ -230,43 +848,35 @@ def normalize_samples(counts, number_datasets):
     it will apply the factors to each dataset. 
     :param counts: a Pandas dataframe conposed of several ST Datasets
     :param number_datasets: the number of different datasets merged in the input data frame
+    (not needed as the datasets are obtained from the spots)
     :return: the same dataframe as input with the counts normalized
     """
-    # First store the aggregated gene counts for each dataset in a dictionary
-    sample_counts = dict()
-    tot_spots = counts.index
-    for i in xrange(number_datasets):
-        spots_to_keep = [spot for spot in tot_spots if spot.startswith("{}_".format(i))]
-        slice_counts = counts.loc[spots_to_keep]
-        sample_counts[i] = slice_counts.sum(axis=0)
-        
-    # Now build up a data frame with the accumulated gene counts for
-    # each sample
-    per_sample_factors = pd.DataFrame(index=sample_counts.keys(), columns=counts.columns)
-    for key,value in sample_counts.iteritems():
-        per_sample_factors.loc[key] = value
+    datasets = pd.Categorical(parse_spots(counts.index)["dataset"].values)
+    # Aggregated gene counts for each dataset (datasets as rows)
+    if is_sparse(counts):
+        indicator = sp.csr_matrix((np.ones(len(datasets.codes)), 
+                                   (datasets.codes, np.arange(len(datasets.codes)))),
+                                  shape=(len(datasets.categories), len(datasets.codes)))
+        per_sample_counts = indicator.dot(sparse_matrix(counts)).toarray()
+    else:
+        per_sample_counts = np.array(counts.groupby(datasets).sum().values, dtype=np.float64)
     # Replace Nan and Inf by zeroes
-    per_sample_factors.replace([np.inf, -np.inf], np.nan)
-    per_sample_factors.fillna(0.0, inplace=True)
-    
-    # Spots are columns and genes are rows
-    per_sample_factors = per_sample_factors.transpose()
+    per_sample_counts[~np.isfinite(per_sample_counts)] = 0.0
     
     # Compute normalization factors for each dataset(sample) using DESeq 
-    per_sample_size_factors = computeSizeFactors(per_sample_factors)
+    # (spots are columns and genes are rows)
+    per_sample_size_factors = computeSizeFactors(per_sample_counts.transpose())
     
     # Now use the factors per sample to normalize genes in each sample
     # one factor per sample so we divide every gene count of each sample by its factor
-    for spot in counts.index:
-        # spot is i_XxY
-        tokens = spot.split("x")
-        assert(len(tokens) == 2)
-        index = int(tokens[0].split("_")[0])
-        factor = per_sample_size_factors[index]
-        counts.loc[spot] = counts.loc[spot] / factor
-        
+    spot_factors = np.asarray(per_sample_size_factors, dtype=np.float64)[datasets.codes]
+    if is_sparse(counts):
+        norm_counts = sp.diags(1.0 / spot_factors).dot(sparse_matrix(counts)).tocoo()
+        # Replace Nan and Inf by zeroes
+        norm_counts.data[~np.isfinite(norm_counts.data)] = 0.0
+        return sparse_frame(norm_counts, counts.index, counts.columns)
+    norm_counts = counts.div(spot_factors, axis=0)
     # Replace Nan and Inf by zeroes
-    counts.replace([np.inf, -np.inf], np.nan)
-    counts.fillna(0.0, inplace=True)
-        
-    return counts
\ No newline at end of file
+    norm_counts.replace([np.inf, -np.inf], np.nan, inplace=True)
+    norm_counts.fillna(0.0, inplace=True)
+    return norm_counts
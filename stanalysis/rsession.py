@@ -0,0 +1,277 @@
+"""
+R session management for the st analysis package.
+All the calls to R (rpy2) are executed through this module
+in one or several worker processes (R sessions) that
+are started once and re-used. The R libraries are loaded
+only once in each session and the pandas converter is only
+active while a call is being executed.
+"""
+import os
+import atexit
+import pickle
+import tempfile
+import traceback
+import threading
+import multiprocessing
+import numpy as np
+import scipy.sparse as sp
+
+# Number of R worker processes (0 means R runs in the calling process)
+_num_workers = int(os.environ.get("STANALYSIS_R_WORKERS", 1))
+_pool = None
+_pool_lock = threading.Lock()
+# Loaded R libraries in this process
+_libraries = dict()
+_parallel_registered = False
+
+def set_r_workers(num_workers):
+    """ Sets the number of R worker processes (R sessions)
+    that can execute R calls concurrently. If 0 the R calls
+    are executed in the calling process. Running sessions
+    are closed so the new number takes effect in the next call.
+    :param num_workers: the number of worker processes (>= 0)
+    """
+    global _num_workers
+    if num_workers < 0:
+        raise RuntimeError("Error, the number of R workers must be >= 0\n")
+    close_r_session()
+    _num_workers = num_workers
+
+def r_workers():
+    """ Returns the number of R worker processes (R sessions)
+    that can execute R calls concurrently (0 if the R calls are
+    executed in the calling process).
+    """
+    return _num_workers
+
+def close_r_session():
+    """ Terminates the R worker processes (if any).
+    """
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+
+atexit.register(close_r_session)
+
+def _init_worker():
+    """ Initializes the R session in a worker process
+    (the cores are shared if there are several R workers).
+    """
+    if _num_workers > 1:
+        _register_parallel()
+
+def _register_parallel():
+    """ Registers the BiocParallel backend once per session
+    sharing the cores among the R workers (otherwise the
+    default backend of BiocParallel is used).
+    """
+    global _parallel_registered
+    if not _parallel_registered:
+        multicore = RimportLibrary("BiocParallel")
+        cores = max((multiprocessing.cpu_count() - 1) // max(_num_workers, 1), 1)
+        multicore.register(multicore.MulticoreParam(cores))
+        _parallel_registered = True
+
+def _execute(func, args, kwargs):
+    """ Executes a function in the R session. The errors keep their
+    type (the traceback of the worker is attached by multiprocessing).
+    Errors that cannot be sent back to the calling process (not picklable)
+    are re-raised as RuntimeError with the traceback of the R session.
+    """
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        if _num_workers == 0:
+            raise
+        try:
+            pickle.loads(pickle.dumps(e))
+        except Exception:
+            raise RuntimeError("Error in R call {}: {}\n{}".format(func.__name__, str(e), 
+                                                                  traceback.format_exc()))
+        raise
+
+def r_call_async(func, *args, **kwargs):
+    """ Executes a function that makes use of R in one of the
+    R worker processes without blocking. The function must be
+    defined at module level and its arguments and return
+    value must be Python (picklable) objects.
+    :param func: the function to execute
+    :return: an object with a get() method that returns the result
+    """
+    global _pool
+    if _num_workers == 0:
+        return _Result(_execute(func, args, kwargs))
+    with _pool_lock:
+        if _pool is None:
+            _pool = multiprocessing.Pool(_num_workers, initializer=_init_worker)
+    return _pool.apply_async(_execute, (func, args, kwargs))
+
+def r_call(func, *args, **kwargs):
+    """ Executes a function that makes use of R in one of the
+    R worker processes and returns its result (see r_call_async()).
+    :param func: the function to execute
+    :return: the value returned by the function
+    """
+    return r_call_async(func, *args, **kwargs).get()
+
+class _Result(object):
+    """ Result of a call executed in the calling process
+    """
+    def __init__(self, value):
+        self.value = value
+    def get(self, timeout=None):
+        return self.value
+
+def RimportLibrary(lib_name):
+    """ Helper function to import R libraries
+    using the rpy2 binder. The libraries are
+    loaded once per R session. Missing libraries
+    are installed with BiocManager if it is installed.
+    """
+    if lib_name not in _libraries:
+        import rpy2.robjects.packages as rpackages
+        if not rpackages.isinstalled(lib_name):
+            if not rpackages.isinstalled("BiocManager"):
+                raise RuntimeError("Error, the R library {0} is not installed. Install it in R "
+                                   "with install.packages(\"BiocManager\") and "
+                                   "BiocManager::install(\"{0}\")\n".format(lib_name))
+            biocmanager = rpackages.importr("BiocManager")
+            biocmanager.install(lib_name, update=False, ask=False)
+            if not rpackages.isinstalled(lib_name):
+                raise RuntimeError("Error, the R library {} could not be installed "
+                                   "with BiocManager\n".format(lib_name))
+        _libraries[lib_name] = rpackages.importr(lib_name)
+    return _libraries[lib_name]
+
+def r_converter():
+    """ Returns a context manager that enables the automatic conversion
+    between Pandas and R objects only during its scope.
+    """
+    from rpy2.robjects import default_converter, pandas2ri
+    from rpy2.robjects.conversion import localconverter
+    return localconverter(default_converter + pandas2ri.converter)
+
+def _shared_dir():
+    """ Returns the folder used to share matrices with the
+    R workers (in memory if possible).
+    """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+class SharedMatrix(object):
+    """ A matrix (NumPy array, Pandas data frame or scipy.sparse matrix)
+    to be sent to R. The matrix is stored contiguously (column-major) as
+    float64 or int32 and shared with the R workers through a memory mapped
+    file so it is not pickled. In the R session to_r() creates the R matrix
+    with dimnames copying the data only once.
+    Use it as a context manager so the shared file is removed:
+
+        with SharedMatrix(counts) as r_counts:
+            r_call(func, r_counts)
+    """
+    def __init__(self, values, rownames=None, colnames=None):
+        if hasattr(values, "columns"):
+            rownames = list(values.index) if rownames is None else rownames
+            colnames = list(values.columns) if colnames is None else colnames
+            values = values.values
+        elif sp.issparse(values):
+            values = values.toarray()
+        values = np.asarray(values)
+        dtype = np.int32 if values.dtype.kind in "iub" and (values.size == 0 \
+        or np.abs(values).max() < np.iinfo(np.int32).max) else np.float64
+        self.shape = values.shape
+        self.rownames = None if rownames is None else [str(x) for x in rownames]
+        self.colnames = None if colnames is None else [str(x) for x in colnames]
+        self.path = None
+        self.values = np.asfortranarray(values, dtype=dtype)
+        if _num_workers > 0:
+            fd, self.path = tempfile.mkstemp(suffix=".npy", dir=_shared_dir())
+            with os.fdopen(fd, "wb") as filehandler:
+                np.save(filehandler, self.values)
+            self.values = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """ Removes the shared file (called in the main process)
+        """
+        if self.path is not None and os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def load(self):
+        """ Returns the matrix as a NumPy array (memory mapped
+        in the R workers)
+        """
+        if self.values is not None:
+            return self.values
+        return np.load(self.path, mmap_mode="r")
+
+    def to_r(self, rows=None):
+        """ Creates the R matrix with dimnames (executed in the R session)
+        :param rows: an optional (start, end) tuple to create the R matrix
+        only with those rows
+        """
+        from rpy2 import rinterface
+        values = self.load()
+        rownames = self.rownames
+        if rows is not None:
+            values = values[rows[0]:rows[1]]
+            rownames = None if rownames is None else rownames[rows[0]:rows[1]]
+        flat = values.ravel(order="F")
+        if values.dtype == np.int32:
+            vector_type, kind = rinterface.IntSexpVector, rinterface.INTSXP
+        else:
+            vector_type, kind = rinterface.FloatSexpVector, rinterface.REALSXP
+        if hasattr(vector_type, "from_memoryview"):
+            r_vector = vector_type.from_memoryview(memoryview(np.ascontiguousarray(flat)))
+        else:
+            r_vector = rinterface.SexpVector(flat, kind)
+        # Set the attributes in place so R does not duplicate the matrix
+        r_vector.do_slot_assign("dim", rinterface.IntSexpVector(list(values.shape)))
+        if rownames is not None or self.colnames is not None:
+            dimnames = [rinterface.NULL if names is None else rinterface.StrSexpVector(names)
+                        for names in [rownames, self.colnames]]
+            r_vector.do_slot_assign("dimnames", rinterface.ListSexpVector(dimnames))
+        return r_vector
+
+def r_to_numpy(r_object):
+    """ Returns a numeric R vector or matrix as a NumPy
+    array without copying the data when possible (the array
+    is a view of the R memory).
+    :param r_object: a numeric R vector or matrix
+    :return: a NumPy array (2D for matrices)
+    """
+    values = np.asarray(r_object)
+    try:
+        dims = list(r_object.do_slot("dim"))
+    except LookupError:
+        return values
+    return values.reshape(dims, order="F")
+
+def r_serialize(r_object):
+    """ Serializes an R object to bytes (executed in the R session)
+    so it can be sent to another R session (see r_unserialize()).
+    :param r_object: an R object
+    :return: the serialized object (bytes)
+    """
+    from rpy2.robjects import r
+    raw = r["serialize"](r_object, r("NULL"))
+    return np.asarray(raw).view(np.uint8).tobytes()
+
+def r_unserialize(data):
+    """ Creates an R object from bytes (see r_serialize())
+    (executed in the R session).
+    :param data: the serialized object (bytes)
+    :return: the R object
+    """
+    from rpy2 import rinterface
+    from rpy2.robjects import r
+    return r["unserialize"](rinterface.ByteSexpVector(data))
+
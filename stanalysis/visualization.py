@@ -28,9 +28,9 @@ def volcano(dea_results, fdr, outfile):
     colors = ["red" if p <= fdr else "blue" for p in dea_results["padj"]]
     x_points = dea_results["log2FoldChange"]
     y_points = -np.log10(dea_results["pvalue"])
-    x_points_conf = dea_results.ix[dea_results["padj"] <= fdr]["log2FoldChange"]
-    y_points_conf = -np.log10(dea_results.ix[dea_results["padj"] <= fdr]["pvalue"])
-    names_conf = dea_results.ix[dea_results["padj"] <= fdr].index
+    x_points_conf = dea_results.loc[dea_results["padj"] <= fdr]["log2FoldChange"]
+    y_points_conf = -np.log10(dea_results.loc[dea_results["padj"] <= fdr]["pvalue"])
+    names_conf = dea_results.loc[dea_results["padj"] <= fdr].index
     # Scale axes
     OFFSET = 0.1
     a.set_xlim([min(x_points) - OFFSET, max(x_points) + OFFSET])
@@ -70,7 +70,7 @@ def histogram(x_points, output, title="Histogram", xlabel="X", color="blue"):
 
     # Tweak spacing to prevent clipping of ylabel
     plt.subplots_adjust(left=0.15)
-    fig.savefig("{}.pdf".format(os.path.splitext(os.path.basename(output))[0]), 
+    fig.savefig("{}.pdf".format(os.path.splitext(output)[0]), 
                 format='pdf', dpi=300)
     
 def scatter_plot3d(x_points, y_points, z_points, output=None,
@@ -123,7 +123,7 @@ def scatter_plot3d(x_points, y_points, z_points, output=None,
     a.set_title(title, size=10)
     # Save or show the plot
     if output is not None:
-        fig.savefig("{}.pdf".format(os.path.splitext(os.path.basename(output))[0]), 
+        fig.savefig("{}.pdf".format(os.path.splitext(output)[0]), 
                     format='pdf', dpi=300)
     else:
         fig.show()
@@ -200,7 +200,7 @@ def scatter_plot(x_points, y_points, output=None, colors=None,
         plt.colorbar(sc)
     # Save or show the plot
     if output is not None:
-        fig.savefig("{}.pdf".format(os.path.splitext(os.path.basename(output))[0]), 
+        fig.savefig("{}.pdf".format(os.path.splitext(output)[0]), 
                     format='pdf', dpi=180)
     else:
         fig.show()
\ No newline at end of file
@@ -0,0 +1,254 @@
+""" 
+Tests of the analysis functions of the st analysis package.
+The expected results of the negative binomial GLMs were computed 
+fitting each gene separately (the dispersions, the trend and the 
+coefficients maximizing the likelihoods with scipy.optimize).
+"""
+import unittest
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.stats import norm, false_discovery_control, mannwhitneyu, ttest_ind
+from sklearn.manifold import trustworthiness
+from sklearn.neighbors import NearestNeighbors
+from sklearn.decomposition import PCA
+from stanalysis.analysis import tsne, Rtsne, deaNegativeBinomial, deaDESeq2, \
+deaWilcoxon, deaTTest, computePCA
+from stanalysis.normalization import computeSizeFactors
+from tests.test_normalization import r_library
+
+def blobs(n_spots=50, n_genes=20, n_clusters=3, random_state=0):
+    """ Returns the points of n_clusters Gaussian clusters 
+    (spots as rows) and the cluster of each spot
+    """
+    random = np.random.RandomState(random_state)
+    centers = random.normal(0.0, 5.0, size=(n_clusters, n_genes))
+    labels = np.repeat(np.arange(n_clusters), n_spots)
+    return centers[labels] + random.normal(size=(len(labels), n_genes)), labels
+
+def neighbours_accuracy(points, labels):
+    """ Returns the fraction of spots whose 5 nearest neighbours
+    (majority) belong to their cluster (leave one out)
+    """
+    neighbours = NearestNeighbors(n_neighbors=6).fit(points).kneighbors(
+        points, return_distance=False)[:,1:]
+    votes = np.array([np.bincount(labels[row]).argmax() for row in neighbours])
+    return np.mean(votes == labels)
+
+def nb_counts():
+    """ Returns negative binomial counts (30 genes and 16 spots) 
+    and the conditions (A and B) of the spots. The first 6 genes
+    are differentially expressed.
+    """
+    random = np.random.RandomState(0)
+    means = random.gamma(2.0, 20.0, size=30)
+    lfc = np.zeros(30)
+    lfc[:6] = [2, -2, 1.5, -1, 3, 1]
+    disp = 0.05 + 1.0 / means
+    size_factors = random.uniform(0.6, 1.6, size=16)
+    groups = np.repeat([0, 1], 8)
+    mu = means[:,np.newaxis] * 2**(lfc[:,np.newaxis] * groups) * size_factors
+    counts = random.negative_binomial(1.0 / disp[:,np.newaxis], 
+                                      1.0 / (1.0 + disp[:,np.newaxis] * mu))
+    return counts, np.array(["A", "B"])[groups]
+
+# Comparison B-A of nb_counts()
+NB_LFC = np.array([1.94536867, -2.39243374, 1.13049811, -1.56889291, 2.79517522, 1.41174324,
+                   0.04597655, -0.6430541, -0.28723654, -0.08446929, -0.18893369, -0.44427574,
+                   0.23743667, -0.42391162, -0.0298158, -0.33918991, 0.11094452, -0.14911263,
+                   -0.26499911, -0.55325935, -0.15027516, -0.61705399, 0.04164606, -0.06378033,
+                   -0.20643372, 0.22984646, -0.26499726, 0.10318302, 0.01196949, 0.10311887])
+NB_LFC_SE = np.array([0.16387997, 0.28901409, 0.15775527, 0.44101091, 0.19787869, 0.18222069, 
+                      0.23465576, 0.22077414, 0.22477924, 0.22083337, 0.23577605, 0.30275578, 
+                      1.24321103, 0.18069042, 0.24269453, 0.38343096, 0.20213077, 0.16785969, 
+                      0.28607016, 0.51979749, 0.21437047, 0.1761735, 0.34571734, 0.39521904, 
+                      0.23806779, 0.22442787, 0.38504334, 0.2325939, 0.27531415, 0.27286594])
+
+class TestNegativeBinomial(unittest.TestCase):
+
+    def test_wald(self):
+        counts, conds = nb_counts()
+        result = deaNegativeBinomial(counts, conds, [("B", "A")], 0.1)[0]
+        self.assertEqual(list(result.columns), 
+                         ["baseMean", "log2FoldChange", "lfcSE", "stat", "pvalue", "padj"])
+        np.testing.assert_allclose(result["baseMean"], 
+                                   np.mean(counts / computeSizeFactors(counts), axis=1))
+        np.testing.assert_allclose(result["log2FoldChange"], NB_LFC, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(result["lfcSE"], NB_LFC_SE, rtol=1e-5)
+        np.testing.assert_allclose(result["stat"], NB_LFC / NB_LFC_SE, rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(result["pvalue"], 2.0 * norm.sf(np.abs(NB_LFC / NB_LFC_SE)), 
+                                   rtol=1e-3)
+        np.testing.assert_allclose(result["padj"], false_discovery_control(result["pvalue"]))
+        # Only the differentially expressed genes are significant
+        self.assertEqual(list(np.flatnonzero(result["padj"] < 0.001)), [0, 1, 2, 4, 5])
+
+    def test_inputs(self):
+        # Sparse, data frames, blocks of genes and the opposite comparison
+        counts, conds = nb_counts()
+        genes = ["gene{}".format(i) for i in range(counts.shape[0])]
+        expected = deaNegativeBinomial(counts, conds, [("B", "A")], 0.1)[0]
+        sparse = deaNegativeBinomial(sp.csr_matrix(counts), conds, [("B", "A")], 0.1)[0]
+        pd.testing.assert_frame_equal(sparse, expected)
+        frame = pd.DataFrame(counts, index=genes)
+        blocks, opposite = deaNegativeBinomial(frame, conds, [("B", "A"), ("A", "B")], 0.1, 
+                                               block_size=7, num_workers=2)
+        self.assertEqual(list(blocks.index), genes)
+        np.testing.assert_allclose(blocks.values, expected.values)
+        np.testing.assert_allclose(opposite["log2FoldChange"], -expected["log2FoldChange"])
+        np.testing.assert_allclose(opposite["pvalue"], expected["pvalue"])
+
+    def test_errors(self):
+        counts, conds = nb_counts()
+        self.assertRaises(RuntimeError, deaNegativeBinomial, counts, conds, [("B", "C")], 0.1)
+        self.assertRaises(RuntimeError, deaNegativeBinomial, counts, conds[1:], [("B", "A")], 0.1)
+        self.assertRaises(RuntimeError, deaNegativeBinomial, counts[:,[0, 8]], ["A", "B"], 
+                          [("B", "A")], 0.1)
+
+    @unittest.skipUnless(r_library("DESeq2"), "DESeq2 (R) is not available")
+    def test_deseq2(self):
+        counts, conds = nb_counts()
+        genes = ["gene{}".format(i) for i in range(counts.shape[0])]
+        spots = ["spot{}".format(i) for i in range(counts.shape[1])]
+        frame = pd.DataFrame(counts, index=genes, columns=spots)
+        result = deaNegativeBinomial(frame, conds, [("B", "A")], 0.1)[0]
+        expected = deaDESeq2(frame, conds, [("B", "A")], 0.1)[0]
+        # DESeq2 can replace the counts of the outliers (Cook's distances)
+        expected = expected.loc[genes]
+        tested = np.isfinite(expected["pvalue"].values)
+        self.assertGreater(np.corrcoef(result["log2FoldChange"][tested], 
+                                       expected["log2FoldChange"][tested])[0,1], 0.99)
+        self.assertGreater(np.corrcoef(np.log(result["pvalue"][tested]), 
+                                       np.log(expected["pvalue"][tested]))[0,1], 0.99)
+
+def rank_counts():
+    """ Returns Poisson counts (40 genes and 3 conditions A, B and C 
+    of 12, 9 and 15 spots) with many zeros and ties, the conditions 
+    and the size factors of the spots
+    """
+    random = np.random.RandomState(1)
+    conds = np.repeat(["A", "B", "C"], [12, 9, 15])
+    means = random.gamma(1.0, 3.0, size=(40, 3))[:,np.searchsorted(["A", "B", "C"], conds)]
+    size_factors = random.uniform(0.5, 2.0, size=len(conds))
+    counts = random.poisson(means * size_factors)
+    counts[0] = 0
+    return counts, conds, size_factors
+
+RANK_COMPARISONS = [("A", "B"), ("A", "C"), ("C", "B")]
+
+class TestRankTests(unittest.TestCase):
+
+    def test_wilcoxon(self):
+        counts, conds, size_factors = rank_counts()
+        log_counts = np.log2(counts / size_factors + 1.0)
+        results = deaWilcoxon(counts, conds, RANK_COMPARISONS, 0.1, size_factors=size_factors)
+        for (A, B), result in zip(RANK_COMPARISONS, results):
+            a, b = log_counts[:,conds == A], log_counts[:,conds == B]
+            # The genes with all the values tied are not tested
+            self.assertTrue(np.isnan(result["pvalue"].iloc[0]))
+            for gene in range(1, len(counts)):
+                expected = mannwhitneyu(a[gene], b[gene], use_continuity=True, 
+                                        alternative="two-sided", method="asymptotic")
+                self.assertAlmostEqual(result["pvalue"].iloc[gene], expected.pvalue, places=12)
+                # The statistic is the normal approximation without continuity correction
+                expected = mannwhitneyu(a[gene], b[gene], use_continuity=False, 
+                                        alternative="two-sided", method="asymptotic")
+                sign = np.sign(expected.statistic - a.shape[1] * b.shape[1] / 2.0)
+                self.assertAlmostEqual(result["stat"].iloc[gene], 
+                                       sign * norm.isf(expected.pvalue / 2.0), places=8)
+            np.testing.assert_allclose(result["log2FoldChange"], 
+                                       a.mean(axis=1) - b.mean(axis=1), atol=1e-12)
+            self.assertTrue(result["lfcSE"].isnull().all())
+            tested = result["pvalue"].notnull().values
+            np.testing.assert_allclose(result["padj"][tested], 
+                                       false_discovery_control(result["pvalue"][tested]))
+
+    def test_ttest(self):
+        counts, conds, size_factors = rank_counts()
+        log_counts = np.log2(counts / size_factors + 1.0)
+        results = deaTTest(counts, conds, RANK_COMPARISONS, 0.1, size_factors=size_factors)
+        for (A, B), result in zip(RANK_COMPARISONS, results):
+            a, b = log_counts[1:,conds == A], log_counts[1:,conds == B]
+            expected = ttest_ind(a, b, axis=1, equal_var=False)
+            np.testing.assert_allclose(result["stat"].iloc[1:], expected.statistic, rtol=1e-10)
+            np.testing.assert_allclose(result["pvalue"].iloc[1:], expected.pvalue, rtol=1e-8)
+            np.testing.assert_allclose(result["log2FoldChange"].iloc[1:], 
+                                       a.mean(axis=1) - b.mean(axis=1), atol=1e-12)
+            np.testing.assert_allclose(result["lfcSE"].iloc[1:], 
+                                       np.sqrt(a.var(axis=1, ddof=1) / a.shape[1] + 
+                                               b.var(axis=1, ddof=1) / b.shape[1]), rtol=1e-10)
+
+    def test_inputs(self):
+        # Sparse, blocks of genes and the DESeq2 size factors
+        counts, conds, _ = rank_counts()
+        counts = counts[1:]
+        for func in [deaWilcoxon, deaTTest]:
+            expected = func(counts, conds, RANK_COMPARISONS, 0.1)
+            sparse = func(sp.csr_matrix(counts), conds, RANK_COMPARISONS, 0.1)
+            for result, expected_result in zip(sparse, expected):
+                pd.testing.assert_frame_equal(result, expected_result, check_exact=False)
+        expected = deaWilcoxon(counts, conds, RANK_COMPARISONS, 0.1)
+        blocks = deaWilcoxon(counts, conds, RANK_COMPARISONS, 0.1, block_size=7, num_workers=2)
+        for result, expected_result in zip(blocks, expected):
+            pd.testing.assert_frame_equal(result, expected_result)
+
+class TestTSNE(unittest.TestCase):
+
+    def test_embedding(self):
+        points, labels = blobs()
+        embedding = tsne(points, 2, dims=10, perplexity=20, max_iter=500, num_threads=1)
+        self.assertEqual(embedding.shape, (len(points), 2))
+        self.assertTrue(np.isfinite(embedding).all())
+        self.assertGreater(trustworthiness(points, embedding, n_neighbors=5), 0.9)
+        self.assertEqual(neighbours_accuracy(embedding, labels), 1.0)
+
+    def test_deterministic(self):
+        points, _ = blobs()
+        first = tsne(points, 2, dims=10, perplexity=20, max_iter=300, random_state=1)
+        second = tsne(points, 2, dims=10, perplexity=20, max_iter=300, random_state=1)
+        np.testing.assert_array_equal(first, second)
+
+    def test_options(self):
+        # Three dimensions, less iterations than the early exaggeration (250) 
+        # and more principal components than genes
+        points, _ = blobs(n_spots=20, n_genes=5)
+        embedding = tsne(points, 3, dims=50, perplexity=30, max_iter=100, 
+                         early_exaggeration=4.0, num_threads=1)
+        self.assertEqual(embedding.shape, (len(points), 3))
+        self.assertTrue(np.isfinite(embedding).all())
+        
+    def test_early_iterations(self):
+        points, labels = blobs()
+        embedding = tsne(points, 2, dims=10, perplexity=20, max_iter=500, num_threads=1,
+                         n_iter_early=100, learning_rate="auto")
+        self.assertEqual(neighbours_accuracy(embedding, labels), 1.0)
+        # The number of iterations with early exaggeration is used
+        default = tsne(points, 2, dims=10, perplexity=20, max_iter=500, num_threads=1,
+                       learning_rate="auto")
+        self.assertFalse(np.allclose(embedding, default))
+
+    @unittest.skipUnless(r_library("Rtsne"), "Rtsne (R) is not available")
+    def test_rtsne(self):
+        # The embeddings are not the same but their quality must be similar
+        points, labels = blobs()
+        embedding = tsne(points, 2, dims=10, perplexity=20, max_iter=1000)
+        r_embedding = Rtsne(points, 2, dims=10, perplexity=20, max_iter=1000)
+        self.assertGreater(trustworthiness(points, embedding, n_neighbors=5),
+                           trustworthiness(points, r_embedding, n_neighbors=5) - 0.02)
+        self.assertGreaterEqual(neighbours_accuracy(embedding, labels), 
+                                neighbours_accuracy(r_embedding, labels))
+
+class TestPCA(unittest.TestCase):
+
+    def test_sparse(self):
+        # Sparse counts of rank 5 (the sparse PCA is centered as the exact PCA)
+        random = np.random.RandomState(0)
+        counts = random.uniform(size=(300, 5)).dot(
+            sp.random(5, 100, density=0.3, random_state=random).toarray())
+        for whiten in [False, True]:
+            expected = PCA(n_components=4, svd_solver="full", whiten=whiten).fit_transform(counts)
+            components = computePCA(sp.csr_matrix(counts), 4, whiten=whiten)
+            signs = np.sign(np.sum(components * expected, axis=0))
+            np.testing.assert_allclose(components * signs, expected, atol=1e-8)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+""" 
+Tests of the normalization functions of the st analysis package.
+The expected factors of the small count matrices below were computed
+with a per-spot implementation of edgeR::calcNormFactors (the factors
+are multiplied by the library sizes as computeTMMFactors() and
+computeRLEFactors() do) and DESeq2::estimateSizeFactorsForMatrix. 
+The expected Scran factors were computed solving the linear system
+of the pools of scran::computeSumFactors (dense design matrix).
+When R is available the factors are also compared to the R packages.
+"""
+import unittest
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from stanalysis.normalization import computeTMMFactors, computeRLEFactors, \
+computeSizeFactors, computeSizeFactorsSizeAdjusted, computeSumFactors
+from stanalysis.preprocessing import compute_size_factors, sparse_frame
+
+def r_library(name):
+    """ Returns True if rpy2 and the R library are available
+    """
+    try:
+        from rpy2.robjects.packages import isinstalled
+        return isinstalled(name)
+    except Exception:
+        return False
+
+# Genes as rows and spots as columns (with zeros and a gene not expressed)
+COUNTS = np.array([[0, 0, 2, 2, 5], 
+                   [15, 33, 45, 22, 72], 
+                   [7, 11, 18, 7, 20], 
+                   [0, 0, 0, 0, 0], 
+                   [34, 83, 115, 57, 175], 
+                   [12, 15, 0, 14, 36], 
+                   [5, 13, 25, 18, 30], 
+                   [0, 0, 2, 1, 4], 
+                   [0, 5, 8, 1, 0], 
+                   [4, 9, 32, 12, 31], 
+                   [17, 25, 36, 14, 58], 
+                   [19, 27, 53, 18, 74]])
+COUNTS_TMM = np.array([110.051228997014, 216.216691769332, 346.855351110009, 
+                       164.192336754608, 519.067769471038])
+COUNTS_RLE = np.array([107.60909089657, 220.985001178792, 365.566619951589, 
+                       157.826666648303, 512.685202734797])
+COUNTS_DESEQ2 = np.array([0.464062719831, 0.9529947687, 1.576501004895, 
+                          0.680625322419, 2.210947863383])
+# Counts + 1
+COUNTS_DESEQ2_PSEUDO = np.array([0.49204760596, 0.9547832702, 1.475019580222, 
+                                 0.832696177352, 2.175199012818])
+# Counts + library size / mean library size
+COUNTS_DESEQ2_ADJUSTED = np.array([0.445183951183, 0.948066439567, 1.585323258864, 
+                                   0.711591365691, 2.216792971949])
+
+# Two genes highly expressed in the last spot (composition bias)
+COUNTS_BIAS = np.array([[10, 12, 9, 11],
+                        [20, 22, 18, 500],
+                        [5, 6, 4, 5],
+                        [8, 8, 8, 8],
+                        [30, 28, 33, 29],
+                        [1, 0, 2, 3],
+                        [15, 14, 16, 300],
+                        [7, 9, 6, 8],
+                        [12, 11, 13, 12],
+                        [3, 4, 2, 3]])
+COUNTS_BIAS_TMM = np.array([178.294481139034, 198.88383140032, 
+                            174.778958330889, 199.210928227927])
+COUNTS_BIAS_RLE = np.array([196.194323347179, 196.194323347179, 
+                            158.74214379218, 202.057310525804])
+COUNTS_BIAS_DESEQ2 = np.array([1.0, 1.0, 0.80910671157, 1.029883571954])
+
+# The upper quartile of most spots is zero (the reference spot 
+# is the one with the largest sum of square roots)
+COUNTS_ZEROS = np.array([[3, 5, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0], 
+                         [0, 4, 9, 0, 0, 0, 0, 0, 0, 0, 0, 0], 
+                         [6, 0, 2, 0, 0, 0, 0, 0, 0, 0, 0, 0], 
+                         [8, 1, 3, 2, 5, 1, 1, 4, 2, 6, 1, 3]]).transpose()
+COUNTS_ZEROS_TMM = np.array([7.950713225267, 37.816259706158, 
+                             8.67561769901, 11.801575341346])
+
+def scran_counts():
+    """ Returns the counts (60 genes and 32 spots) and the 
+    clusters (2 clusters of 16 spots) of the Scran tests
+    """
+    random = np.random.RandomState(0)
+    means = random.gamma(2.0, 3.0, size=(60, 1)) * \
+    np.repeat(random.gamma(4.0, 0.25, size=(60, 2)), 16, axis=1)
+    depth = random.uniform(0.5, 2.0, size=32)
+    return random.poisson(means * depth), np.repeat([1, 2], 16)
+
+SCRAN_SIZES = [4, 6, 8]
+SCRAN_CLUSTERS = np.array([0.991662049051, 0.501331939724, 0.817829539735, 0.784258590443,
+                           0.692538671805, 0.683105043901, 0.419411527548, 0.759095839632,
+                           1.21388560171, 1.917124665948, 1.909084398729, 1.102473547667,
+                           0.544709385393, 1.290221648839, 1.146418386993, 1.827716746008,
+                           0.463916233334, 1.290545987799, 0.792697456528, 0.70908485284,
+                           1.162925599565, 0.698916770617, 1.24201268585, 0.952276831057,
+                           0.904075255323, 0.985298047339, 0.606994270052, 1.151230674313,
+                           0.927951665407, 0.870630549324, 1.309914317964, 1.330661219562])
+SCRAN_NO_CLUSTERS = np.array([0.91436676552, 0.494713319896, 0.69049700008, 0.715395374608,
+                              0.646993263822, 0.624301461363, 0.384569101173, 0.631156212502,
+                              1.006014500803, 1.672209534307, 1.640317148061, 1.009225472969,
+                              0.464048959478, 1.357183142358, 0.979234880631, 1.775806971468,
+                              0.468122824646, 1.398615031807, 0.867867151017, 0.798374413069,
+                              1.378862708968, 0.690351974643, 1.290797611472, 1.14182266878,
+                              1.075074110952, 1.225079376359, 0.778614012386, 1.224542134818,
+                              0.924096606626, 0.927345626183, 1.471859790267, 1.332540848968])
+
+class TestEdgeRFactors(unittest.TestCase):
+
+    def check_factors(self, func, counts, expected):
+        for matrix in [counts, sp.csr_matrix(counts), sp.csc_matrix(counts)]:
+            np.testing.assert_allclose(func(matrix), expected, rtol=1e-10)
+
+    def test_tmm(self):
+        self.check_factors(computeTMMFactors, COUNTS, COUNTS_TMM)
+        self.check_factors(computeTMMFactors, COUNTS_BIAS, COUNTS_BIAS_TMM)
+        self.check_factors(computeTMMFactors, COUNTS_ZEROS, COUNTS_ZEROS_TMM)
+
+    def test_rle(self):
+        self.check_factors(computeRLEFactors, COUNTS, COUNTS_RLE)
+        self.check_factors(computeRLEFactors, COUNTS_BIAS, COUNTS_BIAS_RLE)
+
+    def test_rle_no_common_genes(self):
+        # No gene is expressed in every spot (EdgeR returns NA)
+        for matrix in [COUNTS_ZEROS, sp.csr_matrix(COUNTS_ZEROS)]:
+            self.assertTrue(np.isnan(computeRLEFactors(matrix)).all())
+
+    def test_factors_multiply_to_one(self):
+        lib_size = COUNTS_BIAS.sum(axis=0)
+        for func in [computeTMMFactors, computeRLEFactors]:
+            factors = func(COUNTS_BIAS) / lib_size
+            self.assertAlmostEqual(np.exp(np.mean(np.log(factors))), 1.0)
+
+    def test_one_spot(self):
+        for func in [computeTMMFactors, computeRLEFactors]:
+            np.testing.assert_allclose(func(COUNTS[:,:1]), [COUNTS[:,0].sum()])
+
+    @unittest.skipUnless(r_library("edgeR"), "edgeR (R) is not available")
+    def test_edger(self):
+        for counts in [COUNTS, COUNTS_BIAS, COUNTS_ZEROS]:
+            np.testing.assert_allclose(computeTMMFactors(counts), 
+                                       computeTMMFactors(counts, use_r=True), rtol=1e-10)
+        for counts in [COUNTS, COUNTS_BIAS]:
+            np.testing.assert_allclose(computeRLEFactors(counts), 
+                                       computeRLEFactors(counts, use_r=True), rtol=1e-10)
+
+class TestDESeq2Factors(unittest.TestCase):
+
+    def test_size_factors(self):
+        for counts, expected in [(COUNTS, COUNTS_DESEQ2), (COUNTS_BIAS, COUNTS_BIAS_DESEQ2)]:
+            for matrix in [counts, sp.csr_matrix(counts), sp.csc_matrix(counts)]:
+                np.testing.assert_allclose(computeSizeFactors(matrix), expected, rtol=1e-10)
+
+    def test_size_adjusted(self):
+        for matrix in [COUNTS, sp.csr_matrix(COUNTS)]:
+            np.testing.assert_allclose(np.asarray(computeSizeFactorsSizeAdjusted(matrix)).ravel(), 
+                                       COUNTS_DESEQ2_ADJUSTED, rtol=1e-10)
+
+    def test_no_common_genes(self):
+        # No gene is expressed in every spot (DESeq2 returns NA)
+        for matrix in [COUNTS_ZEROS, sp.csr_matrix(COUNTS_ZEROS)]:
+            self.assertTrue(np.isnan(computeSizeFactors(matrix)).all())
+
+    def test_compute_size_factors(self):
+        # Spots as rows and genes as columns (dense and sparse data frames)
+        spots = ["spot{}".format(i) for i in range(COUNTS.shape[1])]
+        genes = ["gene{}".format(i) for i in range(COUNTS.shape[0])]
+        dense = pd.DataFrame(COUNTS.transpose(), index=spots, columns=genes)
+        sparse = sparse_frame(sp.csr_matrix(COUNTS.transpose(), dtype=np.float64), spots, genes)
+        for normalization, expected in [("DESeq2", COUNTS_DESEQ2), 
+                                        ("DESeq2PseudoCount", COUNTS_DESEQ2_PSEUDO),
+                                        ("DESeq2SizeAdjusted", COUNTS_DESEQ2_ADJUSTED)]:
+            for counts in [dense, sparse]:
+                size_factors = compute_size_factors(counts, normalization)
+                np.testing.assert_allclose(np.asarray(size_factors).ravel(), expected, rtol=1e-10)
+
+    @unittest.skipUnless(r_library("DESeq2"), "DESeq2 (R) is not available")
+    def test_deseq2(self):
+        for counts in [COUNTS, COUNTS_BIAS]:
+            np.testing.assert_allclose(computeSizeFactors(counts), 
+                                       computeSizeFactors(counts, use_r=True), rtol=1e-10)
+
+class TestScranFactors(unittest.TestCase):
+
+    def test_clusters(self):
+        counts, clusters = scran_counts()
+        for matrix in [counts, sp.csc_matrix(counts), sp.csr_matrix(counts)]:
+            for num_workers in [1, 2]:
+                factors = computeSumFactors(matrix, clusters=clusters, sizes=SCRAN_SIZES,
+                                            num_workers=num_workers)
+                np.testing.assert_allclose(factors, SCRAN_CLUSTERS, rtol=1e-8)
+
+    def test_no_clusters(self):
+        counts, _ = scran_counts()
+        for matrix in [counts, sp.csc_matrix(counts)]:
+            factors = computeSumFactors(matrix, scran_clusters=False, sizes=SCRAN_SIZES)
+            np.testing.assert_allclose(factors, SCRAN_NO_CLUSTERS, rtol=1e-8)
+
+    def test_low_counts(self):
+        # No gene has an average count >= min_mean
+        counts, clusters = scran_counts()
+        factors = computeSumFactors(counts, clusters=clusters, sizes=SCRAN_SIZES, min_mean=1e6)
+        self.assertTrue(np.isnan(factors).all())
+
+    def test_small_clusters(self):
+        counts, _ = scran_counts()
+        self.assertRaises(RuntimeError, computeSumFactors, counts, 
+                          clusters=np.arange(counts.shape[1]) % 16, sizes=SCRAN_SIZES)
+
+    @unittest.skipUnless(r_library("scran"), "scran (R) is not available")
+    def test_scran(self):
+        counts, _ = scran_counts()
+        np.testing.assert_allclose(computeSumFactors(counts, scran_clusters=False), 
+                                   computeSumFactors(counts, scran_clusters=False, use_r=True),
+                                   rtol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()